@@ -0,0 +1,77 @@
+"""Shared pieces for the benchmarks. Run benchmarks from the repository root, eg.
+
+    python bench/broadcast_bench.py
+"""
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test'))
+
+from twisted.internet.address import IPv4Address
+import juggernaut
+from juggernaut.channels import ClientSet
+from test_helper import connectProtocol
+
+config = {
+    'host': 'localhost',
+    'port': 5003,
+    'allowed_ips': ['127.0.0.1'],
+    'subscription_url': 'http://localhost:8080/subscribe',
+    'logout_connection_url': 'http://localhost:8080/disconnected',
+    'logout_url': 'http://localhost:8080/logged_out',
+    'timeout': 10
+}
+
+class NullTransport:
+    '''Transport swallowing everything, counts writes and bytes'''
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+        
+    def write(self, data):
+        self.writes += 1
+        self.bytes += len(data)
+        
+    def writeSequence(self, seq):
+        self.writes += 1
+        self.bytes += sum(map(len, seq))
+        
+    def loseConnection(self):
+        pass
+        
+    def getHost(self):
+        return IPv4Address('TCP', '127.0.0.1', config['port'])
+        
+    def registerProducer(self, producer, streaming):
+        pass
+        
+    def unregisterProducer(self):
+        pass
+
+def makeConnector(service):
+    '''JuggernautProtocol connected to a NullTransport'''
+    return connectProtocol(service, transport=NullTransport())
+
+def makeService(**options):
+    cfg = dict(config)
+    cfg.update(options)
+    return juggernaut.makeService(cfg)
+    
+def addClients(service, num, channels=[1]):
+    '''Create num alive clients spread evenly across channels, without calling the webhooks'''
+    clients = []
+    for i in xrange(num):
+        channel_id = channels[i % len(channels)]
+        client = service.findOrCreateClient(makeConnector(service), i, i, channel_id)
+        service.channels.setdefault(channel_id, ClientSet()).add(client)
+        client.channel_id = channel_id
+        clients.append(client)
+    return clients
+
+def cpuTime(f, *args, **kwargs):
+    '''Return CPU seconds spent in f'''
+    start = time.clock()
+    f(*args, **kwargs)
+    return time.clock() - start
+
+def report(name, seconds, num):
+    print '%-40s %10.3f ms total %10.3f us per item' % (name, seconds * 1000, seconds * 1000000 / num)
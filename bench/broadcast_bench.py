@@ -0,0 +1,35 @@
+"""Compares per-recipient CPU cost of a broadcast when the body is serialized for
+every recipient (the old path) and when it is serialized once and the frame is shared."""
+from bench_helper import *
+from juggernaut import Message, JuggernautProtocol
+
+RECIPIENTS = 20000
+BODY = {'type': 'chat', 'user': {'id': 123, 'name': 'John Smith'}, 'text': 'Lorem ipsum dolor sit amet ' * 30}
+
+def legacyBroadcast(clients, body):
+    for client in clients:
+        msg = Message(body)
+        client.connector.transport.write(str(msg) + JuggernautProtocol.CR)
+        
+def sharedBroadcast(clients, body):
+    msg = Message(body)
+    for client in clients:
+        client.connector.transport.write(msg.frame())
+
+def sharedWebSocketBroadcast(clients, body):
+    msg = Message(body)
+    for client in clients:
+        client.connector.transport.write(msg.websocketFrame())
+
+def serviceBroadcast(service, client_ids, body):
+    service.broadcast_to_clients({'body': body, 'client_ids': client_ids})
+
+if __name__ == '__main__':
+    service = makeService()
+    clients = addClients(service, RECIPIENTS)
+    client_ids = [client.client_id for client in clients]
+    
+    report('encode per recipient', cpuTime(legacyBroadcast, clients, BODY), RECIPIENTS)
+    report('encode once, shared frame', cpuTime(sharedBroadcast, clients, BODY), RECIPIENTS)
+    report('encode once, shared WebSocket frame', cpuTime(sharedWebSocketBroadcast, clients, BODY), RECIPIENTS)
+    report('JuggernautService.broadcast_to_clients', cpuTime(serviceBroadcast, service, client_ids, BODY), RECIPIENTS)
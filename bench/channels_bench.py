@@ -0,0 +1,44 @@
+"""Subscribes 100k clients across a few channels and removes them in random order,
+with channel members kept in ClientSet. Lists (the old way) are measured with 5k clients only,
+removing 100k clients from lists takes many minutes."""
+from bench_helper import *
+import random
+
+CLIENTS = 100000
+LIST_CLIENTS = 5000
+CHANNELS = [1, 2, 3, 4]
+
+def subscribeToLists(channels, clients):
+    for client in clients:
+        channels.setdefault(client.channel_id, []).append(client)
+
+def removeFromLists(channels, clients):
+    for client in clients:
+        channels[client.channel_id].remove(client)
+        
+def subscribeToSets(channels, clients):
+    for client in clients:
+        channels.setdefault(client.channel_id, ClientSet()).add(client)
+
+def removeFromSets(channels, clients):
+    for client in clients:
+        channels[client.channel_id].remove(client)
+        
+def removeFromService(service, clients):
+    for client in clients:
+        service.removeClient(client)
+
+if __name__ == '__main__':
+    service = makeService()
+    clients = addClients(service, CLIENTS, CHANNELS)
+    leaving = list(clients)
+    random.seed(1)
+    random.shuffle(leaving)
+    
+    channels = {}
+    report('list subscribe (5k)', cpuTime(subscribeToLists, channels, clients[:LIST_CLIENTS]), LIST_CLIENTS)
+    report('list remove (5k)', cpuTime(removeFromLists, channels, [c for c in leaving if c.client_id < LIST_CLIENTS]), LIST_CLIENTS)
+    channels = {}
+    report('ClientSet subscribe', cpuTime(subscribeToSets, channels, clients), CLIENTS)
+    report('ClientSet remove', cpuTime(removeFromSets, channels, leaving), CLIENTS)
+    report('JuggernautService.removeClient', cpuTime(removeFromService, service, leaving), CLIENTS)
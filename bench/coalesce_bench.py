@@ -0,0 +1,90 @@
+"""Writes and send syscalls per delivered message for bursty traffic, with write_coalesce_delay unset, 
+0 and 5 ms. Subscribers connect over real sockets, every 10 ms a burst of broadcasts is published to 
+their channel. Twisted itself only sends from doWrite once per reactor iteration, so coalescing saves
+calls into the transport more than it saves syscalls."""
+from bench_helper import *
+from twisted.internet import reactor, protocol, defer, task, tcp
+import json
+
+SUBSCRIBERS = 200
+BURSTS = 50
+BURST_SIZE = 10
+BODY = {'type': 'chat', 'text': 'Lorem ipsum dolor sit amet ' * 5}
+DELAYS = [None, 0, 0.005]
+
+counts = {'write': 0, 'send': 0}
+
+def counting(name, method):
+    def wrapper(self, *args):
+        counts[name] += 1
+        return method(self, *args)
+    return wrapper
+    
+tcp.Server.write = counting('write', tcp.Server.write)
+tcp.Server.writeSequence = counting('write', tcp.Server.writeSequence)
+tcp.Server.writeSomeData = counting('send', tcp.Server.writeSomeData)
+
+class AdmittedProtocol(juggernaut.JuggernautProtocol):
+    '''Joins channel 1 as soon as it connects, without the subscribe webhook'''
+    def connectionMade(self):
+        juggernaut.JuggernautProtocol.connectionMade(self)
+        service = self.factory.service
+        self.client = service.findOrCreateClient(self, len(service.clients), len(service.clients), 1)
+        service.addToChannel(self.client, 1)
+        
+    def connectionLost(self, reason):
+        pass # no webhooks
+
+class Subscriber(protocol.Protocol):
+    def connectionMade(self):
+        self.factory.connected += 1
+        
+    def dataReceived(self, data):
+        self.factory.received += data.count('\0')
+
+@defer.inlineCallbacks
+def waitUntil(condition):
+    while not condition():
+        yield task.deferLater(reactor, 0.01, lambda: None)
+
+@defer.inlineCallbacks
+def run(delay):
+    service = makeService(write_coalesce_delay=delay)
+    factory = juggernaut.IJuggernautFactory(service)
+    factory.protocol = AdmittedProtocol
+    port = reactor.listenTCP(config['port'], factory, backlog=SUBSCRIBERS)
+    clients = protocol.ClientFactory()
+    clients.protocol = Subscriber
+    clients.connected = clients.received = 0
+    connectors = [reactor.connectTCP('127.0.0.1', config['port'], clients) for i in xrange(SUBSCRIBERS)]
+    yield waitUntil(lambda: clients.connected == SUBSCRIBERS and len(service.channels.get(1, ())) == SUBSCRIBERS)
+    
+    counts.update(write=0, send=0)
+    start = time.clock()
+    for burst in xrange(BURSTS):
+        for i in xrange(BURST_SIZE):
+            service.broadcast({'type': 'to_channels', 'channels': [1], 'body': BODY})
+        yield task.deferLater(reactor, 0.01, lambda: None)
+    expected = SUBSCRIBERS * BURSTS * BURST_SIZE
+    yield waitUntil(lambda: clients.received >= expected)
+    seconds = time.clock() - start
+    
+    print '%-28s %8.3f writes %8.3f sends per message %10.3f us CPU per message' % (
+        'write_coalesce_delay=%s' % delay, float(counts['write']) / expected, float(counts['send']) / expected, 
+        seconds * 1000000 / expected)
+    for connector in connectors:
+        connector.disconnect()
+    yield port.stopListening()
+    yield service.stopService()
+    
+@defer.inlineCallbacks
+def main():
+    try:
+        for delay in DELAYS:
+            yield run(delay)
+    finally:
+        reactor.stop()
+
+if __name__ == '__main__':
+    reactor.callWhenRunning(main)
+    reactor.run()
@@ -0,0 +1,28 @@
+"""Encoding and decoding cost of representative frames with every installed JSON backend."""
+from bench_helper import *
+from juggernaut import codec
+
+ROUNDS = 20000
+BODY = {'type': 'chat', 'user': {'id': 123, 'name': 'John Smith'}, 'text': 'Lorem ipsum dolor sit amet ' * 10}
+FRAMES = {
+    'subscribe': {'command': 'subscribe', 'client_id': 123, 'session_id': 456, 'channels': [1], 'last_msg_id': 789},
+    'broadcast': {'command': 'broadcast', 'type': 'to_channels', 'channels': [1, 2], 'body': BODY},
+    'query': {'command': 'query', 'type': 'show_clients', 'client_ids': range(100)},
+    'message': {'id': 12345, 'body': BODY},
+    'query response': [{'client_id': i, 'num_connections': 1, 'session_id': i} for i in range(100)]
+}
+
+def decode(text):
+    for i in xrange(ROUNDS):
+        codec.loads(text)
+        
+def encode(frame):
+    for i in xrange(ROUNDS):
+        codec.dumps(frame)
+
+if __name__ == '__main__':
+    for name in codec.available():
+        codec.use(name)
+        for kind, frame in sorted(FRAMES.items()):
+            report('%-10s decode %s' % (name, kind), cpuTime(decode, codec.dumps(frame)), ROUNDS)
+            report('%-10s encode %s' % (name, kind), cpuTime(encode, frame), ROUNDS)
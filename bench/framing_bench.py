@@ -0,0 +1,44 @@
+"""Feeds NUL terminated frames to the old split-everything buffer and to NulFrameDecoder
+in 1 byte, 1 KB and 64 KB chunks."""
+from bench_helper import *
+from juggernaut.framing import NulFrameDecoder
+import re
+
+class LegacyBuffer:
+    '''The buffering JuggernautProtocol.dataReceived used to do'''
+    CR = "\0"
+    CR_END = re.compile(CR + '$')
+    
+    def __init__(self):
+        self.buffer = ""
+        
+    def feed(self, data):
+        self.buffer += data
+        split = self.buffer.split(self.CR)
+        if not self.CR_END.match(self.buffer):
+            self.buffer = split.pop()
+        return split
+
+PATTERNS = [
+    # chunk size, frame size, number of frames
+    (1, 16 * 1024, 1),
+    (1024, 1024 * 1024, 2),
+    (64 * 1024, 4 * 1024 * 1024, 4),
+]
+
+def chunks(chunk_size, frame_size, num_frames):
+    stream = ('x' * (frame_size - 1) + "\0") * num_frames
+    return [stream[i:i + chunk_size] for i in xrange(0, len(stream), chunk_size)]
+    
+def feedAll(decoder, data):
+    frames = 0
+    for chunk in data:
+        frames += len(decoder.feed(chunk))
+    return frames
+
+if __name__ == '__main__':
+    for chunk_size, frame_size, num_frames in PATTERNS:
+        data = chunks(chunk_size, frame_size, num_frames)
+        name = '%d B chunks, %d KB frames' % (chunk_size, frame_size / 1024)
+        report('legacy ' + name, cpuTime(feedAll, LegacyBuffer(), data), len(data))
+        report('decoder ' + name, cpuTime(feedAll, NulFrameDecoder(), data), len(data))
@@ -0,0 +1,213 @@
+"""Load generator built on MockFlashClient and MockWebServer from the test suite. It opens --clients 
+subscriber connections spread over --channels channels, broadcasts to random channels at --rate 
+broadcasts per second through a publisher connection, and measures end-to-end delivery latency from 
+the send time carried in every body. Results are printed, or written to --output, as JSON.
+
+Scenarios:
+    steady            only the broadcasts
+    reconnect_storm   in the middle of the run all subscribers drop and reconnect at once
+    mass_disconnect   after the run all subscribers drop at once, measures how long the disconnected 
+                      and logged_out webhooks take
+
+By default Juggernaut runs in this process. With --host and --port it loads a server running elsewhere,
+whose webhooks should point at the mock Rails app listening on --web-port. Eg.
+
+    python bench/loadgen.py --clients 2000 --channels 20 --rate 200 --duration 10 --scenario reconnect_storm
+"""
+from bench_helper import *
+from twisted.internet import reactor, defer, task
+from twisted.python import log
+import argparse, json, random, time
+
+from test_helper import MockFlashClient, ClientProtocol, MockWebServer
+
+class Recorder:
+    def __init__(self):
+        self.latencies = []
+        self.delivered = 0
+        
+    def percentiles(self):
+        if not self.latencies:
+            return {}
+        latencies = sorted(self.latencies)
+        at = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+        return {
+            'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99), 'max': latencies[-1] * 1000, 
+            'mean': sum(latencies) * 1000 / len(latencies)
+        }
+
+recorder = Recorder()
+
+class LatencyClientProtocol(ClientProtocol):
+    '''Records the latency of every message instead of keeping it'''
+    def messageReceived(self, message):
+        recorder.delivered += 1
+        recorder.latencies.append(time.time() - json.loads(message)['body']['sent'])
+        
+class LoadClient(MockFlashClient):
+    protocol = LatencyClientProtocol
+
+class LoadGenerator:
+    CONNECT_BATCH = 200
+    
+    def __init__(self, options):
+        self.options = options
+        self.subscribers = {}
+        self.publisher = None
+        self.broadcasts = 0
+        self.expected = 0
+        self.results = {
+            'scenario': options.scenario, 'clients': options.clients, 'channels': options.channels, 
+            'rate': options.rate, 'duration': options.duration, 'timestamp': time.time()
+        }
+        
+    def startServer(self):
+        self.webServer = MockWebServer(self.options.web_port, lambda request: '')
+        if self.options.host:
+            self.results['server'] = '%s:%d' % (self.options.host, self.options.port)
+            return
+        url = 'http://127.0.0.1:%d/' % self.options.web_port
+        self.service = makeService(port=self.options.port, log_level='warning', timeout=self.options.timeout,
+            subscription_url=url + 'subscribe', logout_connection_url=url + 'disconnected', logout_url=url + 'logged_out')
+        self.listeningPort = reactor.listenTCP(self.options.port, juggernaut.IJuggernautFactory(self.service), backlog=1024)
+        self.results['server'] = 'in-process'
+        
+    @defer.inlineCallbacks
+    def stopServer(self):
+        '''Disconnect everybody and let the disconnected webhooks through before anything stops listening'''
+        connected = [client for client in self.subscribers.values() if client.connector.state == 'connected']
+        disconnected = self.webServer.received.get('disconnected', 0) + len(connected)
+        for client in connected + filter(None, [self.publisher]):
+            client.connector.disconnect()
+        yield self.waitForWebhooks('disconnected', disconnected, 10)
+        if not self.options.host:
+            yield self.listeningPort.stopListening()
+            yield self.service.stopService()
+        yield self.webServer.stopListening()
+        
+    def connect(self, client_id=None):
+        return LoadClient(client_id, self.options.host or '127.0.0.1', self.options.port)
+        
+    @defer.inlineCallbacks
+    def subscribeAll(self):
+        '''Connect and subscribe every client, in batches so the listen backlog doesn't overflow'''
+        expected = self.webServer.received.get('subscribe', 0) + self.options.clients
+        for start in xrange(0, self.options.clients, self.CONNECT_BATCH):
+            batch = [self.connect(i) for i in xrange(start, min(start + self.CONNECT_BATCH, self.options.clients))]
+            yield defer.DeferredList([client.connectedEvent for client in batch])
+            for client in batch:
+                client.sendSubscribeMessage([client.id % self.options.channels])
+                self.subscribers[client.id] = client
+        yield self.waitForWebhooks('subscribe', expected)
+        
+    @defer.inlineCallbacks
+    def waitForWebhooks(self, path, count, timeout=60):
+        '''Seconds until the mock Rails app got count requests to path'''
+        start = time.time()
+        while self.webServer.received.get(path, 0) < count and time.time() - start < timeout:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        defer.returnValue(time.time() - start)
+        
+    @defer.inlineCallbacks
+    def disconnectAll(self):
+        clients = self.subscribers.values()
+        for client in clients:
+            client.connector.disconnect()
+        yield defer.DeferredList([client.disconnectedEvent for client in clients])
+        
+    def publish(self, seconds):
+        '''Broadcast at the target rate for the given time, sending as many broadcasts every tick as are due'''
+        members = self.options.clients / self.options.channels
+        start = time.time()
+        d = defer.Deferred()
+        def tick():
+            elapsed = time.time() - start
+            while self.broadcasts < self.sent_before + int(elapsed * self.options.rate):
+                channel = random.randrange(self.options.channels)
+                self.publisher.sendMessage({'command': 'broadcast', 'type': 'to_channels', 'channels': [channel], 
+                    'body': {'sent': time.time(), 'seq': self.broadcasts}})
+                self.broadcasts += 1
+                self.expected += members + (channel < self.options.clients % self.options.channels)
+            if elapsed >= seconds:
+                loop.stop()
+                d.callback(None)
+        self.sent_before = self.broadcasts
+        loop = task.LoopingCall(tick)
+        loop.start(0.005)
+        return d
+        
+    @defer.inlineCallbacks
+    def run(self):
+        self.startServer()
+        try:
+            start = time.time()
+            yield self.subscribeAll()
+            self.results['subscribe_seconds'] = time.time() - start
+            self.publisher = self.connect()
+            yield self.publisher.connectedEvent
+            
+            scenario = self.options.scenario
+            if scenario == 'reconnect_storm':
+                yield self.publish(self.options.duration / 2.0)
+                storm = time.time()
+                yield self.disconnectAll()
+                publishing = self.publish(self.options.duration / 2.0)
+                yield self.subscribeAll()
+                self.results['reconnect_seconds'] = time.time() - storm
+                yield publishing
+            else:
+                yield self.publish(self.options.duration)
+                
+            yield self.waitForDeliveries()
+            if scenario == 'mass_disconnect':
+                disconnected = self.webServer.received.get('disconnected', 0) + self.options.clients
+                logged_out = self.webServer.received.get('logged_out', 0) + self.options.clients
+                start = time.time()
+                yield self.disconnectAll()
+                yield self.waitForWebhooks('disconnected', disconnected)
+                self.results['disconnected_webhooks_seconds'] = time.time() - start
+                yield self.waitForWebhooks('logged_out', logged_out, self.options.timeout + 60)
+                self.results['logged_out_webhooks_seconds'] = time.time() - start
+            
+            self.results.update({
+                'broadcasts': self.broadcasts, 'expected_deliveries': self.expected, 'delivered': recorder.delivered,
+                'lost': self.expected - recorder.delivered, 
+                'latency_ms': recorder.percentiles()
+            })
+        finally:
+            yield self.stopServer()
+            
+    @defer.inlineCallbacks
+    def waitForDeliveries(self, timeout=10):
+        start = time.time()
+        while recorder.delivered < self.expected and time.time() - start < timeout:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+def parseOptions():
+    parser = argparse.ArgumentParser(description='Juggernaut load generator')
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--channels', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=100, help='broadcasts per second')
+    parser.add_argument('--duration', type=float, default=5, help='seconds of broadcasting')
+    parser.add_argument('--scenario', choices=['steady', 'reconnect_storm', 'mass_disconnect'], default='steady')
+    parser.add_argument('--host', help='load a server running elsewhere instead of one in this process')
+    parser.add_argument('--port', type=int, default=config['port'])
+    parser.add_argument('--web-port', type=int, default=8081, help='port of the mock Rails app answering the webhooks')
+    parser.add_argument('--timeout', type=float, default=2, help='timeout of the in-process server')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    options = parseOptions()
+    generator = LoadGenerator(options)
+    
+    def finished(_):
+        results = json.dumps(generator.results, indent=2, sort_keys=True)
+        if options.output:
+            open(options.output, 'w').write(results)
+        print results
+    def failed(err):
+        log.err(err)
+    d = generator.run().addCallbacks(finished, failed)
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
@@ -0,0 +1,30 @@
+"""CPU cost of a broadcast to many clients with logging at different levels, compared with 
+the old per-recipient log line. Log output goes to /dev/null, so only formatting and dispatching 
+the log events is measured."""
+from bench_helper import *
+from twisted.python import log
+from juggernaut.logs import logger
+import os
+
+RECIPIENTS = 10000
+BODY = {'type': 'chat', 'user': {'id': 123, 'name': 'John Smith'}, 'text': 'Lorem ipsum dolor sit amet ' * 30}
+
+def perRecipientLogging(clients, body):
+    msg = juggernaut.Message(body)
+    for client in clients:
+        log.msg("Sending message to client_id=%s body=%s" % (str(client.client_id), str(msg)))
+        client.deliverMessage(msg)
+
+def serviceBroadcast(service, client_ids, body):
+    service.broadcast_to_clients({'body': body, 'client_ids': client_ids})
+
+if __name__ == '__main__':
+    log.startLogging(open(os.devnull, 'w'), setStdout=False)
+    service = makeService()
+    clients = addClients(service, RECIPIENTS)
+    client_ids = [client.client_id for client in clients]
+    
+    report('log line per recipient', cpuTime(perRecipientLogging, clients, BODY), RECIPIENTS)
+    for level, sampling in [('debug', 1.0), ('debug', 0.01), ('info', 1.0), ('error', 1.0)]:
+        logger.configure(level, sampling)
+        report('broadcast, log_level=%s sampling=%s' % (level, sampling), cpuTime(serviceBroadcast, service, client_ids, BODY), RECIPIENTS)
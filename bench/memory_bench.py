@@ -0,0 +1,26 @@
+"""Memory taken by idle connections: a subscribed JuggernautClient with its JuggernautProtocol, on a
+transport which takes no memory itself. Reports resident memory growth per connection at 10k and 100k
+connections, each count measured in a fresh process. Linux only, it reads /proc/self/statm."""
+from bench_helper import *
+import gc, os, resource, subprocess, sys
+
+COUNTS = [10000, 100000]
+
+def residentBytes():
+    return int(open('/proc/self/statm').read().split()[1]) * resource.getpagesize()
+    
+def measure(count):
+    service = makeService(log_level='warning')
+    gc.collect()
+    before = residentBytes()
+    clients = addClients(service, count, range(count / 100))
+    gc.collect()
+    return (residentBytes() - before) / float(count)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        print measure(int(sys.argv[1]))
+    else:
+        for count in COUNTS:
+            per_connection = float(subprocess.check_output([sys.executable, __file__, str(count)]))
+            print '%-40s %10.0f bytes per idle connection' % ('%d connections' % count, per_connection)
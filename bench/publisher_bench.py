@@ -0,0 +1,38 @@
+"""Messages per second a publisher gets through when it sends one broadcast frame per message,
+and when it packs them into batch broadcasts. Frames are fed straight to the protocol, so this
+measures the server side CPU cost of parsing, authenticating, dispatching and writing."""
+from bench_helper import *
+import json
+
+MESSAGES = 20000
+RECIPIENTS = 20
+CHANNELS = 10
+BODY = {'type': 'chat', 'user': {'id': 123, 'name': 'John Smith'}, 'text': 'Lorem ipsum dolor sit amet'}
+
+def singleFrames():
+    return ''.join(json.dumps({'command': 'broadcast', 'type': 'to_channels', 'channels': [i % CHANNELS], 'body': BODY}) + '\0' 
+        for i in xrange(MESSAGES))
+
+def batchFrames(size):
+    frames = []
+    for start in xrange(0, MESSAGES, size):
+        entries = [{'channels': [i % CHANNELS], 'body': BODY} for i in xrange(start, start + size)]
+        frames.append(json.dumps({'command': 'broadcast', 'type': 'batch', 'broadcasts': entries}) + '\0')
+    return ''.join(frames)
+
+def publish(service, data):
+    connector = makeConnector(service)
+    connector.dataReceived(data)
+    return connector
+
+if __name__ == '__main__':
+    service = makeService(log_level='warning')
+    clients = addClients(service, RECIPIENTS, range(CHANNELS))
+    
+    for name, data in [('one frame per message', singleFrames())] + \
+            [('batches of %d' % size, batchFrames(size)) for size in [10, 100, 1000]]:
+        writes = sum(client.connector.transport.writes for client in clients)
+        seconds = cpuTime(publish, service, data)
+        writes = sum(client.connector.transport.writes for client in clients) - writes
+        report(name, seconds, MESSAGES)
+        print '%-40s %10.0f messages/s %10d socket writes' % ('', MESSAGES / seconds, writes)
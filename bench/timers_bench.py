@@ -0,0 +1,38 @@
+"""Schedules and cancels 100k pending logout timeouts with reactor.callLater (the old way)
+and with TimerWheel, then expires 100k timeouts through the wheel."""
+from bench_helper import *
+from twisted.internet import reactor, task
+from juggernaut.timers import TimerWheel
+
+PENDING = 100000
+TIMEOUT = 10
+
+def noop(*a):
+    pass
+
+def schedule(callLater, num):
+    return [callLater(TIMEOUT, noop, i) for i in xrange(num)]
+    
+def cancel(calls):
+    for call in calls:
+        call.cancel()
+        
+def expire(clock, wheel, num):
+    for i in xrange(num):
+        wheel.schedule(TIMEOUT + (i % 100) * 0.01, noop, i)
+    clock.advance(TIMEOUT + 1)
+
+if __name__ == '__main__':
+    calls = []
+    report('reactor.callLater schedule', cpuTime(lambda: calls.extend(schedule(reactor.callLater, PENDING))), PENDING)
+    report('reactor.callLater cancel', cpuTime(cancel, calls), PENDING)
+    print '%-40s %10d' % ('reactor pending delayed calls', len(reactor.getDelayedCalls()))
+    
+    wheel = TimerWheel(0.1)
+    timers = []
+    report('TimerWheel schedule', cpuTime(lambda: timers.extend(schedule(wheel.schedule, PENDING))), PENDING)
+    print '%-40s %10d' % ('reactor pending delayed calls', len(reactor.getDelayedCalls()))
+    report('TimerWheel cancel', cpuTime(cancel, timers), PENDING)
+    
+    clock = task.Clock()
+    report('TimerWheel expire', cpuTime(expire, clock, TimerWheel(0.1, clock), PENDING), PENDING)
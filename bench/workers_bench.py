@@ -0,0 +1,99 @@
+"""Broadcast throughput of a server running 1, 2 and 4 worker processes. Subscribers connect over
+real sockets and only count the frames they receive, publishers keep a fixed number of broadcasts
+in flight. Prints delivered messages per second for every worker count.
+
+The subscribers live in this process, so on a machine with few cores they may become the bottleneck
+before the workers do."""
+from bench_helper import *
+from twisted.internet import reactor, protocol, defer, task
+from twisted.web import resource, server
+from juggernaut.workers import WorkerPoolService
+import json, os
+
+SUBSCRIBERS = 200
+PUBLISHERS = 4
+BROADCASTS = 1000
+WORKER_COUNTS = [1, 2, 4]
+WEB_PORT = 8081
+
+class Ok(resource.Resource):
+    isLeaf = True
+    def render_POST(self, request):
+        return ''
+
+class Subscriber(protocol.Protocol):
+    def connectionMade(self):
+        self.transport.write(json.dumps({'command': 'subscribe', 'client_id': self.factory.next_id, 
+            'session_id': self.factory.next_id, 'channels': [1]}) + '\0')
+        self.factory.next_id += 1
+        self.factory.connected.append(self)
+        
+    def dataReceived(self, data):
+        self.factory.received += data.count('\0')
+        
+class Publisher(protocol.Protocol):
+    BROADCAST = json.dumps({'command': 'broadcast', 'type': 'to_channels', 'channels': [1], 'body': 'x' * 200}) + '\0'
+    
+    def connectionMade(self):
+        self.factory.connected.append(self)
+        
+    def publish(self, num):
+        self.transport.write(self.BROADCAST * num)
+
+def connectAll(factory_protocol, num, factory=None):
+    factory = factory or protocol.ClientFactory()
+    factory.protocol = factory_protocol
+    factory.connected = []
+    for i in xrange(num):
+        reactor.connectTCP('127.0.0.1', config['port'], factory)
+    def waitForAll():
+        if len(factory.connected) < num:
+            return task.deferLater(reactor, 0.05, waitForAll)
+        return factory
+    return task.deferLater(reactor, 0.05, waitForAll)
+
+@defer.inlineCallbacks
+def measure(workers):
+    pool = WorkerPoolService(dict(config, workers=workers, websocket_port=None, 
+        subscription_url='http://127.0.0.1:%d/' % WEB_PORT, logout_connection_url='http://127.0.0.1:%d/' % WEB_PORT,
+        logout_url='http://127.0.0.1:%d/' % WEB_PORT))
+    pool.startService()
+    yield task.deferLater(reactor, 1, lambda: None) # let the workers start
+    
+    subscribers = protocol.ClientFactory()
+    subscribers.next_id = 0
+    subscribers.received = 0
+    yield connectAll(Subscriber, SUBSCRIBERS, subscribers)
+    publishers = yield connectAll(Publisher, PUBLISHERS)
+    yield task.deferLater(reactor, 1, lambda: None) # let the subscribe webhooks finish
+    
+    expected = SUBSCRIBERS * BROADCASTS
+    start = time.time()
+    for publisher in publishers.connected:
+        publisher.publish(BROADCASTS / PUBLISHERS)
+    while subscribers.received < expected and time.time() - start < 60:
+        yield task.deferLater(reactor, 0.01, lambda: None)
+    elapsed = time.time() - start
+    print '%d workers: %10d messages delivered in %.3f s, %10.0f messages/s' % (workers, 
+        subscribers.received, elapsed, subscribers.received / elapsed)
+    
+    for p in subscribers.connected + publishers.connected:
+        p.transport.loseConnection()
+    yield pool.stopService()
+
+@defer.inlineCallbacks
+def main():
+    web = reactor.listenTCP(WEB_PORT, server.Site(Ok()))
+    try:
+        for workers in WORKER_COUNTS:
+            yield measure(workers)
+    finally:
+        web.stopListening()
+        reactor.stop()
+
+if __name__ == '__main__':
+    # the workers log a line for every broadcast, keep that out of the results
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 2)
+    reactor.callWhenRunning(main)
+    reactor.run()
@@ -1,45 +1,84 @@
 #!/usr/bin/env python
 from twisted.application import service, internet
-from twisted.internet import protocol, defer, reactor
-from twisted.python import log, components
-from twisted.web import client as web_client
+from twisted.internet import protocol, defer, reactor, task
+from twisted.internet.interfaces import IPushProducer
+from twisted.python import components
 from zope.interface import implements, Interface
-import sys, re, json
+import os, zlib, base64
 
 from helpers import RequestParamsHelper
+from framing import NulFrameDecoder, FrameTooLarge
+from webhooks import WebhookClient, WebhookBatcher, SubscribeBatcher
+from channels import ClientSet
+from storage import MessageStore, WriteQueue, HistoryCache
+from timers import TimerWheel, FlushScheduler
+import websocket
+import codec
+from logs import logger
+from metrics import Registry, RECIPIENT_BUCKETS, mergeSnapshots
+from cluster import BACKPLANES
+from admission import POLICY_FILE_REQUEST, policyFile, ConnectionRateLimiter
+import snapshot
 
 class IJuggernautClient(Interface):
     def __init__(self, connector, client_id, session_id):
         pass
     
-    def markDead(self):
-        """Mark client connection as disconnected. Dead clients only store messages"""
+    def markDead(self, unsent=()):
+        """Mark client connection as disconnected. Dead clients only store messages, starting with the frames 
+        the connection hadn't written"""
 
-class JuggernautClient():
+class JuggernautClient(object):
     implements(IJuggernautClient)
+    # one instance per connected user, so no __dict__
+    __slots__ = ('connector', 'client_id', 'channel_id', 'session_id', 'is_alive', 'service', 
+        'logoutTaskCall', 'stored_messages', 'buffered', 'repr_hash')
 
-    def __init__(self, connector, client_id, session_id, channel_id):
+    def __init__(self, connector, client_id, session_id, channel_id, service=None):
         self.connector = connector
         self.client_id = client_id
         self.channel_id = None
         self.session_id = session_id
         self.is_alive = True
-        self.service = self.connector.factory.service
+        self.service = service or self.connector.factory.service
         self.logoutTaskCall = None
+        self.stored_messages = None
+        self.buffered = None
+        self.repr_hash = None
 
-    def markDead(self):
+    def markDead(self, unsent=()):
+        """unsent are frames the lost connection hadn't written, they are stored before the messages held back"""
         self.is_alive = False
         self.connector = None
-        self.stored_messages = []
-        log.msg('Marked dead client_id=%s, channel_id=%s' % (str(self.client_id), str(self.channel_id)))
+        self.repr_hash = None
+        self.stored_messages = self._newStore()
+        self.storeFrames(unsent)
+        logger.info('Marked dead client_id=%s, channel_id=%s', self.client_id, self.channel_id)
+        if self.buffered:
+            self.flushBuffered()
         if self.channel_id != None:
             self.service.disconnectedRequest(self, [self.channel_id])
-        self.logoutTaskCall = reactor.callLater(self.service.config['timeout'], self.service.logoutRequest, self)
+        self.logoutTaskCall = self.service.logoutTimers.schedule(self.service.config['timeout'], self.service.logoutRequest, self)
+            
+    def markRestored(self, channel_id, frames, timeout):
+        """Brought back from a snapshot after a restart. Dead until it reconnects, logged out after timeout"""
+        self.is_alive = False
+        self.connector = None
+        self.channel_id = channel_id
+        self.stored_messages = self._newStore()
+        self.storeFrames(frames)
+        self.logoutTaskCall = self.service.logoutTimers.schedule(timeout, self.service.logoutRequest, self)
+        
+    def _newStore(self):
+        config = self.service.config
+        return MessageStore(config.get('stored_messages_limit', MessageStore.MAX_MESSAGES), 
+            config.get('stored_messages_bytes', MessageStore.MAX_BYTES))
             
     def markAlive(self, connector):
         """Called when the disconnected client subscribes again"""
         self.connector = connector
         self.is_alive = True
+        self.repr_hash = None
         self.sendStoredMessages()
         
         if self.logoutTaskCall:
@@ -48,31 +87,82 @@ class JuggernautClient():
             
     def sendMessage(self, body):
         """Send message to connection, store it if client is dead"""
+        self.deliverMessage(Message(body))
         
-        msg = Message(body)
+    def deliverMessage(self, msg):
+        """Send already built message to connection, store it if client is dead. 
+        The same message instance may be shared by all recipients of a broadcast. Returns True if it was sent"""
+        if self.buffered is not None:
+            self.buffered.append((self.service.history.position(), msg))
+            return True
         if self.is_alive:
-            log.msg("Sending message to client_id=%s body=%s" % (str(self.client_id), str(msg)))
             self.writeMessageToConnection(msg)
-        else:
-            self.stored_messages.append(msg)
+            return True
+        self.stored_messages.append(msg.frame())
+        return False
             
     def writeMessageToConnection(self, msg):
-        """Write message body to a connection transport"""
-        self.connector.transport.write(str(msg) + JuggernautProtocol.CR)
+        """Write message frame to a connection transport"""
+        self.connector.writeMessage(msg)
+        
+    def bufferMessages(self):
+        """Hold messages back until flushBuffered is called, while the subscribe webhook is in flight"""
+        self.buffered = []
+        
+    def flushBuffered(self, entries=[]):
+        """Send messages held back together with entries, (id, frame, history position) in the order they were 
+        recorded, in a single write. Everything goes out in the order it arrived and every id only once, 
+        ids striped across workers or nodes don't tell the order"""
+        buffered, self.buffered = self.buffered or [], None
+        frame = self.is_alive and self.connector.messageFrame or Message.frame
+        merged = []
+        held = 0
+        for entry in entries:
+            # messages held back before the entry was recorded go first
+            while held < len(buffered) and buffered[held][0] < entry[2]:
+                msg = buffered[held][1]
+                merged.append((msg.id, frame(msg)))
+                held += 1
+            merged.append(entry)
+        merged.extend((msg.id, frame(msg)) for position, msg in buffered[held:])
+        seen = set()
+        frames = []
+        for entry in merged:
+            if entry[0] not in seen:
+                seen.add(entry[0])
+                frames.append(entry[1])
+        if not frames:
+            return
+        if self.is_alive:
+            self.connector.writeFrames(''.join(frames))
+        else:
+            self.storeFrames(frames)
+        
+    def storeFrames(self, frames):
+        """Keep frames which were queued for the connection when it was lost"""
+        for frame in frames:
+            self.stored_messages.append(frame)
         
     def sendStoredMessages(self):
-        """Send stored messages after the client has been reconnected"""
-        for message in self.stored_messages:
-            self.writeMessageToConnection(message)
-        self.stored_messages = None
+        """Send stored messages after the client has been reconnected, all of them in a single write"""
+        store, self.stored_messages = self.stored_messages, None
+        self.service.metrics.counter('stored_messages_sent').inc(len(store))
+        self.service.metrics.counter('stored_messages_dropped').inc(store.dropped)
+        if store.dropped:
+            logger.warning("Dropped %d stored messages (%d bytes) for client_id=%s", store.dropped, store.dropped_bytes, self.client_id)
+        if len(store):
+            self.connector.writeFrames(store.flush())
         
     def toReprHash(self):
-        '''Return a hash with describing the client connection. Yes format here doesn't have much of a sense, but it is left like this for the sake of being compatibile with original implementation'''
-        return {
-            'client_id': self.client_id, 
-            'num_connections': self.numConnections(),
-            'session_id': self.session_id
-        }
+        '''Return a hash with describing the client connection. Yes format here doesn't have much of a sense, but it is left like this for the sake of being compatibile with original implementation.
+        The hash is built once and shared until the client is marked dead or alive, don't modify it'''
+        if self.repr_hash is None:
+            self.repr_hash = {
+                'client_id': self.client_id, 
+                'num_connections': self.numConnections(),
+                'session_id': self.session_id
+            }
+        return self.repr_hash
         
     def numConnections(self):
         if self.is_alive:
@@ -82,105 +172,367 @@ class JuggernautClient():
 class IJuggernautProtocol(Interface):
     pass
 
-class Message:
+class Message(object):
+    __slots__ = ('body', 'id', 'encoded', 'encoded_frame', 'encoded_websocket_frame', 
+        'encoded_compressed', 'encoded_compressed_frame', 'encoded_compressed_websocket_frame')
     current_id = 0
+    id_step = 1
     
-    def __init__(self, body):
+    def __init__(self, body, id=None):
         self.body = body
-        self.id = Message.current_id 
-        Message.current_id += 1
+        if id is None:
+            self.id = Message.current_id 
+            Message.current_id += Message.id_step
+        else:
+            self.id = id
+            Message.observe(id)
+        self.encoded = None
+        self.encoded_frame = None
+        self.encoded_websocket_frame = None
+        self.encoded_compressed = None
+        self.encoded_compressed_frame = None
+        self.encoded_compressed_websocket_frame = None
         
     def __str__(self):
-        return json.dumps({'id': self.id, 'body': self.body})
+        if self.encoded is None:
+            self.encoded = codec.dumps({'id': self.id, 'body': self.body})
+        return self.encoded
+        
+    def frame(self):
+        """Return message encoded and terminated with the NUL byte. It is computed only once, 
+        so broadcasting a message to many clients costs a single serialization"""
+        if self.encoded_frame is None:
+            self.encoded_frame = str(self) + JuggernautProtocol.CR
+        return self.encoded_frame
+        
+    def websocketFrame(self):
+        """Return message encoded as a WebSocket text frame, computed only once as well"""
+        if self.encoded_websocket_frame is None:
+            self.encoded_websocket_frame = websocket.encodeFrame(str(self))
+        return self.encoded_websocket_frame
+        
+    def compressed(self):
+        """Return message deflated, base64 encoded so it holds no NUL bytes and wrapped as {"id": id, "deflate": data}.
+        It is computed once for all clients which asked for compression. If it isn't shorter, the plain message"""
+        if self.encoded_compressed is None:
+            plain = str(self)
+            envelope = codec.dumps({'id': self.id, 'deflate': base64.b64encode(zlib.compress(plain))})
+            self.encoded_compressed = len(envelope) < len(plain) and envelope or plain
+        return self.encoded_compressed
+        
+    def compressedFrame(self):
+        if self.encoded_compressed_frame is None:
+            self.encoded_compressed_frame = self.compressed() + JuggernautProtocol.CR
+        return self.encoded_compressed_frame
+        
+    def compressedWebsocketFrame(self):
+        if self.encoded_compressed_websocket_frame is None:
+            self.encoded_compressed_websocket_frame = websocket.encodeFrame(self.compressed())
+        return self.encoded_compressed_websocket_frame
+        
+    @classmethod
+    def observe(cls, id):
+        """Make sure ids given out from now on are greater than id, which was assigned by another worker. 
+        With many workers every worker hands out ids from its own residue class modulo id_step. Ids stay unique, 
+        but they don't tell the order of arrival: a broadcast relayed late may carry a lower id than ones given out here"""
+        if id >= cls.current_id:
+            cls.current_id += ((id - cls.current_id) // cls.id_step + 1) * cls.id_step
 
 components.registerAdapter(JuggernautClient, IJuggernautClient, IJuggernautProtocol)
       
 class JuggernautProtocol(protocol.Protocol):
-    implements(IJuggernautProtocol)
+    """Also the push producer of its own transport, so it knows when the client stops keeping up. 
+    While paused, messages wait in a WriteQueue bounded by write_buffer_limit"""
+    implements(IJuggernautProtocol, IPushProducer)
     
     CR = "\0"
-    CR_END = re.compile(CR + '$')
+    MAX_FRAME_SIZE = 1024 * 1024
+    WRITE_BUFFER_LIMIT = 1024 * 1024
     
-    def __init__(self):
-        self.buffer = ""
-        self.client = None
+    # Protocol is an old-style class, so __slots__ wouldn't work. Defaults live in the class instead and 
+    # an idle connection's __dict__ holds only what Twisted sets and its client
+    decoder = None
+    client = None
+    paused = False
+    queue = None
+    pending = None
+    evicted = False
+    authenticated = False
+    compression = False
         
-    def dataReceived(self, data):
-        self.buffer += data
-        split = self.buffer.split(self.CR)
+    def connectionMade(self):
+        self.transport.registerProducer(self, True)
         
-        if not self.CR_END.match(self.buffer):
-            self.buffer = split.pop()
-            
-        for message in split:
+    def dataReceived(self, data):
+        if self.decoder is None:
+            config = self.factory.service.config
+            self.decoder = NulFrameDecoder(config.get('max_frame_size', self.MAX_FRAME_SIZE), 
+                config.get('oversized_frame_policy', NulFrameDecoder.DISCONNECT))
+        messages = self.decoder.feed(data)
+        self.factory.service.metrics.counter('frames_received').inc(len(messages))
+        for message in messages:
             self.processMessage(message)
+        # frames received before the oversized one are handled first
+        if self.decoder.oversized is not None:
+            logger.error("Closing connection: %s", self.decoder.oversized)
+            self.transport.loseConnection()
         
     def processMessage(self, message):
-        log.msg("Processing message: %s" % message)
+        logger.debug("Processing message: %s", message)
+        # Flash asks for the policy before every connection, so it is recognized without parsing JSON
+        if message.startswith(POLICY_FILE_REQUEST):
+            self.sendPolicyFile()
+            return
         try:
-            request = json.loads(message)
+            request = codec.loads(message)
             self._checkExists(request, 'command', unicode)
             method = getattr(self, request['command'] + "Command")
             method(request)
         except Exception as e:
-            if message == "<policy-file-request/>":
-                self.sendPolicyFile()
-            else:
-                log.err("Processing message failed with exception: %s" % str(e))
-                self.transport.loseConnection()
+            logger.error("Processing message failed with exception: %s", e)
+            self.transport.loseConnection()
         
     def subscribeCommand(self, request):
-        log.msg("SUBSCRIBE: %s" % str(request))
+        logger.debug("SUBSCRIBE: %s", request)
+        self.factory.service.metrics.counter('subscribes').inc()
         
         self._checkExists(request, 'channels', list)
         self._checkExists(request, 'client_id', int)
         self._checkExists(request, 'session_id', int)
         if len(request['channels']) != 1:
             raise ValueError("You can pass only one channel to subscribe to!")
+        last_msg_id = request.get('last_msg_id')
+        if last_msg_id is not None:
+            self._checkExists(request, 'last_msg_id', int)
+        # clients not knowing compression never send it, unknown methods leave the messages plain
+        self.compression = request.get('compression') == 'deflate'
+        # a client reconnecting before its timeout gets its stored messages instead of the channel history
+        if request['client_id'] in self.factory.service.clients:
+            last_msg_id = None
+        restored = self.factory.service.restored.pop(request['client_id'], None)
     
         self.client = self.factory.service.findOrCreateClient(self, request['client_id'], request['session_id'], request['channels'][0])
-        self.factory.service.subscribeRequest(self.client, [request['channels'][0]])
+        if restored == (request['session_id'], request['channels'][0]):
+            # the Rails app let it in before the restart, it isn't asked again
+            self.factory.service.metrics.counter('subscribes_restored').inc()
+            return
+        self.factory.service.subscribeRequest(self.client, [request['channels'][0]], last_msg_id)
             
             
     def broadcastCommand(self, request):
-        log.msg("BROADCAST: %s" % str(request))
+        logger.debug("BROADCAST: %s", request)
+        self.factory.service.metrics.counter('broadcasts_received').inc()
         
         self._checkExists(request, 'type', unicode)
-        self._checkExists(request, 'body', [unicode, dict])
+        if request['type'] == 'batch':
+            self._checkExists(request, 'broadcasts', list)
+            for entry in request['broadcasts']:
+                self._checkExists(entry, 'body', [unicode, dict])
+                if not (entry.has_key('channels') or entry.has_key('client_ids')):
+                    raise ValueError("Batch entry %s has neither channels nor client_ids" % str(entry))
+        else:
+            self._checkExists(request, 'body', [unicode, dict])
                 
-        self.factory.service.authenticateBroadcastOrQuery(self, request)
-        
-        method = getattr(self.factory.service, 'broadcast_' + request['type'])
-        method(request)
+        self._authenticate(request)
+        self.factory.service.broadcast(request)
         
     def queryCommand(self, request):
-        log.msg("QUERY: %s" % str(request))
+        logger.debug("QUERY: %s", request)
+        self.factory.service.metrics.counter('queries').inc()
         
         self._checkExists(request, 'type', unicode)
         
-        self.factory.service.authenticateBroadcastOrQuery(self, request)
-        
-        method = getattr(self.factory.service, 'query_' + request['type'])
-        method(request, self)
+        self._authenticate(request)
+        self.factory.service.query(request, self)
         
     def connectionLost(self, reason):
         if self.client:
-            self.client.markDead()
+            # oldest first: frames waiting for the flush, then the write queue, then messages held back
+            unsent = []
+            if self.pending:
+                unsent.extend(isinstance(item, Message) and item.frame() or item for item in self.pending)
+                self.pending = None
+            if self.queue is not None and len(self.queue):
+                unsent.extend(self.queue.frames)
+            self.client.markDead(unsent)
+            
+    def pauseProducing(self):
+        self.paused = True
+        
+    def resumeProducing(self):
+        self.paused = False
+        if self.queue is not None and len(self.queue) and not self.evicted:
+            self.writeFrames(self.queue.flush())
+            
+    def stopProducing(self):
+        pass
+            
+    def writeMessage(self, msg):
+        if self.paused:
+            # queued frames stay plain, when the connection is lost they are stored for the next one
+            self._enqueue(msg.frame())
+        elif self.pending is not None:
+            self.pending.append(msg)
+        elif self.factory.service.flushScheduler is not None:
+            self.pending = [msg]
+            self.factory.service.flushScheduler.add(self)
+        else:
+            self.transport.write(self.encodeMessage(msg))
+        
+    def writeFrames(self, data):
+        """Write NUL terminated frames joined together"""
+        if self.paused:
+            self._enqueue(data)
+        elif self.pending is not None:
+            self.pending.append(data)
+        elif self.factory.service.flushScheduler is not None:
+            self.pending = [data]
+            self.factory.service.flushScheduler.add(self)
+        else:
+            self.transport.write(self.encodeFrames(data))
+            
+    def flushPending(self):
+        """Write messages and frames collected with write_coalesce_delay, all of them in a single write"""
+        pending, self.pending = self.pending, None
+        if not pending:
+            return
+        if self.paused:
+            for item in pending:
+                self._enqueue(isinstance(item, Message) and item.frame() or item)
+        else:
+            self.transport.writeSequence([isinstance(item, Message) and self.encodeMessage(item) or self.encodeFrames(item) 
+                for item in pending])
+            
+    def messageFrame(self, msg):
+        """NUL terminated frame of the message, deflated if the client asked for it and the message is long enough"""
+        if self.compression and len(msg.frame()) > self.factory.service.compression_threshold:
+            return msg.compressedFrame()
+        return msg.frame()
+        
+    def encodeMessage(self, msg):
+        return self.messageFrame(msg)
+        
+    def encodeFrames(self, data):
+        return data
+        
+    def bufferedBytes(self):
+        """Bytes written to the transport but not sent yet, and bytes waiting in the queue"""
+        transport = len(getattr(self.transport, 'dataBuffer', '')) - getattr(self.transport, 'offset', 0) + \
+            getattr(self.transport, '_tempDataLen', 0)
+        return transport, self.queue is not None and self.queue.bytes or 0
+        
+    def _enqueue(self, data):
+        if self.queue is None:
+            config = self.factory.service.config
+            self.queue = WriteQueue(config.get('write_buffer_limit', self.WRITE_BUFFER_LIMIT), 
+                config.get('slow_consumer_policy', WriteQueue.DROP_OLDEST))
+        if not self.queue.append(data) and not self.evicted:
+            logger.warning("Disconnecting slow client_id=%s, %d bytes queued", self.client and self.client.client_id, self.queue.bytes)
+            self.evicted = True
+            self.factory.service.metrics.counter('slow_clients_disconnected').inc()
+            self.transport.abortConnection()
+        
+    def publishResponse(self, msg):
+        self.writeFrames(codec.dumps(msg) + self.CR)
 
+    def _authenticate(self, request):
+        """The address of a connection doesn't change, so it is checked only for its first broadcast or query"""
+        if not self.authenticated:
+            self.factory.service.authenticateBroadcastOrQuery(self, request)
+            self.authenticated = True
+            
     def _checkExists(self, request, key, classes):
         if not isinstance(classes, list):
             classes = [ classes ]
+        if unicode in classes:
+            classes = classes + [ str ] # some JSON backends decode ASCII strings to str
         if not classes.__contains__(request[key].__class__):
             raise ValueError("Key %s should be of type of %s, but was %s instead" % (key, str(classes), request[key].__class__.__name__))
 
     def sendPolicyFile(self):
-        log.msg('Sending policy file')
-        self.transport.write('''
-            <cross-domain-policy>
-                <allow-access-from domain="*" to-ports="%d" />
-            </cross-domain-policy>''' % self.factory.service.config['port'])
+        logger.debug('Sending policy file')
+        self.factory.service.metrics.counter('policy_files_sent').inc()
+        self.transport.write(self.factory.service.policy_file)
         self.transport.loseConnection()
 
+class JuggernautWebSocketProtocol(JuggernautProtocol):
+    """The same protocol served over WebSocket. Every text message sent by the client carries a single command, 
+    messages are sent to the client as text frames with the same JSON flash clients get"""
+    
+    handshake = ""
+    pingTaskCall = None
+        
+    def dataReceived(self, data):
+        if self.handshake is not None:
+            data = self._processHandshake(data)
+            if not data:
+                return
+        
+        if self.decoder is None:
+            self.decoder = websocket.WebSocketFrameDecoder(self.factory.service.config.get('max_frame_size', self.MAX_FRAME_SIZE))
+        try:
+            messages = self.decoder.feed(data)
+        except FrameTooLarge as e:
+            logger.error("Closing connection: %s", e)
+            return self.close(websocket.CLOSE_TOO_BIG)
+        except websocket.WebSocketError as e:
+            logger.error("Closing connection: %s", e)
+            return self.close(websocket.CLOSE_PROTOCOL_ERROR)
+            
+        self.factory.service.metrics.counter('frames_received').inc(len(messages))
+        for opcode, payload in messages:
+            if opcode in (websocket.TEXT, websocket.BINARY):
+                self.processMessage(payload)
+            elif opcode == websocket.PING:
+                self.transport.write(websocket.encodeFrame(payload, websocket.PONG))
+            elif opcode == websocket.CLOSE:
+                return self.close(websocket.CLOSE_NORMAL)
+                
+    def _processHandshake(self, data):
+        self.handshake += data
+        try:
+            handshake = websocket.parseHandshake(self.handshake)
+        except websocket.WebSocketError as e:
+            logger.error("WebSocket handshake failed: %s", e)
+            self.transport.write("HTTP/1.1 400 Bad Request\r\n\r\n")
+            self.transport.loseConnection()
+            return None
+        if handshake is None:
+            return None
+        
+        key, rest = handshake
+        self.handshake = None
+        self.transport.write(websocket.handshakeResponse(key))
+        interval = self.factory.service.config.get('websocket_ping_interval')
+        if interval:
+            self.pingTaskCall = task.LoopingCall(self.transport.write, websocket.encodeFrame('', websocket.PING))
+            self.pingTaskCall.start(interval, now=False)
+        return rest
+        
+    def close(self, code):
+        self.transport.write(websocket.closeFrame(code))
+        self.transport.loseConnection()
+        
+    def connectionLost(self, reason):
+        if self.pingTaskCall:
+            self.pingTaskCall.stop()
+            self.pingTaskCall = None
+        JuggernautProtocol.connectionLost(self, reason)
+        
+    def encodeMessage(self, msg):
+        if self.compression and len(msg.frame()) > self.factory.service.compression_threshold:
+            return msg.compressedWebsocketFrame()
+        return msg.websocketFrame()
+        
+    def encodeFrames(self, data):
+        frames = data.split(self.CR)
+        frames.pop()
+        return ''.join(map(websocket.encodeFrame, frames))
+        
+    def sendPolicyFile(self):
+        """Flash policy requests make no sense over WebSocket"""
+        self.close(websocket.CLOSE_PROTOCOL_ERROR)
+
 class IJuggernautFactory(Interface):
     pass
     
@@ -192,19 +544,176 @@ class JuggernautFactoryFromService(protocol.ServerFactory):
     def __init__(self, service):
         self.service = service
         
+    def buildProtocol(self, addr):
+        """Refuse addresses over connection_rate_limit before anything is allocated for them"""
+        admission = self.service.admission
+        if admission is not None and not admission.allow(addr.host):
+            logger.debug("Refusing connection from %s, over the connection rate limit", addr.host)
+            self.service.metrics.counter('connections_refused').inc()
+            return None
+        return protocol.ServerFactory.buildProtocol(self, addr)
+        
+class IJuggernautWebSocketFactory(Interface):
+    pass
+    
+class JuggernautWebSocketFactoryFromService(JuggernautFactoryFromService):
+    implements(IJuggernautWebSocketFactory)
+    
+    protocol = JuggernautWebSocketProtocol
+        
+class ResponseCollector:
+    """Stands in for the connector when a query response is needed as a value, not written to a connection"""
+    def __init__(self):
+        self.response = None
+        
+    def publishResponse(self, msg):
+        self.response = msg
+        
 class IJuggernautService(Interface):
     pass
         
 components.registerAdapter(JuggernautFactoryFromService, IJuggernautService, IJuggernautFactory)
+components.registerAdapter(JuggernautWebSocketFactoryFromService, IJuggernautService, IJuggernautWebSocketFactory)
         
 class JuggernautService(service.Service):
     implements(IJuggernautService)
     
+    # How responses of queries answered by many workers are merged. Queries not listed are answered locally
+    RELAYED_QUERIES = {
+        'show_clients': 'concat',
+        'show_clients_for_channels': 'concat',
+        'show_buffers': 'concat',
+        'show_channel_counts': 'sum',
+        'stats': 'sum',
+        'show_client': 'first',
+        'show_channels_for_client': 'first',
+        'remove_channels_from_client': 'none'
+    }
+    # key of the recipients in every type of broadcast
+    BROADCAST_TARGETS = {
+        'to_channels': 'channels',
+        'to_clients': 'client_ids'
+    }
+    # seconds clients taken back from a snapshot have to reconnect
+    SNAPSHOT_GRACE = 60
+    # bytes, longer messages are compressed for clients subscribed with compression
+    COMPRESSION_THRESHOLD = 1024
+    
     def __init__(self, options):
+        logger.configure(options.get('log_level', 'info'), options.get('log_sampling', 1.0))
+        codec.use(options.get('json_backend'))
+        self.relay = None
+        self.backplane = None
+        if options.get('cluster_peers'):
+            self.backplane = BACKPLANES[options.get('cluster_backplane', 'tcp')](self, options)
+        self.policy_file = policyFile(options['port'])
+        self.compression_threshold = options.get('compression_threshold', self.COMPRESSION_THRESHOLD)
+        self.admission = None
+        if options.get('connection_rate_limit'):
+            self.admission = ConnectionRateLimiter(options['connection_rate_limit'], 
+                options.get('connection_rate_burst', ConnectionRateLimiter.BURST), options['allowed_ips'])
+        self.holding = None # clients whose messages are held back until the end of a batch
         self.channels = {}
         self.config = options
         self.clients = {}
+        self.sessions = {} # session_id => list of its clients, usually just one
+        self.restored = {} # client_id => (session_id, channel_id) of clients from the snapshot which haven't reconnected yet
+        self.snapshotTaskCall = None
+        self.webhooks = WebhookClient(options)
+        self.history = HistoryCache(options.get('channel_history_size', HistoryCache.SIZE), 
+            options.get('channel_history_bytes', HistoryCache.MAX_BYTES), 
+            options.get('channel_history_total_bytes', HistoryCache.MAX_TOTAL_BYTES),
+            options.get('channel_history_sizes', {}))
+        self.metrics = Registry()
+        self.metrics.gauge('clients', lambda: len(self.clients))
+        self.metrics.gauge('clients_connected', lambda: len(filter(lambda x: x.is_alive, self.clients.values())))
+        self.metrics.gauge('channels', lambda: len(self.channels))
+        self.metrics.gauge('history_channels', lambda: len(self.history))
+        self.metrics.gauge('history_bytes', lambda: self.history.bytes)
+        for url, name in [('subscription_url', 'subscribe'), ('logout_connection_url', 'disconnected'), ('logout_url', 'logged_out')]:
+            self.webhooks.latency[options[url]] = self.metrics.histogram('webhook_%s_seconds' % name)
+        self.logoutTimers = TimerWheel(options.get('timer_resolution', 0.1))
+        self.flushScheduler = None
+        if options.get('write_coalesce_delay') is not None:
+            self.flushScheduler = FlushScheduler(options['write_coalesce_delay'])
+        self.disconnectedBatch = None
+        self.logoutBatch = None
+        if options.get('webhook_batch_window') is not None:
+            window, size = options['webhook_batch_window'], options.get('webhook_batch_size', 100)
+            self.disconnectedBatch = WebhookBatcher(self.webhooks, options['logout_connection_url'], self, window, size)
+            self.logoutBatch = WebhookBatcher(self.webhooks, options['logout_url'], self, window, size)
+        self.subscribeBatch = None
+        if options.get('subscribe_batch_window') is not None:
+            self.subscribeBatch = SubscribeBatcher(self.webhooks, options['subscription_url'], self, 
+                options['subscribe_batch_window'], options.get('subscribe_batch_size', 100))
+        
+    def startService(self):
+        service.Service.startService(self)
+        if self.config.get('snapshot_path'):
+            self.restoreSnapshot()
+            if self.config.get('snapshot_interval'):
+                self.snapshotTaskCall = task.LoopingCall(self.saveSnapshot)
+                self.snapshotTaskCall.start(self.config['snapshot_interval'], now=False)
+        if self.backplane:
+            self.backplane.start()
+        
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.snapshotTaskCall:
+            self.snapshotTaskCall.stop()
+            self.snapshotTaskCall = None
+        if self.config.get('snapshot_path'):
+            self.saveSnapshot()
+        self.logoutTimers.stop()
+        if self.flushScheduler:
+            self.flushScheduler.flush()
+        for batch in filter(None, [self.disconnectedBatch, self.logoutBatch, self.subscribeBatch]):
+            batch.flush()
+        if self.backplane:
+            return defer.gatherResults([defer.maybeDeferred(self.backplane.stop), self.webhooks.close()])
+        return self.webhooks.close()
     
+    def saveSnapshot(self):
+        """Save the clients already in a channel together with their stored messages, and the message id counter"""
+        clients = []
+        for client in self.clients.values():
+            if client.channel_id is None:
+                continue
+            frames = client.stored_messages and list(client.stored_messages.frames) or []
+            clients.append([client.client_id, client.session_id, client.channel_id, frames])
+        try:
+            snapshot.save(self.config['snapshot_path'], {'current_id': Message.current_id, 'clients': clients})
+        except (IOError, OSError) as e:
+            logger.error("Saving snapshot failed: %s", e)
+            return
+        logger.info("Saved snapshot of %d clients to %s", len(clients), self.config['snapshot_path'])
+        
+    def restoreSnapshot(self):
+        """Take back the clients of the last snapshot as disconnected. Those subscribing again within 
+        snapshot_grace seconds, with the same session and channel, skip the subscribe webhook"""
+        path = self.config['snapshot_path']
+        try:
+            state = snapshot.load(path)
+            if state is None:
+                return
+            # a crash later on mustn't bring the same clients back again
+            os.remove(path)
+        except (IOError, OSError, ValueError) as e:
+            logger.error("Restoring snapshot failed: %s", e)
+            return
+        Message.observe(state['current_id'] - 1)
+        grace = self.config.get('snapshot_grace', self.SNAPSHOT_GRACE)
+        for client_id, session_id, channel_id, frames in state['clients']:
+            if client_id in self.clients:
+                continue
+            client = JuggernautClient(None, client_id, session_id, channel_id, self)
+            self.clients[client_id] = client
+            self.sessions.setdefault(session_id, []).append(client)
+            self.addToChannel(client, channel_id)
+            client.markRestored(channel_id, [frame.encode('utf-8') for frame in frames], grace)
+            self.restored[client_id] = (session_id, channel_id)
+        logger.info("Restored %d clients from %s", len(state['clients']), path)
+        
     def findOrCreateClient(self, connector, client_id, session_id, channel_id):
         try: 
             found_client = self.clients[client_id]  # TODO: Make it somehow secure. Now connection can be kidnappned
@@ -215,50 +724,107 @@ class JuggernautService(service.Service):
         except KeyError:
             new_client = JuggernautClient(connector, client_id, session_id, channel_id)
             self.clients[client_id] = new_client
+            self.sessions.setdefault(session_id, []).append(new_client)
             return new_client
     
-    def subscribeRequest(self, client, channels):
+    def subscribeRequest(self, client, channels, last_msg_id=None):
+        """Ask the Rails app whether the client may subscribe. If it may, the client gets in one write: 
+        messages sent to it while the webhook was in flight, messages the channel got meanwhile (or after 
+        last_msg_id if given) from the channel history and messages rendered by the subscribe action"""
         content_helper = RequestParamsHelper(client, channels, self)
-        request_task = web_client.getPage(self.config['subscription_url'], method="POST", postdata=content_helper.subscribeParams()) 
-        
         channel_id = channels[0]
-        def appendClientToChannel(*a):
-            try:
-                self.channels[channel_id].append(client)
-            except KeyError:
-                self.channels[channel_id] = [ client ]
-            client.channel_id = channel_id
+        # the history position, not the id counter, tells what the channel got meanwhile: relayed
+        # broadcasts may come with ids lower than the ones given out here
+        position = None
+        if last_msg_id is None and client not in self.clientsInChannel(channel_id):
+            position = self.history.position()
+        client.bufferMessages()
+        if self.subscribeBatch:
+            request_task = self.subscribeBatch.add(client, channels)
+        else:
+            request_task = self.webhooks.post(self.config['subscription_url'], content_helper.subscribeParams())
+        
+        def appendClientToChannel(body):
+            entries = []
+            if last_msg_id is not None:
+                entries.extend(self.history.entriesSince(channel_id, last_msg_id))
+            elif position is not None:
+                entries.extend(self.history.entriesAfter(channel_id, position))
+            rendered = self.history.position() + 1 # after everything held back
+            entries.extend((msg.id, msg.frame(), rendered) for msg in self._subscribeMessages(body))
+            client.flushBuffered(entries)
+            self.addToChannel(client, channel_id)
             
         def subscribeFail(err):
-            log.err("Sending request failed %s" % str(err))
+            logger.error("Sending request failed %s", err)
+            client.flushBuffered()
             client.connector.transport.loseConnection()
         request_task.addCallbacks(appendClientToChannel, subscribeFail)
         
         return request_task
         
+    def addToChannel(self, client, channel_id):
+        try:
+            self.channels[channel_id].add(client)
+        except KeyError:
+            self.channels[channel_id] = ClientSet([ client ])
+            if self.backplane:
+                self.backplane.interestChanged(channel_id, True)
+        client.channel_id = channel_id
+        
+    def _subscribeMessages(self, body):
+        '''Messages for the new client rendered by the subscribe action as a JSON list of message bodies'''
+        if not body or not body.strip():
+            return []
+        try:
+            bodies = codec.loads(body)
+        except ValueError:
+            logger.warning("Subscribe response is not JSON: %s", body)
+            return []
+        if not isinstance(bodies, list):
+            logger.warning("Subscribe response is not a list of messages: %s", body)
+            return []
+        return map(Message, bodies)
+        
     def disconnectedRequest(self, client, channels):
+        if self.disconnectedBatch:
+            self.disconnectedBatch.add(client, [client.channel_id])
+            return
         content_helper = RequestParamsHelper(client, [client.channel_id], self)
-        web_client.getPage(self.config['logout_connection_url'], method="POST", postdata=content_helper.disconnectedParams())
+        self.webhooks.post(self.config['logout_connection_url'], content_helper.disconnectedParams()).addErrback(self._webhookFailed)
     
     def logoutRequest(self, client):
-        content_helper = RequestParamsHelper(client, [client.channel_id], self)
-        web_client.getPage(self.config['logout_url'], method="POST", postdata=content_helper.disconnectedParams())
+        if self.logoutBatch:
+            self.logoutBatch.add(client, [client.channel_id])
+        else:
+            content_helper = RequestParamsHelper(client, [client.channel_id], self)
+            self.webhooks.post(self.config['logout_url'], content_helper.disconnectedParams()).addErrback(self._webhookFailed)
         self.removeClient(client)
         
     def removeClient(self, client):
         try:
-            self.channels[client.channel_id].remove(client)
-            if len(self.channels[client.channel_id]) == 0:
-                log.msg("Removing channel %s" % str(client.channel_id))
-                del(self.channels[client.channel_id])
+            members = self.channels[client.channel_id]
+            if client in members:
+                members.remove(client)
+                if len(members) == 0:
+                    logger.info("Removing channel %s", client.channel_id)
+                    del(self.channels[client.channel_id])
+                    if self.backplane:
+                        self.backplane.interestChanged(client.channel_id, False)
+            else:
+                logger.error("Removing client from channel failed! Client not found in channel %s", client.channel_id)
         except KeyError:
-            log.err("Removing client from channel failed! Channel %s not found!" % str(client.channel_id))
-        except ValueError:
-            log.err("Removing client from channel failed! Client not found in channel %s" % str(client.channel_id))
+            logger.error("Removing client from channel failed! Channel %s not found!", client.channel_id)
         try:
             del(self.clients[client.client_id])
         except KeyError:
-            log.err("Removing client failed. Client with id %s not found!" % str(client.client_id))
+            logger.error("Removing client failed. Client with id %s not found!", client.client_id)
+        self.restored.pop(client.client_id, None)
+        session = self.sessions.get(client.session_id)
+        if session is not None and client in session:
+            session.remove(client)
+            if len(session) == 0:
+                del(self.sessions[client.session_id])
         
     def clientsInChannel(self, channel):
         try:
@@ -273,20 +839,102 @@ class JuggernautService(service.Service):
         else:
             raise Exception('Dissalowed request %s from %s' % (str(request), str(ip)))
         
-    def broadcast_to_channels(self, request):
+    def broadcast(self, request, msg_id=None):
+        """Deliver broadcast to the local clients. Broadcasts coming from the publisher (without msg_id) 
+        are also passed on to the other workers and nodes, together with the id they got here"""
+        if request['type'] == 'batch':
+            return self.broadcast_batch(request)
+        # checked before the broadcast is passed on, the other workers and nodes mustn't get a broken one
+        self._checkBroadcast(request)
+        msg = Message(request['body'], msg_id)
+        if self.relay and msg_id is None:
+            self.relay.broadcast(request, msg.id)
+        if self.backplane and msg_id is None:
+            self.backplane.publish(request, msg.id)
+        method = getattr(self, 'broadcast_' + request['type'])
+        method(request, msg)
+        
+    def _checkBroadcast(self, request):
+        target = self.BROADCAST_TARGETS.get(request['type'])
+        if target is None:
+            raise ValueError("Unknown broadcast type %s" % request['type'])
+        if not isinstance(request.get(target), list):
+            raise ValueError("Broadcast of type %s needs a list of %s" % (request['type'], target))
+        
+    def broadcast_batch(self, request):
+        """Many broadcasts in one request, each entry has a body and either channels or client_ids. 
+        A client receiving more than one of them gets them all in a single write"""
+        entries = [dict(entry, type=entry.has_key('channels') and 'to_channels' or 'to_clients') for entry in request['broadcasts']]
+        map(self._checkBroadcast, entries)
+        self.holding = []
+        try:
+            for entry in entries:
+                self.broadcast(entry)
+        finally:
+            holding, self.holding = self.holding, None
+            for client in holding:
+                client.flushBuffered()
+        
+    def broadcast_to_channels(self, request, msg=None):
+        msg = msg or Message(request['body'])
         ids_to_send = []
         for channel in request['channels']:
             map(lambda x: ids_to_send.append(x.client_id), self.clientsInChannel(channel))
+            self.history.record(channel, msg.id, msg.frame())
         
-        request['client_ids'] = ids_to_send
-        self.broadcast_to_clients(request)
+        request = dict(request, client_ids=ids_to_send)
+        self.broadcast_to_clients(request, msg)
          
-    def broadcast_to_clients(self, request):
+    def broadcast_to_clients(self, request, msg=None):
+        msg = msg or Message(request['body'])
+        sent = stored = deflated = 0
+        holding = self.holding
+        # with many workers or nodes the other recipients are held by the others, missing them here is no error
+        findClient = (self.relay or self.backplane) and self.clients.get or self._findClient
         for client_id in request['client_ids']:
-            client = self._findClient(client_id)
+            client = findClient(client_id)
             if client:
-                client.sendMessage(request['body'])
+                if holding is not None and client.buffered is None and client.is_alive:
+                    client.bufferMessages()
+                    holding.append(client)
+                if client.deliverMessage(msg):
+                    sent += 1
+                    deflated += client.connector.compression
+                else:
+                    stored += 1
+        logger.info("Broadcast id=%d sent to %d clients, stored for %d", msg.id, sent, stored)
+        # counted once per broadcast, nothing is updated per recipient
+        self.metrics.counter('broadcasts').inc()
+        self.metrics.histogram('recipients_per_broadcast', RECIPIENT_BUCKETS).observe(sent + stored)
+        self.metrics.counter('messages_sent').inc(sent)
+        frame_bytes = sent and len(msg.frame())
+        if deflated and frame_bytes > self.compression_threshold:
+            self.metrics.counter('message_bytes_sent').inc((sent - deflated) * frame_bytes + deflated * len(msg.compressedFrame()))
+        else:
+            self.metrics.counter('message_bytes_sent').inc(sent * frame_bytes)
+        self.metrics.counter('messages_stored').inc(stored)
+        logger.debug("Broadcast id=%d body=%s", msg.id, msg)
                 
+    def query(self, request, connector):
+        """Answer the query. If other workers exist, their responses are merged with the local one"""
+        method = getattr(self, 'query_' + request['type'])
+        merge = self.RELAYED_QUERIES.get(request['type'])
+        if self.relay is None or merge is None:
+            return method(request, connector)
+        
+        local = ResponseCollector()
+        method(request, local)
+        
+        def publishMerged(responses):
+            responses = [local.response] + responses
+            if merge == 'concat':
+                self._publishResponse(connector, reduce(lambda x, y: x + (y or []), responses, []))
+            elif merge == 'sum':
+                self._publishResponse(connector, mergeSnapshots(responses))
+            elif merge == 'first':
+                self._publishResponse(connector, reduce(lambda x, y: x if x is not None else y, responses, None))
+        return self.relay.query(request).addCallback(publishMerged)
+        
     def query_remove_channels_from_client(self, request, connector):
         '''Disconnect clients from the given channels'''
         for client_id in request['client_ids']:
@@ -302,12 +950,16 @@ class JuggernautService(service.Service):
         self._publishResponse(connector, resp)
         
     def query_show_clients(self, request, connector):
+        '''All clients, or those in client_ids or in session_ids. Unknown ids are skipped'''
         if request.has_key('client_ids'):
-            clients = map(lambda x: self._findClient(x), request['client_ids'])
-            clients = filter(lambda x: x != None, clients)
+            clients = filter(None, map(self.clients.get, request['client_ids']))
+        elif request.has_key('session_ids'):
+            clients = []
+            for session_id in request['session_ids']:
+                clients.extend(self.sessions.get(session_id, ()))
         else:
             clients = self.clients.values()
-        self._publishResponse(connector, map(lambda x: x.toReprHash(), clients))
+        self._publishResponse(connector, [client.toReprHash() for client in clients])
     
     def query_show_client(self, request, connector):
         client = self._findClient(request['client_id'])
@@ -318,20 +970,72 @@ class JuggernautService(service.Service):
         clients = []
         for channel_id in request['channels']:
             if self.channels.has_key(channel_id):
-                clients = clients + self.channels[channel_id]
-        self._publishResponse(connector, map(lambda x: x.toReprHash(), clients))
+                clients.extend(self.channels[channel_id])
+        self._publishResponse(connector, [client.toReprHash() for client in clients])
+        
+    def query_show_channel_counts(self, request, connector):
+        '''Number of clients in every channel, or in the given channels. Keys are strings, as in JSON'''
+        if request.has_key('channels'):
+            counts = dict((str(channel_id), len(self.clientsInChannel(channel_id))) for channel_id in request['channels'])
+        else:
+            counts = dict((str(channel_id), len(members)) for channel_id, members in self.channels.items())
+        self._publishResponse(connector, counts)
             
+    def query_show_buffers(self, request, connector):
+        '''Bytes buffered for every connected client, or for those in client_ids'''
+        if request.has_key('client_ids'):
+            clients = filter(None, map(self._findClient, request['client_ids']))
+        else:
+            clients = self.clients.values()
+        buffers = []
+        for client in clients:
+            if client.is_alive:
+                transport_bytes, queued_bytes = client.connector.bufferedBytes()
+                queue = client.connector.queue
+                buffers.append({
+                    'client_id': client.client_id,
+                    'transport_bytes': transport_bytes,
+                    'queued_bytes': queued_bytes,
+                    'dropped': queue and queue.dropped or 0,
+                    'paused': client.connector.paused
+                })
+        self._publishResponse(connector, buffers)
+        
+    def query_stats(self, request, connector):
+        '''Snapshot of the metrics, summed over all workers'''
+        self._publishResponse(connector, self.metrics.snapshot())
+        
+    def query_show_webhook_stats(self, request, connector):
+        self._publishResponse(connector, self.webhooks.stats())
+        
     def _publishResponse(self, connector, msg):
-        connector.transport.write(json.dumps(msg) + JuggernautProtocol.CR)
+        connector.publishResponse(msg)
     
+    def _webhookFailed(self, err):
+        logger.error("Sending request failed %s", err)
+        
     def _findClient(self, client_id):
         try:
             return self.clients[client_id]
         except KeyError:
-            log.err('Client with id %s not found!' % client_id)
+            logger.error('Client with id %s not found!', client_id)
             return None
     
 components.registerAdapter(JuggernautService, IJuggernautService, service.IService)
 
 def makeService(options):
+    """With options['workers'] > 1 returns a service running that many worker processes, 
+    each of them running its own JuggernautService"""
+    if options.get('workers', 1) > 1 and options.get('cluster_peers'):
+        raise ValueError("Nodes of a cluster run a single process, set workers to 1")
+    if options.get('workers', 1) > 1:
+        from workers import WorkerPoolService
+        return WorkerPoolService(options)
+    if options.get('cluster_peers'):
+        # every node numbers its messages in its own stripe, the same way the workers do
+        Message.current_id = options.get('cluster_node_id', 0)
+        Message.id_step = len(options['cluster_peers']) + 1
+        # a client may reconnect to any node, so no node can take back clients from a snapshot
+        options = dict(options)
+        options.pop('snapshot_path', None)
     return JuggernautService(options)
\ No newline at end of file
@@ -0,0 +1,42 @@
+'''Cheap checks done before a connection costs anything: Flash policy file requests are answered with
+bytes rendered once, and addresses opening connections too fast are refused before a protocol exists'''
+from twisted.internet import reactor
+from collections import OrderedDict
+
+POLICY_FILE_REQUEST = '<policy-file-request/>'
+
+def policyFile(port):
+    '''Flash socket policy allowing connections to port, terminated with the NUL byte as Flash expects'''
+    return '<cross-domain-policy><allow-access-from domain="*" to-ports="%d" /></cross-domain-policy>\0' % port
+
+class ConnectionRateLimiter:
+    '''Token bucket per IP address: burst connections at once, then rate connections per second.
+    Once MAX_TRACKED addresses are tracked, the one seen least recently is forgotten for each new one'''
+    
+    BURST = 10
+    MAX_TRACKED = 10000
+    
+    def __init__(self, rate, burst, exempt=(), clock=reactor):
+        self.rate = float(rate)
+        self.burst = burst
+        self.exempt = frozenset(exempt)
+        self.clock = clock
+        self.buckets = OrderedDict() # ip => [tokens, time of the last update], least recently seen first
+    
+    def allow(self, ip):
+        if ip in self.exempt:
+            return True
+        now = self.clock.seconds()
+        bucket = self.buckets.pop(ip, None)
+        if bucket is None:
+            if len(self.buckets) >= self.MAX_TRACKED:
+                self.buckets.popitem(last=False)
+            self.buckets[ip] = [self.burst - 1, now]
+            return True
+        self.buckets[ip] = bucket
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
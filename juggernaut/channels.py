@@ -0,0 +1,26 @@
+from collections import OrderedDict
+
+class ClientSet:
+    '''Members of a channel. Adding, removing and checking membership of a client are O(1),
+    iteration yields clients in the order they have been added'''
+    
+    def __init__(self, clients=[]):
+        self.members = OrderedDict()
+        for client in clients:
+            self.add(client)
+            
+    def add(self, client):
+        self.members[client] = True
+        
+    def remove(self, client):
+        '''Remove the client, raises KeyError if it is not a member'''
+        del(self.members[client])
+        
+    def __contains__(self, client):
+        return client in self.members
+        
+    def __len__(self):
+        return len(self.members)
+        
+    def __iter__(self):
+        return iter(self.members)
@@ -0,0 +1,146 @@
+'''Running Juggernaut on many nodes. A broadcast published to any node reaches the clients of all of them,
+it is passed on through the backplane to the other nodes. Every node tells the others which channels
+its clients are in, so broadcasts to channels are only passed on to nodes with clients in them.'''
+from twisted.internet import protocol, defer, reactor
+from twisted.python import log
+from zope.interface import Interface, implements
+
+from workers import RelayProtocol
+from logs import logger
+
+class IBackplane(Interface):
+    def start():
+        """Connect to the other nodes"""
+    
+    def stop():
+        """Disconnect from the other nodes, may return a deferred"""
+    
+    def publish(request, msg_id):
+        """Pass a broadcast published to this node on to the other nodes"""
+    
+    def interestChanged(channel_id, interested):
+        """The first local client joined the channel (interested) or the last one left it"""
+
+class PeerLink(RelayProtocol):
+    '''Link to another node, broadcasts are sent over it. The node answers with the channels it has
+    clients in and keeps them up to date. Until they arrive everything is sent'''
+    
+    def __init__(self):
+        RelayProtocol.__init__(self)
+        self.interest = None
+    
+    def connectionMade(self):
+        self.factory.backplane.peers.append(self)
+    
+    def connectionLost(self, reason):
+        if self in self.factory.backplane.peers:
+            self.factory.backplane.peers.remove(self)
+    
+    def messageReceived(self, msg):
+        if msg['op'] == 'interest':
+            self.interest = set(msg['channels'])
+        elif msg['op'] == 'subscribe':
+            self.interest.add(msg['channel'])
+        elif msg['op'] == 'unsubscribe':
+            self.interest.discard(msg['channel'])
+    
+    def channelsWanted(self, channels):
+        if self.interest is None:
+            return channels
+        return [channel for channel in channels if channel in self.interest]
+
+class NodeLink(RelayProtocol):
+    '''Link from another node, broadcasts arrive over it'''
+    
+    def connectionMade(self):
+        backplane = self.factory.backplane
+        backplane.nodes.append(self)
+        self.sendMessage({'op': 'interest', 'channels': backplane.service.channels.keys()})
+    
+    def connectionLost(self, reason):
+        if self in self.factory.backplane.nodes:
+            self.factory.backplane.nodes.remove(self)
+    
+    def messageReceived(self, msg):
+        if msg['op'] == 'broadcast':
+            # a failing broadcast is logged, losing the link would lose the broadcasts after it
+            try:
+                self.factory.backplane.service.broadcast(msg['request'], msg['id'])
+            except:
+                log.err()
+
+class PeerFactory(protocol.ReconnectingClientFactory):
+    protocol = PeerLink
+    maxDelay = 5
+    
+    def __init__(self, backplane, peer):
+        self.backplane = backplane
+        self.peer = peer
+    
+    def clientConnectionLost(self, connector, reason):
+        if self.continueTrying:
+            logger.warning("Lost connection to node %s: %s", self.peer, reason.getErrorMessage())
+        protocol.ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
+
+class NodeFactory(protocol.ServerFactory):
+    protocol = NodeLink
+    
+    def __init__(self, backplane):
+        self.backplane = backplane
+
+class TCPMeshBackplane:
+    '''Every node listens on cluster_port and connects to all cluster_peers, given as "host:port".
+    Broadcasts sent while a peer is unreachable are lost for its clients'''
+    implements(IBackplane)
+    
+    def __init__(self, service, options):
+        self.service = service
+        self.port = options['cluster_port']
+        self.addresses = options['cluster_peers']
+        self.peers = []
+        self.nodes = []
+        self.listening = None
+        self.factories = []
+    
+    def start(self):
+        self.listening = reactor.listenTCP(self.port, NodeFactory(self))
+        for address in self.addresses:
+            host, port = address.rsplit(':', 1)
+            factory = PeerFactory(self, address)
+            self.factories.append(factory)
+            reactor.connectTCP(host, int(port), factory)
+    
+    def stop(self):
+        for factory in self.factories:
+            factory.stopTrying()
+        for link in self.peers + self.nodes:
+            link.transport.loseConnection()
+        self.factories = []
+        if self.listening:
+            listening, self.listening = self.listening, None
+            return listening.stopListening()
+        return defer.succeed(None)
+    
+    def publish(self, request, msg_id):
+        forwarded = 0
+        for link in self.peers:
+            if request['type'] == 'to_channels':
+                channels = link.channelsWanted(request['channels'])
+                if not channels:
+                    continue
+                link.sendMessage({'op': 'broadcast', 'request': dict(request, channels=channels), 'id': msg_id})
+            else:
+                # nodes don't know where clients are, so broadcasts to clients go everywhere
+                link.sendMessage({'op': 'broadcast', 'request': request, 'id': msg_id})
+            forwarded += 1
+        self.service.metrics.counter('cluster_broadcasts_forwarded').inc(forwarded)
+        self.service.metrics.counter('cluster_broadcasts_skipped').inc(len(self.peers) - forwarded)
+    
+    def interestChanged(self, channel_id, interested):
+        msg = {'op': interested and 'subscribe' or 'unsubscribe', 'channel': channel_id}
+        for link in self.nodes:
+            link.sendMessage(msg)
+
+BACKPLANES = {
+    'tcp': TCPMeshBackplane
+}
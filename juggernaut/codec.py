@@ -0,0 +1,53 @@
+'''JSON codec used for all frames. The fastest available backend is picked when the module is imported,
+use() switches to another one. Callers look the functions up on the module, as codec.dumps and 
+codec.loads, so they always get the current backend.
+
+Backends differ in details: simplejson decodes ASCII strings to str instead of unicode, and the
+encoders use different separators. The encoded text always decodes to the same values.'''
+import json
+
+BACKENDS = ['ujson', 'simplejson', 'json'] # fastest first
+
+def _load(name):
+    '''(dumps, loads) of the backend, raises ImportError if it is not installed'''
+    if name == 'ujson':
+        import ujson
+        return (lambda obj: ujson.dumps(obj, escape_forward_slashes=False)), ujson.loads
+    if name == 'simplejson':
+        import simplejson
+        return simplejson.dumps, simplejson.loads
+    if name == 'json':
+        return json.dumps, json.loads
+    raise ValueError("Unknown JSON backend %s" % str(name))
+    
+def available():
+    names = []
+    for name in BACKENDS:
+        try:
+            _load(name)
+            names.append(name)
+        except ImportError:
+            pass
+    return names
+
+def _accelerated(name):
+    '''simplejson built without its C extension is slower than the stdlib'''
+    if name == 'simplejson':
+        try:
+            import simplejson._speedups
+        except ImportError:
+            return False
+    return True
+
+def use(name=None):
+    '''Switch to the named backend, or to the fastest one available when name is None'''
+    global backend, dumps, loads
+    if name is None:
+        name = filter(_accelerated, available())[0]
+    try:
+        dumps, loads = _load(name)
+    except ImportError:
+        raise ValueError("JSON backend %s is not installed" % name)
+    backend = name
+    
+use()
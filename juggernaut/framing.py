@@ -0,0 +1,77 @@
+from logs import logger
+
+class FrameTooLarge(ValueError):
+    pass
+
+class NulFrameDecoder:
+    '''Splits incoming stream into NUL terminated frames. Only the newly received data is scanned for the
+    terminator, incomplete frame is kept as a list of chunks and joined once, when its terminator arrives'''
+    CR = "\0"
+    
+    DROP = 'drop'
+    DISCONNECT = 'disconnect'
+    
+    def __init__(self, max_frame_size=None, policy=DISCONNECT):
+        if policy not in (self.DROP, self.DISCONNECT):
+            raise ValueError("Unknown oversized frame policy %s" % str(policy))
+        self.max_frame_size = max_frame_size
+        self.policy = policy
+        self.chunks = []
+        self.length = 0
+        self.dropping = False
+        self.dropped = 0
+        self.oversized = None # FrameTooLarge of the frame which stopped decoding with the disconnect policy
+        
+    def feed(self, data):
+        '''Consume data, return the list of completed frames. If a frame exceeds max_frame_size and the 
+        policy is to disconnect, the frames before it are returned, oversized is set and nothing is decoded 
+        any more'''
+        if self.oversized is not None:
+            return []
+        frames = []
+        start = 0
+        end = data.find(self.CR)
+        while end != -1:
+            if self.dropping:
+                self.dropping = False
+            else:
+                frame = data[start:end]
+                if self.chunks:
+                    self.chunks.append(frame)
+                    frame = ''.join(self.chunks)
+                    self.chunks = []
+                    self.length = 0
+                if self._fits(len(frame)):
+                    frames.append(frame)
+                else:
+                    self._oversized(len(frame))
+                    if self.oversized is not None:
+                        return frames
+            start = end + 1
+            end = data.find(self.CR, start)
+        
+        if start < len(data) and not self.dropping:
+            self.length += len(data) - start
+            if self._fits(self.length):
+                self.chunks.append(data[start:])
+            else:
+                length = self.length
+                self.chunks = []
+                self.length = 0
+                self._oversized(length)
+                self.dropping = True
+        return frames
+        
+    def pending(self):
+        '''Number of buffered bytes of the incomplete frame'''
+        return self.length
+        
+    def _fits(self, length):
+        return self.max_frame_size is None or length <= self.max_frame_size
+        
+    def _oversized(self, length):
+        if self.policy == self.DISCONNECT:
+            self.oversized = FrameTooLarge("Frame of at least %d bytes exceeds the limit of %d bytes" % (length, self.max_frame_size))
+            return
+        self.dropped += 1
+        logger.error("Dropped frame of at least %d bytes, it exceeds the limit of %d bytes", length, self.max_frame_size)
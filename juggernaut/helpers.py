@@ -13,14 +13,52 @@ class RequestParamsHelper:
         return params
     
     def subscribeParams(self):
+        '''Members of the channel being subscribed to, as in a batch of subscribes'''
         params = self._commonParams()
+        params.extend(self._membersParams(self.channels and self.channels[0] or self.client.channel_id))
+        return '&'.join(params)
+        
+    def _membersParams(self, channel_id):
+        '''Session ids of clients in the channel, or just their number with the subscribe_member_count option'''
+        members = self.service.clientsInChannel(channel_id)
+        if self.service.config.get('subscribe_member_count'):
+            return ["clients_in_channel_count=%d" % len(members)]
+        params = []
         i = -1
-        for client in self.service.clientsInChannel(self.client.channel_id):
+        for client in members:
             params.append("clients_in_channel[%d]=%s" % (i, str(client.session_id)))
             i += 1
-            
-        return '&'.join(params)
+        return params
         
     def disconnectedParams(self):
         params = self._commonParams()
-        return '&'.join(params)
\ No newline at end of file
+        return '&'.join(params)
+
+class BatchRequestParamsHelper(RequestParamsHelper):
+    '''Params describing many clients in a single request. Each client adds one value to client_id[], session_id[] 
+    and channels[] arrays, so values with the same index belong to the same client'''
+    def __init__(self, service):
+        RequestParamsHelper.__init__(self, None, [], service)
+        self.entries = []
+        
+    def __len__(self):
+        return len(self.entries)
+        
+    def add(self, client, channels):
+        channel = None
+        if len(channels) > 0:
+            channel = channels[0]
+        self.entries.append((client.client_id, client.session_id, channel))
+        
+    def disconnectedParams(self):
+        params = []
+        for client_id, session_id, channel in self.entries:
+            params.append("client_id[]=%s" % str(client_id))
+            params.append("session_id[]=%s" % str(session_id))
+            params.append("channels[]=%s" % str(channel))
+        return '&'.join(params)
+        
+    def subscribeParams(self):
+        '''All clients subscribe to the same channel, its members are listed once'''
+        params = self.disconnectedParams()
+        return '&'.join([params] + self._membersParams(self.entries[0][2]))
\ No newline at end of file
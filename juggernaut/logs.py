@@ -0,0 +1,54 @@
+from twisted.python import log
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+
+class Logger:
+    '''Level gated logging on top of twisted.python.log. Messages are formatted only when they pass the level, 
+    so a disabled call costs a comparison. Debug messages, which are logged on the hot path, can be sampled: 
+    with sampling 0.01 only every hundredth of them is logged'''
+    
+    def __init__(self, level=INFO, sampling=1.0):
+        self.configure(level, sampling)
+        
+    def configure(self, level=INFO, sampling=1.0):
+        if not isinstance(level, int):
+            try:
+                level = LEVELS[level]
+            except KeyError:
+                raise ValueError("Unknown log level %s" % str(level))
+        if not 0 < sampling <= 1:
+            raise ValueError("Log sampling should be in (0, 1], was %s" % str(sampling))
+        self.level = level
+        self.sample_every = int(round(1 / sampling))
+        self.sampled = 0
+        
+    def enabled(self, level):
+        return level >= self.level
+        
+    def debug(self, format, *args):
+        if self.level > DEBUG:
+            return
+        self.sampled += 1
+        if self.sampled >= self.sample_every:
+            self.sampled = 0
+            log.msg(format % args if args else format)
+    
+    def info(self, format, *args):
+        if self.level <= INFO:
+            log.msg(format % args if args else format)
+            
+    def warning(self, format, *args):
+        if self.level <= WARNING:
+            log.msg(format % args if args else format)
+            
+    def error(self, format, *args):
+        if self.level <= ERROR:
+            log.err(format % args if args else format)
+
+# Shared by the whole server, JuggernautService configures it from log_level and log_sampling
+logger = Logger()
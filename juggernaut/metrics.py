@@ -0,0 +1,117 @@
+'''Counters, gauges and fixed-bucket histograms describing what the server does. Updating a counter or 
+a histogram is a couple of attribute updates, gauges are computed only when a snapshot is taken'''
+from twisted.web import resource
+from bisect import bisect_left
+import json
+
+RECIPIENT_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        
+    def inc(self, amount=1):
+        self.value += amount
+        
+    def snapshot(self):
+        return self.value
+
+class Gauge:
+    '''Value read from func when a snapshot is taken'''
+    def __init__(self, func):
+        self.func = func
+        
+    def snapshot(self):
+        return self.func()
+        
+class Histogram:
+    '''Counts observed values in buckets with fixed upper bounds, the last bucket is unbounded'''
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        
+    def snapshot(self):
+        '''Cumulative counts of values less than or equal to every bound, like Prometheus does'''
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            cumulative.append([bound, total])
+        return {'buckets': cumulative, 'sum': self.sum, 'count': self.count}
+
+class Registry:
+    '''Named metrics. Asking for a metric which already exists returns the existing one'''
+    
+    def __init__(self):
+        self.metrics = {}
+        
+    def counter(self, name):
+        return self._get(name, Counter)
+        
+    def gauge(self, name, func):
+        return self._get(name, Gauge, func)
+        
+    def histogram(self, name, buckets=LATENCY_BUCKETS):
+        return self._get(name, Histogram, buckets)
+        
+    def snapshot(self):
+        return dict((name, metric.snapshot()) for name, metric in self.metrics.items())
+        
+    def text(self):
+        '''Snapshot in the Prometheus text format'''
+        lines = []
+        for name, value in sorted(self.snapshot().items()):
+            if isinstance(value, dict):
+                for bound, count in value['buckets']:
+                    lines.append('%s_bucket{le="%s"} %s' % (name, bound, count))
+                lines.append('%s_sum %s' % (name, value['sum']))
+                lines.append('%s_count %s' % (name, value['count']))
+            else:
+                lines.append('%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+        
+    def _get(self, name, kind, *args):
+        try:
+            return self.metrics[name]
+        except KeyError:
+            self.metrics[name] = kind(*args)
+            return self.metrics[name]
+
+def mergeSnapshots(snapshots):
+    '''Sum snapshots taken in many processes, histograms are summed bucket by bucket'''
+    merged = {}
+    for snapshot in filter(None, snapshots):
+        for name, value in snapshot.items():
+            if name not in merged:
+                merged[name] = json.loads(json.dumps(value))
+            elif isinstance(value, dict):
+                for total, (bound, count) in zip(merged[name]['buckets'], value['buckets']):
+                    total[1] += count
+                merged[name]['sum'] += value['sum']
+                merged[name]['count'] += value['count']
+            else:
+                merged[name] += value
+    return merged
+
+class StatsResource(resource.Resource):
+    '''Serves the registry as text, or as JSON with ?format=json'''
+    isLeaf = True
+    
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+        
+    def render_GET(self, request):
+        if request.args.get('format') == ['json']:
+            request.setHeader('Content-Type', 'application/json')
+            return json.dumps(self.registry.snapshot())
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.registry.text()
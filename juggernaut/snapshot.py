@@ -0,0 +1,35 @@
+'''Clients, their channels and the messages stored for them, saved to disk so a restarted server can
+take them back without asking the Rails app again. Snapshots are zlib compressed JSON'''
+import os, zlib
+
+import codec
+
+VERSION = 1
+
+def save(path, state):
+    '''Write the state next to path first and rename it, so a crash never leaves half a snapshot behind'''
+    state = dict(state, version=VERSION)
+    tmp_path = path + '.tmp'
+    f = open(tmp_path, 'wb')
+    try:
+        f.write(zlib.compress(codec.dumps(state), 1))
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+    
+def load(path):
+    '''Saved state, or None if there is no snapshot. Raises ValueError if it can't be read'''
+    if not os.path.exists(path):
+        return None
+    f = open(path, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    try:
+        state = codec.loads(zlib.decompress(data))
+    except zlib.error as e:
+        raise ValueError("Snapshot %s is corrupt: %s" % (path, e))
+    if state.get('version') != VERSION:
+        raise ValueError("Snapshot %s has unknown version %s" % (path, state.get('version')))
+    return state
@@ -0,0 +1,175 @@
+from collections import deque, OrderedDict
+
+class MessageStore:
+    '''Ring buffer of encoded frames kept for a dead client. Once max_messages frames or max_bytes bytes 
+    are stored, the oldest frames are dropped to make room for the new ones'''
+    
+    MAX_MESSAGES = 1000
+    MAX_BYTES = 1024 * 1024
+    
+    def __init__(self, max_messages=MAX_MESSAGES, max_bytes=MAX_BYTES):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.frames = deque()
+        self.bytes = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+        
+    def append(self, frame):
+        if self.max_bytes is not None and len(frame) > self.max_bytes:
+            self._dropped(frame)
+            return
+        self.frames.append(frame)
+        self.bytes += len(frame)
+        while self._overflows():
+            frame = self.frames.popleft()
+            self.bytes -= len(frame)
+            self._dropped(frame)
+            
+    def flush(self):
+        '''Return all stored frames joined together and empty the store'''
+        data = ''.join(self.frames)
+        self.frames.clear()
+        self.bytes = 0
+        return data
+        
+    def __len__(self):
+        return len(self.frames)
+        
+    def _overflows(self):
+        return (self.max_messages is not None and len(self.frames) > self.max_messages) or \
+            (self.max_bytes is not None and self.bytes > self.max_bytes)
+            
+    def _dropped(self, frame):
+        self.dropped += 1
+        self.dropped_bytes += len(frame)
+            
+class WriteQueue(MessageStore):
+    '''Frames waiting for the transport of a slow client to drain. What happens when they reach max_bytes 
+    depends on the policy: the oldest frames are dropped, everything but the newest frame is dropped, 
+    or append reports the overflow so the client can be disconnected'''
+    
+    DROP_OLDEST = 'drop_oldest'
+    COALESCE = 'coalesce'
+    DISCONNECT = 'disconnect'
+    
+    def __init__(self, max_bytes, policy=DROP_OLDEST):
+        if policy not in (self.DROP_OLDEST, self.COALESCE, self.DISCONNECT):
+            raise ValueError("Unknown slow consumer policy %s" % str(policy))
+        MessageStore.__init__(self, None, policy == self.DROP_OLDEST and max_bytes or None)
+        self.limit = max_bytes
+        self.policy = policy
+        
+    def append(self, frame):
+        '''Queue the frame. Returns False when the queue overflows and the policy is to disconnect'''
+        overflows = self.limit is not None and self.bytes + len(frame) > self.limit
+        if overflows and self.policy == self.COALESCE:
+            for dropped in self.frames:
+                self._dropped(dropped)
+            self.flush()
+        MessageStore.append(self, frame)
+        return not (overflows and self.policy == self.DISCONNECT)
+        
+class ChannelHistory:
+    '''The most recent frames broadcast to a channel, with their message ids and the positions they were 
+    recorded at'''
+    
+    def __init__(self, max_messages, max_bytes):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.entries = deque()
+        self.bytes = 0
+        
+    def append(self, id, frame, position=None):
+        '''Returns by how many bytes the history has grown, negative when it shrunk'''
+        before = self.bytes
+        self.entries.append((id, frame, position))
+        self.bytes += len(frame)
+        while len(self.entries) > self.max_messages or (self.max_bytes is not None and self.bytes > self.max_bytes):
+            self.bytes -= len(self.entries.popleft()[1])
+        return self.bytes - before
+        
+    def entriesSince(self, last_id):
+        '''(id, frame, position) of messages recorded after the one with last_id, oldest first. Ids striped across 
+        workers or nodes are not recorded in increasing order, a relayed message may come after higher ids. 
+        Without last_id in the history every message with a greater id is returned'''
+        entries = []
+        for entry in reversed(self.entries):
+            if entry[0] == last_id:
+                entries.reverse()
+                return entries
+            entries.append(entry)
+        entries.reverse()
+        return [entry for entry in entries if entry[0] > last_id]
+        
+    def entriesAfter(self, position):
+        '''(id, frame, position) of messages recorded after position, oldest first'''
+        entries = []
+        for entry in reversed(self.entries):
+            if entry[2] <= position:
+                break
+            entries.append(entry)
+        entries.reverse()
+        return entries
+        
+    def since(self, last_id):
+        '''Frames of messages recorded after the one with last_id, joined together'''
+        return ''.join(entry[1] for entry in self.entriesSince(last_id))
+        
+    def __len__(self):
+        return len(self.entries)
+        
+class HistoryCache:
+    '''ChannelHistory of every channel which got a broadcast. Channels keep their history after the last 
+    client leaves, when all of them together take more than max_total_bytes the histories of channels 
+    which did not get a broadcast for the longest time are dropped'''
+    
+    SIZE = 100
+    MAX_BYTES = 256 * 1024
+    MAX_TOTAL_BYTES = 64 * 1024 * 1024
+    
+    def __init__(self, size=SIZE, max_bytes=MAX_BYTES, max_total_bytes=MAX_TOTAL_BYTES, sizes={}):
+        self.size = size
+        self.sizes = sizes
+        self.max_bytes = max_bytes
+        self.max_total_bytes = max_total_bytes
+        self.channels = OrderedDict()
+        self.bytes = 0
+        self.recorded = 0 # position of the last recorded frame, it grows with every frame of every channel
+        
+    def record(self, channel_id, id, frame):
+        self.recorded += 1
+        size = self.sizes.get(channel_id, self.sizes.get(str(channel_id), self.size))
+        if not size:
+            return
+        try:
+            history = self.channels.pop(channel_id) # inserted again as the most recently used
+        except KeyError:
+            history = ChannelHistory(size, self.max_bytes)
+        self.channels[channel_id] = history
+        self.bytes += history.append(id, frame, self.recorded)
+        while self.max_total_bytes is not None and self.bytes > self.max_total_bytes and len(self.channels) > 1:
+            channel_id, dropped = self.channels.popitem(last=False)
+            self.bytes -= dropped.bytes
+            
+    def entriesSince(self, channel_id, last_id):
+        try:
+            return self.channels[channel_id].entriesSince(last_id)
+        except KeyError:
+            return []
+            
+    def position(self):
+        '''Position of the last recorded frame, frames recorded later are returned by entriesAfter'''
+        return self.recorded
+        
+    def entriesAfter(self, channel_id, position):
+        try:
+            return self.channels[channel_id].entriesAfter(position)
+        except KeyError:
+            return []
+            
+    def since(self, channel_id, last_id):
+        return ''.join(entry[1] for entry in self.entriesSince(channel_id, last_id))
+            
+    def __len__(self):
+        return len(self.channels)
@@ -0,0 +1,128 @@
+from twisted.internet import reactor, error
+from twisted.python import log
+import heapq
+
+class WheelTimer(object):
+    '''Callback scheduled on a TimerWheel. Can be cancelled just like a DelayedCall'''
+    __slots__ = ('wheel', 'tick', 'f', 'args', 'called', 'cancelled')
+    
+    def __init__(self, wheel, tick, f, args):
+        self.wheel = wheel
+        self.tick = tick
+        self.f = f
+        self.args = args
+        self.called = False
+        self.cancelled = False
+        
+    def cancel(self):
+        if self.cancelled:
+            raise error.AlreadyCancelled
+        if self.called:
+            raise error.AlreadyCalled
+        self.cancelled = True
+        self.wheel._remove(self)
+        
+    def active(self):
+        return not (self.called or self.cancelled)
+
+class TimerWheel:
+    '''Coarse timer for a large number of callbacks. Deadlines are rounded up to a multiple of resolution,
+    callbacks sharing a deadline land in one bucket and the whole bucket is expired by a single reactor call.
+    Scheduling and cancelling a callback is O(1), the reactor only sees one pending call at a time'''
+    
+    def __init__(self, resolution, clock=reactor):
+        self.resolution = resolution
+        self.clock = clock
+        self.buckets = {}
+        self.ticks = []
+        self.pending = 0
+        self.expireTaskCall = None
+        self.scheduledTick = None
+        
+    def schedule(self, delay, f, *args):
+        '''Call f(*args) no sooner than delay seconds from now'''
+        tick = -int(-(self.clock.seconds() + delay) // self.resolution)
+        timer = WheelTimer(self, tick, f, args)
+        try:
+            self.buckets[tick][timer] = True
+        except KeyError:
+            self.buckets[tick] = {timer: True}
+            heapq.heappush(self.ticks, tick)
+            self._reschedule()
+        self.pending += 1
+        return timer
+        
+    def stop(self):
+        '''Cancel all pending callbacks'''
+        for bucket in self.buckets.values():
+            for timer in bucket:
+                timer.cancelled = True
+        self.buckets = {}
+        self.ticks = []
+        self.pending = 0
+        self._reschedule()
+        
+    def __len__(self):
+        return self.pending
+        
+    def _remove(self, timer):
+        bucket = self.buckets[timer.tick]
+        del(bucket[timer])
+        if not bucket:
+            # tick stays in the heap, expiring an empty bucket is a no-op
+            del(self.buckets[timer.tick])
+        self.pending -= 1
+        
+    def _reschedule(self):
+        tick = self.ticks and self.ticks[0] or None
+        if tick == self.scheduledTick:
+            return
+        if self.expireTaskCall and self.expireTaskCall.active():
+            self.expireTaskCall.cancel()
+        self.expireTaskCall = None
+        self.scheduledTick = tick
+        if tick is not None:
+            delay = max(0, tick * self.resolution - self.clock.seconds())
+            self.expireTaskCall = self.clock.callLater(delay, self._expire)
+            
+    def _expire(self):
+        self.expireTaskCall = None
+        self.scheduledTick = None
+        current = self.clock.seconds() / self.resolution + 1e-6
+        while self.ticks and self.ticks[0] <= current:
+            bucket = self.buckets.pop(heapq.heappop(self.ticks), {})
+            self.pending -= len(bucket)
+            for timer in bucket:
+                timer.called = True
+                try:
+                    timer.f(*timer.args)
+                except:
+                    log.err()
+        self._reschedule()
+
+class FlushScheduler:
+    '''Calls flushPending() of every connection added, all of them from a single reactor call delay seconds 
+    after the first one was added. With delay 0 it runs in the next reactor iteration, before the 
+    transports would have sent anything anyway'''
+    
+    def __init__(self, delay, clock=reactor):
+        self.delay = delay
+        self.clock = clock
+        self.dirty = []
+        self.flushTaskCall = None
+        
+    def add(self, connection):
+        self.dirty.append(connection)
+        if self.flushTaskCall is None:
+            self.flushTaskCall = self.clock.callLater(self.delay, self.flush)
+            
+    def flush(self):
+        if self.flushTaskCall is not None and self.flushTaskCall.active():
+            self.flushTaskCall.cancel()
+        self.flushTaskCall = None
+        dirty, self.dirty = self.dirty, []
+        for connection in dirty:
+            try:
+                connection.flushPending()
+            except:
+                log.err()
@@ -0,0 +1,277 @@
+from twisted.internet import defer, reactor, endpoints
+from twisted.web import client as web_client, error
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IAgentEndpointFactory, IBodyProducer
+from zope.interface import implements
+
+from helpers import BatchRequestParamsHelper
+from logs import logger
+
+class StringProducer:
+    '''Writes the whole body at once, so it leaves in the same packet as the headers'''
+    implements(IBodyProducer)
+    
+    def __init__(self, body):
+        self.body = body
+        self.length = len(body)
+        
+    def startProducing(self, consumer):
+        consumer.write(self.body)
+        return defer.succeed(None)
+        
+    def pauseProducing(self):
+        pass
+        
+    def resumeProducing(self):
+        pass
+        
+    def stopProducing(self):
+        pass
+
+class TCP4EndpointFactory:
+    '''Connects over IPv4, the same way getPage did'''
+    implements(IAgentEndpointFactory)
+    
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.tlsPolicy = web_client.BrowserLikePolicyForHTTPS()
+        
+    def endpointForURI(self, uri):
+        endpoint = endpoints.TCP4ClientEndpoint(self.reactor, uri.host, uri.port)
+        if uri.scheme == 'https':
+            endpoint = endpoints.wrapClientTLS(self.tlsPolicy.creatorForNetloc(uri.host, uri.port), endpoint)
+        return endpoint
+
+class CountingConnectionPool(web_client.HTTPConnectionPool):
+    '''Persistent connection pool which counts how many connections it had to open'''
+    
+    def __init__(self, reactor, persistent=True):
+        web_client.HTTPConnectionPool.__init__(self, reactor, persistent)
+        self.connections_requested = 0
+        self.connections_created = 0
+        
+    def getConnection(self, key, endpoint):
+        self.connections_requested += 1
+        return web_client.HTTPConnectionPool.getConnection(self, key, endpoint)
+        
+    def _newConnection(self, key, endpoint):
+        self.connections_created += 1
+        return web_client.HTTPConnectionPool._newConnection(self, key, endpoint)
+        
+    def cachedConnections(self):
+        return sum(map(len, self._connections.values()))
+
+class WebhookClient:
+    '''Sends webhook POSTs to the Rails app through one shared pool of keep-alive connections.
+    Number of concurrent requests to a single url is limited, requests above the limit are queued'''
+    
+    DEFAULT_CONCURRENCY = 10
+    CLOSE_TIMEOUT = 10
+    # the Rails app never saw these requests, retrying them is always safe
+    RETRY_ON = (web_client.RequestNotSent,)
+    # the Rails app may have handled these, retried only with webhook_retry_unsafe
+    RETRY_UNSAFE_ON = (web_client.ResponseNeverReceived, web_client.RequestTransmissionFailed)
+    
+    def __init__(self, config, reactor=reactor):
+        self.reactor = reactor
+        self.pool = CountingConnectionPool(reactor)
+        self.pool.maxPersistentPerHost = config.get('webhook_max_persistent_per_host', self.DEFAULT_CONCURRENCY)
+        self.pool.cachedConnectionTimeout = config.get('webhook_connection_timeout', 240)
+        self.agent = web_client.Agent.usingEndpointFactory(reactor, TCP4EndpointFactory(reactor), pool=self.pool)
+        self.concurrency = config.get('webhook_concurrency', self.DEFAULT_CONCURRENCY)
+        self.retry_on = self.RETRY_ON
+        if config.get('webhook_retry_unsafe'):
+            self.retry_on = self.RETRY_ON + self.RETRY_UNSAFE_ON
+        self.close_timeout = config.get('webhook_shutdown_timeout', self.CLOSE_TIMEOUT)
+        self.semaphores = {}
+        self.counters = {}
+        self.pending = 0
+        self.idleWaiters = []
+        self.latency = {} # url => metrics.Histogram of seconds from post to response
+        
+    def post(self, url, postdata):
+        '''POST form encoded postdata to url. Returned deferred fires with the response body, 
+        or fails with twisted.web.error.Error if the response code is not 2xx, just like getPage did'''
+        counters = self._counters(url)
+        counters['requests'] += 1
+        self.pending += 1
+        started = self.reactor.seconds()
+        d = self._semaphore(url).run(self._post, url, postdata, counters)
+        
+        def done(result):
+            counters['completed'] += 1
+            self._requestFinished(url, started)
+            return result
+        def failed(err):
+            counters['failed'] += 1
+            self._requestFinished(url, started)
+            return err
+        return d.addCallbacks(done, failed)
+        
+    def close(self):
+        '''Wait for the requests in flight, at most webhook_shutdown_timeout seconds, and close all cached connections'''
+        d = defer.Deferred()
+        if self.pending:
+            self.idleWaiters.append(d)
+            def giveUp():
+                if d in self.idleWaiters:
+                    logger.warning("Giving up on %d webhook requests at shutdown", self.pending)
+                    self.idleWaiters.remove(d)
+                    d.callback(None)
+            timeout = self.reactor.callLater(self.close_timeout, giveUp)
+            def cancelTimeout(result):
+                if timeout.active():
+                    timeout.cancel()
+                return result
+            d.addBoth(cancelTimeout)
+        else:
+            d.callback(None)
+        return d.addCallback(lambda _: self.pool.closeCachedConnections())
+        
+    def stats(self):
+        urls = {}
+        for url, counters in self.counters.items():
+            urls[url] = dict(counters)
+            urls[url]['queued'] = len(self.semaphores[url].waiting)
+        return {
+            'connections_requested': self.pool.connections_requested,
+            'connections_created': self.pool.connections_created,
+            'connections_reused': self.pool.connections_requested - self.pool.connections_created,
+            'connections_cached': self.pool.cachedConnections(),
+            'urls': urls
+        }
+        
+    def _post(self, url, postdata, counters, retry=True):
+        counters['in_flight'] += 1
+        headers = Headers({'Content-Type': ['application/x-www-form-urlencoded']})
+        d = self.agent.request('POST', url, headers, StringProducer(postdata))
+        d.addCallback(self._readResponse)
+        
+        def finished(result):
+            counters['in_flight'] -= 1
+            return result
+        d.addBoth(finished)
+        
+        def retryUnsent(err):
+            # only requests which never left are retried. A keep-alive connection from the pool which the Rails 
+            # app has closed usually fails with ResponseNeverReceived, webhooks are POSTs which the app may 
+            # have handled, so that is retried only with webhook_retry_unsafe
+            err.trap(*self.retry_on)
+            counters['retries'] += 1
+            return self._post(url, postdata, counters, False)
+        if retry:
+            d.addErrback(retryUnsent)
+        return d
+        
+    def _requestFinished(self, url, started):
+        if url in self.latency:
+            self.latency[url].observe(self.reactor.seconds() - started)
+        self.pending -= 1
+        if self.pending == 0:
+            waiters, self.idleWaiters = self.idleWaiters, []
+            for d in waiters:
+                d.callback(None)
+        
+    def _readResponse(self, response):
+        d = web_client.readBody(response)
+        if 200 <= response.code < 300:
+            return d
+        def raiseError(body):
+            raise error.Error(response.code, response.phrase, body)
+        return d.addCallback(raiseError)
+        
+    def _semaphore(self, url):
+        try:
+            return self.semaphores[url]
+        except KeyError:
+            limit = self.concurrency
+            if isinstance(limit, dict):
+                limit = limit.get(url, limit.get('default', self.DEFAULT_CONCURRENCY))
+            self.semaphores[url] = defer.DeferredSemaphore(limit)
+            return self.semaphores[url]
+            
+    def _counters(self, url):
+        try:
+            return self.counters[url]
+        except KeyError:
+            self.counters[url] = dict.fromkeys(['requests', 'completed', 'failed', 'retries', 'in_flight'], 0)
+            return self.counters[url]
+
+            
+class WebhookBatcher:
+    '''Collects disconnected or logged_out events and posts them to url together,
+    once window seconds have passed since the first event or size events have been collected'''
+    
+    def __init__(self, webhooks, url, service, window, size, reactor=reactor):
+        self.webhooks = webhooks
+        self.url = url
+        self.service = service
+        self.window = window
+        self.size = size
+        self.reactor = reactor
+        self.helper = BatchRequestParamsHelper(service)
+        self.flushTaskCall = None
+        
+    def add(self, client, channels):
+        self.helper.add(client, channels)
+        if len(self.helper) >= self.size:
+            self.flush()
+        elif self.flushTaskCall is None:
+            self.flushTaskCall = self.reactor.callLater(self.window, self.flush)
+            
+    def flush(self):
+        if self.flushTaskCall and self.flushTaskCall.active():
+            self.flushTaskCall.cancel()
+        self.flushTaskCall = None
+        if len(self.helper) == 0:
+            return defer.succeed(None)
+        
+        helper, self.helper = self.helper, BatchRequestParamsHelper(self.service)
+        def batchFailed(err):
+            logger.error("Sending batch of %d events to %s failed %s", len(helper), self.url, err)
+        return self.webhooks.post(self.url, helper.disconnectedParams()).addErrback(batchFailed)
+        
+class SubscribeBatcher:
+    '''Collects subscribe requests to the same channel and posts them to url together, once window seconds 
+    have passed since the first one or size of them have been collected. Every request gets the same response'''
+    
+    def __init__(self, webhooks, url, service, window, size, reactor=reactor):
+        self.webhooks = webhooks
+        self.url = url
+        self.service = service
+        self.window = window
+        self.size = size
+        self.reactor = reactor
+        self.batches = {} # channel => (BatchRequestParamsHelper, deferreds, flushTaskCall)
+        
+    def add(self, client, channels):
+        '''Returned deferred fires with the body of the response to the whole batch'''
+        channel_id = channels[0]
+        try:
+            helper, deferreds, flushTaskCall = self.batches[channel_id]
+        except KeyError:
+            helper, deferreds = BatchRequestParamsHelper(self.service), []
+            flushTaskCall = self.reactor.callLater(self.window, self.flush, channel_id)
+            self.batches[channel_id] = (helper, deferreds, flushTaskCall)
+        helper.add(client, channels)
+        d = defer.Deferred()
+        deferreds.append(d)
+        if len(helper) >= self.size:
+            self.flush(channel_id)
+        return d
+        
+    def flush(self, channel_id=None):
+        '''Post the batch of the channel, or all batches'''
+        if channel_id is None:
+            return defer.DeferredList([self.flush(channel_id) for channel_id in self.batches.keys()])
+        helper, deferreds, flushTaskCall = self.batches.pop(channel_id)
+        if flushTaskCall.active():
+            flushTaskCall.cancel()
+            
+        def fanOut(result):
+            for d in deferreds:
+                d.callback(result)
+        def fanOutFailure(err):
+            for d in deferreds:
+                d.errback(err)
+        return self.webhooks.post(self.url, helper.subscribeParams()).addCallbacks(fanOut, fanOutFailure)
\ No newline at end of file
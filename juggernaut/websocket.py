@@ -0,0 +1,184 @@
+'''WebSocket (RFC 6455) handshake and framing used by JuggernautWebSocketProtocol'''
+from framing import FrameTooLarge
+import base64, binascii, hashlib, os, struct
+
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+MAX_HANDSHAKE_SIZE = 8192
+
+CONTINUATION = 0x0
+TEXT = 0x1
+BINARY = 0x2
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_TOO_BIG = 1009
+
+class WebSocketError(ValueError):
+    pass
+
+def acceptKey(key):
+    return base64.b64encode(hashlib.sha1(key + GUID).digest())
+
+def parseHandshake(data):
+    '''Parse client opening handshake. Returns None if the request is not complete yet, 
+    otherwise (Sec-WebSocket-Key, data following the request). Raises WebSocketError for invalid requests'''
+    end = data.find('\r\n\r\n')
+    if end == -1:
+        if len(data) > MAX_HANDSHAKE_SIZE:
+            raise WebSocketError("Handshake longer than %d bytes" % MAX_HANDSHAKE_SIZE)
+        return None
+    lines = data[:end].split('\r\n')
+    request = lines[0].split(' ')
+    if len(request) != 3 or request[0] != 'GET':
+        raise WebSocketError("Invalid request line %s" % lines[0])
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if headers.get('upgrade', '').lower() != 'websocket':
+        raise WebSocketError("Missing Upgrade: websocket header")
+    if 'upgrade' not in headers.get('connection', '').lower():
+        raise WebSocketError("Missing Connection: Upgrade header")
+    if headers.get('sec-websocket-version') != '13':
+        raise WebSocketError("Unsupported version %s" % headers.get('sec-websocket-version'))
+    if not headers.get('sec-websocket-key'):
+        raise WebSocketError("Missing Sec-WebSocket-Key header")
+    return headers['sec-websocket-key'], data[end + 4:]
+
+def handshakeResponse(key):
+    return ('HTTP/1.1 101 Switching Protocols\r\n'
+        'Upgrade: websocket\r\n'
+        'Connection: Upgrade\r\n'
+        'Sec-WebSocket-Accept: %s\r\n\r\n') % acceptKey(key)
+        
+def handshakeRequest(host, port, key, path='/'):
+    '''Opening handshake sent by a client, used by the test helpers'''
+    return ('GET %s HTTP/1.1\r\n'
+        'Host: %s:%d\r\n'
+        'Upgrade: websocket\r\n'
+        'Connection: Upgrade\r\n'
+        'Sec-WebSocket-Key: %s\r\n'
+        'Sec-WebSocket-Version: 13\r\n\r\n') % (path, host, port, key)
+        
+def newKey():
+    return base64.b64encode(os.urandom(16))
+
+def mask(payload, key):
+    '''XOR payload with the 4 byte masking key. Masking and unmasking is the same operation'''
+    if not payload:
+        return payload
+    length = len(payload)
+    key = (key * (length / 4 + 1))[:length]
+    masked = int(binascii.hexlify(payload), 16) ^ int(binascii.hexlify(key), 16)
+    return binascii.unhexlify('%0*x' % (2 * length, masked))
+
+def encodeFrame(payload, opcode=TEXT, key=None):
+    '''Encode a single, final frame. Servers send unmasked frames, clients pass a masking key'''
+    length = len(payload)
+    mask_bit = key and 0x80 or 0
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, mask_bit | length)
+    elif length < 0x10000:
+        header = struct.pack('!BBH', 0x80 | opcode, mask_bit | 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, mask_bit | 127, length)
+    if key:
+        return header + key + mask(payload, key)
+    return header + payload
+    
+def closeFrame(code, reason=''):
+    return encodeFrame(struct.pack('!H', code) + reason, CLOSE)
+
+class WebSocketFrameDecoder:
+    '''Turns incoming data into complete messages, a list of (opcode, payload) tuples. Fragmented messages are 
+    reassembled, control frames are returned as soon as they arrive. Incoming data is kept as a list of chunks 
+    and only joined once enough bytes for the next frame are buffered'''
+    
+    def __init__(self, max_message_size=None, masked=True):
+        self.max_message_size = max_message_size
+        self.masked = masked
+        self.chunks = []
+        self.length = 0
+        self.needed = 2
+        self.fragments = []
+        self.fragments_length = 0
+        self.fragments_opcode = None
+        
+    def feed(self, data):
+        self.chunks.append(data)
+        self.length += len(data)
+        if self.length < self.needed:
+            return []
+        
+        data = ''.join(self.chunks)
+        messages = []
+        offset = 0
+        while True:
+            frame = self._parseFrame(data, offset)
+            if frame is None:
+                break
+            offset, fin, opcode, payload = frame
+            self._addFrame(messages, fin, opcode, payload)
+            
+        self.chunks = offset < len(data) and [data[offset:]] or []
+        self.length = len(data) - offset
+        return messages
+        
+    def _parseFrame(self, data, offset):
+        available = len(data) - offset
+        self.needed = 2
+        if available < 2:
+            return None
+        first, second = struct.unpack_from('!BB', data, offset)
+        fin, opcode, length = first & 0x80, first & 0x0F, second & 0x7F
+        if first & 0x70:
+            raise WebSocketError("Reserved bits set, no extensions were negotiated")
+        if bool(second & 0x80) != self.masked:
+            raise WebSocketError(self.masked and "Client frames must be masked" or "Server frames must not be masked")
+            
+        header = 2 + (length == 126 and 2 or 0) + (length == 127 and 8 or 0) + (self.masked and 4 or 0)
+        self.needed = header
+        if available < header:
+            return None
+        if length == 126:
+            length = struct.unpack_from('!H', data, offset + 2)[0]
+        elif length == 127:
+            length = struct.unpack_from('!Q', data, offset + 2)[0]
+            
+        if opcode >= CLOSE and (not fin or length > 125):
+            raise WebSocketError("Invalid control frame")
+        if opcode < CLOSE and self.max_message_size is not None and self.fragments_length + length > self.max_message_size:
+            raise FrameTooLarge("Message of at least %d bytes exceeds the limit of %d bytes" % (self.fragments_length + length, self.max_message_size))
+            
+        self.needed = header + length
+        if available < header + length:
+            return None
+        payload = data[offset + header:offset + header + length]
+        if self.masked:
+            payload = mask(payload, data[offset + header - 4:offset + header])
+        self.needed = 2
+        return offset + header + length, fin, opcode, payload
+        
+    def _addFrame(self, messages, fin, opcode, payload):
+        if opcode >= CLOSE:
+            messages.append((opcode, payload))
+        elif opcode == CONTINUATION:
+            if self.fragments_opcode is None:
+                raise WebSocketError("Continuation frame without a message to continue")
+            self.fragments.append(payload)
+            self.fragments_length += len(payload)
+            if fin:
+                messages.append((self.fragments_opcode, ''.join(self.fragments)))
+                self.fragments, self.fragments_length, self.fragments_opcode = [], 0, None
+        elif opcode in (TEXT, BINARY):
+            if self.fragments_opcode is not None:
+                raise WebSocketError("New message started before the previous one was finished")
+            if fin:
+                messages.append((opcode, payload))
+            else:
+                self.fragments, self.fragments_length, self.fragments_opcode = [payload], len(payload), opcode
+        else:
+            raise WebSocketError("Unknown opcode %d" % opcode)
@@ -0,0 +1,241 @@
+'''Running Juggernaut in many processes. The master process binds the listening sockets and starts
+worker processes which accept connections on them, every worker owns the clients it has accepted.
+Broadcasts and queries received by any worker are relayed through the master to all the other workers.'''
+from twisted.application import service
+from twisted.internet import protocol, defer, reactor, stdio
+from twisted.python import log
+import os, sys, json, socket
+
+import juggernaut
+from framing import NulFrameDecoder
+import codec
+from logs import logger
+
+class RelayProtocol(protocol.Protocol):
+    '''NUL delimited JSON messages exchanged between the master and a worker'''
+    
+    def __init__(self):
+        self.decoder = NulFrameDecoder()
+        
+    def dataReceived(self, data):
+        for frame in self.decoder.feed(data):
+            self.messageReceived(codec.loads(frame))
+            
+    def sendMessage(self, msg):
+        self.transport.write(codec.dumps(msg) + NulFrameDecoder.CR)
+        
+    def messageReceived(self, msg):
+        """Called with every decoded message, subclasses handle the ops they know and ignore the rest"""
+
+class WorkerLink(RelayProtocol):
+    '''Worker end of the link to the master. Set as the relay of the worker JuggernautService'''
+    
+    def __init__(self, service, lost=None):
+        RelayProtocol.__init__(self)
+        self.service = service
+        self.lost = lost
+        self.queries = {}
+        self.query_id = 0
+        
+    def broadcast(self, request, msg_id):
+        self.sendMessage({'op': 'broadcast', 'request': request, 'id': msg_id})
+        
+    def query(self, request):
+        '''Ask the other workers, returned deferred fires with the list of their responses'''
+        self.query_id += 1
+        self.queries[self.query_id] = d = defer.Deferred()
+        self.sendMessage({'op': 'query', 'request': request, 'id': self.query_id})
+        return d
+        
+    def messageReceived(self, msg):
+        # a failing message is logged, losing the link would stop the worker
+        if msg['op'] == 'broadcast':
+            try:
+                self.service.broadcast(msg['request'], msg['id'])
+            except:
+                log.err()
+        elif msg['op'] == 'query':
+            collector = juggernaut.ResponseCollector()
+            try:
+                getattr(self.service, 'query_' + msg['request']['type'])(msg['request'], collector)
+            except:
+                log.err()
+            self.sendMessage({'op': 'response', 'id': msg['id'], 'response': collector.response})
+        elif msg['op'] == 'responses':
+            self.queries.pop(msg['id']).callback(msg['responses'])
+            
+    def connectionLost(self, reason):
+        for d in self.queries.values():
+            d.callback([])
+        self.queries = {}
+        if self.lost:
+            self.lost(reason)
+
+class MasterLink(RelayProtocol):
+    '''Master end of the link to a single worker'''
+    
+    def __init__(self, hub, index):
+        RelayProtocol.__init__(self)
+        self.hub = hub
+        self.index = index
+        
+    def messageReceived(self, msg):
+        self.hub.route(self.index, msg)
+        
+class RelayHub:
+    '''Relays broadcasts and queries between the workers. Responses to a query are collected from
+    all the other workers and sent back to the worker which asked, all at once'''
+    
+    def __init__(self):
+        self.links = {}
+        self.queries = {}
+        self.query_id = 0
+        
+    def addLink(self, link):
+        self.links[link.index] = link
+        
+    def removeLink(self, index):
+        self.links.pop(index, None)
+        for query_id in self.queries.keys():
+            self._responseReceived(query_id, index, None)
+    
+    def route(self, index, msg):
+        if msg['op'] == 'broadcast':
+            for link in self._others(index):
+                link.sendMessage(msg)
+        elif msg['op'] == 'query':
+            others = self._others(index)
+            self.query_id += 1
+            self.queries[self.query_id] = (index, msg['id'], set(link.index for link in others), [])
+            for link in others:
+                link.sendMessage({'op': 'query', 'request': msg['request'], 'id': self.query_id})
+            self._finishQuery(self.query_id)
+        elif msg['op'] == 'response':
+            self._responseReceived(msg['id'], index, msg['response'])
+            
+    def _responseReceived(self, query_id, index, response):
+        if query_id not in self.queries:
+            return
+        origin, origin_id, waiting, responses = self.queries[query_id]
+        if index in waiting:
+            waiting.remove(index)
+            responses.append(response)
+        self._finishQuery(query_id)
+            
+    def _finishQuery(self, query_id):
+        origin, origin_id, waiting, responses = self.queries.get(query_id, (None, None, None, None))
+        if waiting or origin is None:
+            return
+        del(self.queries[query_id])
+        if origin in self.links:
+            self.links[origin].sendMessage({'op': 'responses', 'id': origin_id, 'responses': responses})
+            
+    def _others(self, index):
+        return [link for link in self.links.values() if link.index != index]
+
+class WorkerProcessProtocol(protocol.ProcessProtocol):
+    '''Connects MasterLink to the stdin and stdout of a worker process'''
+    
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.link = MasterLink(pool.hub, index)
+        
+    def connectionMade(self):
+        self.link.makeConnection(self.transport)
+        self.pool.hub.addLink(self.link)
+        
+    def outReceived(self, data):
+        self.link.dataReceived(data)
+        
+    def processEnded(self, reason):
+        self.pool.workerEnded(self.link.index, reason)
+
+class WorkerPoolService(service.Service):
+    '''Binds the listening sockets and runs options['workers'] worker processes sharing them.
+    Workers which die are started again'''
+    
+    LISTENING_FD = 3
+    WEBSOCKET_LISTENING_FD = 4
+    
+    def __init__(self, options):
+        self.config = options
+        self.hub = RelayHub()
+        self.processes = {}
+        self.sockets = {}
+        self.stopping = {}
+        
+    def startService(self):
+        service.Service.startService(self)
+        self.sockets[self.LISTENING_FD] = self._listen(self.config['port'])
+        if self.config.get('websocket_port'):
+            self.sockets[self.WEBSOCKET_LISTENING_FD] = self._listen(self.config['websocket_port'])
+        for index in range(self.config['workers']):
+            self._spawn(index)
+            
+    def stopService(self):
+        service.Service.stopService(self)
+        waiting = []
+        for index, process in self.processes.items():
+            self.stopping[index] = d = defer.Deferred()
+            waiting.append(d)
+            process.closeStdin()
+        for sock in self.sockets.values():
+            sock.close()
+        self.sockets = {}
+        return defer.DeferredList(waiting)
+        
+    def workerEnded(self, index, reason):
+        logger.warning("Worker %d ended: %s", index, reason.getErrorMessage())
+        self.hub.removeLink(index)
+        del(self.processes[index])
+        if index in self.stopping:
+            self.stopping.pop(index).callback(None)
+        elif self.running:
+            self._spawn(index)
+        
+    def _listen(self, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', port))
+        sock.listen(1024)
+        sock.setblocking(False)
+        return sock
+        
+    def _spawn(self, index):
+        child_fds = {0: 'w', 1: 'r', 2: 2}
+        for fd, sock in self.sockets.items():
+            child_fds[fd] = sock.fileno()
+        env = dict(os.environ)
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_dir, env.get('PYTHONPATH')]))
+        args = [sys.executable, '-c', 'from juggernaut.workers import runWorker; runWorker()', 
+            json.dumps(self.config), str(index), str(self.config['workers'])]
+        self.processes[index] = reactor.spawnProcess(WorkerProcessProtocol(self, index), sys.executable, args, env, childFDs=child_fds)
+
+def runWorker():
+    '''Entry point of a worker process, started by WorkerPoolService'''
+    config, index, count = json.loads(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3])
+    config['workers'] = 1
+    # a client may reconnect to any worker, so none of them can take back clients from a snapshot
+    config.pop('snapshot_path', None)
+    for key, value in config.items():
+        if isinstance(value, unicode): # urls have to stay bytes after the trip through JSON
+            config[key] = str(value)
+    log.startLogging(sys.stderr)
+    
+    juggernaut.Message.current_id = index
+    juggernaut.Message.id_step = count
+    
+    worker = juggernaut.JuggernautService(config)
+    worker.relay = WorkerLink(worker, lambda reason: reactor.stop())
+    stdio.StandardIO(worker.relay)
+    
+    reactor.adoptStreamPort(WorkerPoolService.LISTENING_FD, socket.AF_INET, juggernaut.IJuggernautFactory(worker))
+    os.close(WorkerPoolService.LISTENING_FD)
+    if config.get('websocket_port'):
+        reactor.adoptStreamPort(WorkerPoolService.WEBSOCKET_LISTENING_FD, socket.AF_INET, juggernaut.IJuggernautWebSocketFactory(worker))
+        os.close(WorkerPoolService.WEBSOCKET_LISTENING_FD)
+    
+    worker.startService()
+    reactor.addSystemEventTrigger('before', 'shutdown', worker.stopService)
+    reactor.run()
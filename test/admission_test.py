@@ -0,0 +1,60 @@
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import task, address
+import juggernaut
+from juggernaut.admission import ConnectionRateLimiter
+
+import sys
+sys.path.append('test')
+from test_helper import TestConfig, ServiceTest
+
+class ConnectionRateLimiterTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.clock = task.Clock()
+        self.limiter = ConnectionRateLimiter(2, 3, ['127.0.0.1'], self.clock)
+        
+    def testBurstThenRate(self):
+        self.assertEqual([True] * 3 + [False], [self.limiter.allow('10.0.0.1') for _ in range(4)])
+        self.clock.advance(0.5)
+        self.assertEqual([True, False], [self.limiter.allow('10.0.0.1') for _ in range(2)])
+        
+    def testAddressesAreLimitedSeparately(self):
+        for _ in range(3):
+            self.limiter.allow('10.0.0.1')
+        self.assertFalse(self.limiter.allow('10.0.0.1'))
+        self.assertTrue(self.limiter.allow('10.0.0.2'))
+        
+    def testAllowedIpsAreExempt(self):
+        self.assertTrue(all(self.limiter.allow('127.0.0.1') for _ in range(100)))
+        
+    def testLeastRecentlySeenIsForgotten(self):
+        self.limiter.MAX_TRACKED = 2
+        self.limiter.allow('10.0.0.1')
+        self.limiter.allow('10.0.0.2')
+        self.limiter.allow('10.0.0.1')
+        self.limiter.allow('10.0.0.3')
+        self.assertEqual(['10.0.0.1', '10.0.0.3'], self.limiter.buckets.keys())
+
+class AdmissionTest(ServiceTest):
+    options = {'connection_rate_limit': 1, 'connection_rate_burst': 2}
+    
+    def setUp(self):
+        ServiceTest.setUp(self)
+        self.factory = juggernaut.IJuggernautFactory(self.service)
+        
+    def testConnectionsOverTheLimitAreRefused(self):
+        addr = address.IPv4Address('TCP', '10.0.0.1', 40000)
+        protocols = [self.factory.buildProtocol(addr) for _ in range(3)]
+        self.assertEqual(None, protocols[-1])
+        self.assertTrue(all(protocols[:2]))
+        self.assertEqual(1, self.service.metrics.snapshot()['connections_refused'])
+        
+    def testPolicyFileRequestIsAnsweredWithoutJson(self):
+        connector = self.factory.buildProtocol(address.IPv4Address('TCP', '10.0.0.1', 40000))
+        connector.makeConnection(proto_helpers.StringTransport())
+        connector.dataReceived('<policy-file-request/>\0')
+        self.assertEqual(self.service.policy_file, connector.transport.value())
+        self.assertTrue('to-ports="%d"' % TestConfig.config['port'] in connector.transport.value())
+        self.assertTrue(connector.transport.disconnecting)
+        self.assertEqual(1, self.service.metrics.snapshot()['policy_files_sent'])
@@ -0,0 +1,60 @@
+from twisted.test import proto_helpers
+from twisted.internet.address import IPv4Address
+import juggernaut
+
+import sys, json
+sys.path.append('test')
+from test_helper import ServiceTest, connectProtocol
+
+class CountingTransport(proto_helpers.StringTransport):
+    def __init__(self):
+        proto_helpers.StringTransport.__init__(self, hostAddress=IPv4Address('TCP', '127.0.0.1', 5002))
+        self.writes = 0
+        
+    def write(self, data):
+        self.writes += 1
+        proto_helpers.StringTransport.write(self, data)
+
+class BatchBroadcastTest(ServiceTest):
+    
+    def _connect(self):
+        return connectProtocol(self.service, transport=CountingTransport())
+        
+    def _subscribed(self, client_id):
+        connector = self._connect()
+        client = self.service.findOrCreateClient(connector, client_id, client_id, 1)
+        client.channel_id = 1
+        self.service.channels.setdefault(1, juggernaut.ClientSet()).add(client)
+        return connector.transport
+        
+    def _bodies(self, transport):
+        return [json.loads(frame)['body'] for frame in filter(None, transport.value().split('\0'))]
+        
+    def testBatchIsWrittenOncePerRecipient(self):
+        first, second = self._subscribed(1), self._subscribed(2)
+        publisher = self._connect()
+        publisher.dataReceived(json.dumps({'command': 'broadcast', 'type': 'batch', 'broadcasts': [
+            {'channels': [1], 'body': 'a'},
+            {'client_ids': [1], 'body': 'b'},
+            {'channels': [1], 'body': {'c': 1}}
+        ]}) + '\0')
+        self.assertEqual(['a', 'b', {'c': 1}], self._bodies(first))
+        self.assertEqual(['a', {'c': 1}], self._bodies(second))
+        self.assertEqual(1, first.writes)
+        self.assertEqual(1, second.writes)
+        self.assertEqual(3, self.service.metrics.counter('broadcasts').value)
+        self.assertEqual(None, self.service.holding)
+        
+    def testAuthenticationIsCached(self):
+        checks = []
+        authenticate = self.service.authenticateBroadcastOrQuery
+        self.service.authenticateBroadcastOrQuery = lambda *a: checks.append(authenticate(*a))
+        publisher = self._connect()
+        for body in ['a', 'b']:
+            publisher.dataReceived(json.dumps({'command': 'broadcast', 'type': 'to_clients', 'client_ids': [], 'body': body}) + '\0')
+        self.assertEqual([True], checks)
+        
+    def testEntryWithoutRecipientsDisconnects(self):
+        publisher = self._connect()
+        publisher.dataReceived(json.dumps({'command': 'broadcast', 'type': 'batch', 'broadcasts': [{'body': 'a'}]}) + '\0')
+        self.assertTrue(publisher.transport.disconnecting)
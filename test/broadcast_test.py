@@ -21,10 +21,13 @@ class BroadcastTest(JuggernautTest):
         reactor.callLater(0.1, rails_app.sendBroadcastToChannelsMessage, "Czesc", [1])
         
         def assertMessagesArrived(*a):
+            ids = []
             for client in clients:
                 self.assertEqual(len(client.connector.transport.protocol.messages), 1)
                 msg = json.loads(client.connector.transport.protocol.messages[0])
                 self.assertEqual(msg['body'], 'Czesc')
+                ids.append(msg['id'])
+            self.assertEqual(1, len(set(ids))) # every recipient gets the same broadcast id
         d = task.deferLater(reactor, 0.2, assertMessagesArrived)
         
         def disconnectClients(*a):
@@ -129,4 +132,54 @@ class BroadcastTest(JuggernautTest):
             rails.connector.disconnect()
         d.addCallback(disconnect)
         
-        return defer.DeferredList([rails.disconnectedEvent, client.disconnectedEvent, d])
\ No newline at end of file
+        return defer.DeferredList([rails.disconnectedEvent, client.disconnectedEvent, d])
+        
+    def testStoredMessagesAreBounded(self):
+        '''Only the newest stored_messages_limit messages are kept for a disconnected client'''
+        self.webServer.expectRequests(5)
+        self.config['timeout'] = 0.5
+        self.config['stored_messages_limit'] = 2
+        
+        client = MockFlashClient(1)
+        reconnecting_client = MockFlashClient(1)
+        rails = MockFlashClient()
+        reactor.callLater(0.1, client.sendSubscribeMessage)
+        reactor.callLater(0.2, client.connector.disconnect)
+        
+        messages = [ "first", 'second', 'third' ]
+        for message in messages:
+            reactor.callLater(0.3, rails.sendBroadcastToClientsMessage, message, [1])
+        reactor.callLater(0.4, reconnecting_client.sendSubscribeMessage)
+        
+        def assertMessagesArrived(client):
+            self.assertEqual(messages[1:], map(lambda x: (json.loads(x))['body'], client.connector.transport.protocol.messages))
+        d = task.deferLater(reactor, 0.5, assertMessagesArrived, reconnecting_client)
+        
+        def disconnect(*a):
+            reconnecting_client.connector.disconnect()
+            rails.connector.disconnect()
+        d.addCallback(disconnect)
+        
+        return defer.DeferredList([rails.disconnectedEvent, client.disconnectedEvent, d])
+        
+    def testResumeFromLastMsgId(self):
+        '''Client subscribing with last_msg_id gets the messages broadcast to its channel after that id'''
+        self.webServer.expectRequests(3)
+        rails = MockFlashClient()
+        client = MockFlashClient(1)
+        
+        messages = ['first', 'second', 'third']
+        for body in messages:
+            reactor.callLater(0.05, rails.sendBroadcastToChannelsMessage, body, [1])
+        def subscribe():
+            first_id = self.service.history.channels[1].entries[0][0]
+            client.sendMessage({'command': 'subscribe', 'client_id': 1, 'session_id': 1, 'channels': [1], 'last_msg_id': first_id})
+        reactor.callLater(0.1, subscribe)
+        
+        def assertMessagesArrived(*a):
+            self.assertEqual(messages[1:], map(lambda x: (json.loads(x))['body'], client.connector.transport.protocol.messages))
+            client.connector.disconnect()
+            rails.connector.disconnect()
+        d = task.deferLater(reactor, 0.2, assertMessagesArrived)
+        
+        return defer.DeferredList([rails.disconnectedEvent, client.disconnectedEvent, d])
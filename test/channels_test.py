@@ -0,0 +1,17 @@
+from twisted.trial import unittest
+from juggernaut.channels import ClientSet
+
+class ClientSetTest(unittest.TestCase):
+    
+    def testKeepsInsertionOrder(self):
+        members = ClientSet(['a', 'b'])
+        members.add('c')
+        members.add('a') # adding a member again doesn't move it
+        members.remove('b')
+        self.assertEqual(['a', 'c'], list(members))
+        self.assertEqual(2, len(members))
+        self.assertTrue('c' in members)
+        self.assertFalse('b' in members)
+        
+    def testRemovingNonMemberRaises(self):
+        self.assertRaises(KeyError, ClientSet(['a']).remove, 'b')
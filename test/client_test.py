@@ -0,0 +1,21 @@
+import juggernaut
+
+import sys
+sys.path.append('test')
+from test_helper import ServiceTest, connectProtocol
+
+class CompactClientTest(ServiceTest):
+    
+    def setUp(self):
+        ServiceTest.setUp(self)
+        self.connector = connectProtocol(self.service)
+        
+    def testClientAndMessageHaveNoDict(self):
+        client = self.service.findOrCreateClient(self.connector, 1, 1, 1)
+        self.assertFalse(hasattr(client, '__dict__'))
+        self.assertFalse(hasattr(juggernaut.Message('body'), '__dict__'))
+        self.assertEqual(None, client.stored_messages) # created only when the client goes dead
+        
+    def testIdleConnectionKeepsOnlyTwistedState(self):
+        self.connector.client = self.service.findOrCreateClient(self.connector, 1, 1, 1)
+        self.assertEqual(['client', 'connected', 'factory', 'transport'], sorted(vars(self.connector).keys()))
@@ -0,0 +1,153 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task, reactor
+import juggernaut
+
+import sys, json
+sys.path.append('test')
+from test_helper import TestConfig, MockFlashClient, MockWebServer
+
+class ClusterTest(unittest.TestCase):
+    '''Three nodes on localhost connected by the TCP mesh'''
+    timeout = 5
+    NODES = 3
+    
+    def setUp(self):
+        self.webServer = MockWebServer(autoRespond=lambda request: '')
+        cluster_ports = [15101 + index for index in range(self.NODES)]
+        self.nodes, self.ports = [], []
+        for index in range(self.NODES):
+            config = dict(TestConfig.config, port=15001 + index, cluster_port=cluster_ports[index],
+                cluster_peers=['localhost:%d' % port for port in cluster_ports if port != cluster_ports[index]])
+            node = juggernaut.JuggernautService(config)
+            node.startService()
+            self.nodes.append(node)
+            self.ports.append(reactor.listenTCP(config['port'], juggernaut.IJuggernautFactory(node)))
+        self.clients = []
+        return self._waitFor(lambda: all(len(node.backplane.peers) == self.NODES - 1 and
+            all(link.interest is not None for link in node.backplane.peers) for node in self.nodes))
+    
+    @defer.inlineCallbacks
+    def tearDown(self):
+        for client in self.clients:
+            client.connector.disconnect()
+        yield defer.DeferredList([client.disconnectedEvent for client in self.clients])
+        for port in self.ports:
+            yield port.stopListening()
+        for node in self.nodes:
+            yield node.stopService()
+        yield self.webServer.stopListening()
+    
+    @defer.inlineCallbacks
+    def _waitFor(self, condition):
+        while not condition():
+            yield task.deferLater(reactor, 0.005, lambda: None)
+    
+    @defer.inlineCallbacks
+    def _subscribe(self, node, client_id, channel_id):
+        '''Connect a client to the node and wait until the other nodes know about its channel'''
+        client = MockFlashClient(client_id, port=15001 + node)
+        self.clients.append(client)
+        yield client.connectedEvent
+        client.sendSubscribeMessage([channel_id])
+        yield self._waitFor(lambda: all(channel_id in link.interest for other in self.nodes
+            if other is not self.nodes[node] for link in other.backplane.peers if link.transport.getPeer().port == 15101 + node))
+        defer.returnValue(client)
+    
+    def _bodies(self, client):
+        return [json.loads(message)['body'] for message in client.connector.transport.protocol.messages]
+    
+    @defer.inlineCallbacks
+    def testBroadcastReachesClientsOnEveryNode(self):
+        clients = []
+        for node in range(self.NODES):
+            client = yield self._subscribe(node, node + 1, 1)
+            clients.append(client)
+        publisher = MockFlashClient(port=15001)
+        self.clients.append(publisher)
+        yield publisher.connectedEvent
+        publisher.sendBroadcastToChannelsMessage('hello', [1])
+        yield self._waitFor(lambda: all(self._bodies(client) for client in clients))
+        self.assertEqual([['hello']] * self.NODES, map(self._bodies, clients))
+    
+    @defer.inlineCallbacks
+    def testBroadcastIsOnlyForwardedToInterestedNodes(self):
+        client = yield self._subscribe(1, 1, 7)
+        self.nodes[0].broadcast({'type': 'to_channels', 'channels': [7, 8], 'body': 'hello'})
+        yield self._waitFor(lambda: self._bodies(client))
+        self.assertEqual(['hello'], self._bodies(client))
+        metrics = self.nodes[0].metrics.snapshot()
+        self.assertEqual(1, metrics['cluster_broadcasts_forwarded'])
+        self.assertEqual(1, metrics['cluster_broadcasts_skipped'])
+        # the channel without clients on node 1 was left out of the broadcast passed on to it
+        self.assertEqual(1, len(self.nodes[1].history.entriesSince(7, -1)))
+        self.assertEqual([], self.nodes[1].history.entriesSince(8, -1))
+    
+    @defer.inlineCallbacks
+    def testInterestIsWithdrawnWhenChannelEmpties(self):
+        client = yield self._subscribe(2, 1, 5)
+        client.connector.disconnect()
+        yield self._waitFor(lambda: not any(5 in (link.interest or ()) for link in self.nodes[0].backplane.peers))
+    
+    @defer.inlineCallbacks
+    def testBroadcastToClientsReachesOtherNodes(self):
+        client = yield self._subscribe(2, 9, 3)
+        self.nodes[0].broadcast({'type': 'to_clients', 'client_ids': [9], 'body': 'hi'})
+        yield self._waitFor(lambda: self._bodies(client))
+        self.assertEqual(['hi'], self._bodies(client))
+    
+    @defer.inlineCallbacks
+    def testFailingBroadcastKeepsTheLink(self):
+        client = yield self._subscribe(1, 1, 4)
+        link = self.nodes[1].backplane.nodes[0]
+        link.dataReceived(json.dumps({'op': 'broadcast', 'request': {'type': 'bogus', 'body': 'x'}, 'id': 1}) + '\0' +
+            json.dumps({'op': 'broadcast', 'request': {'type': 'to_channels', 'channels': [4], 'body': 'after'}, 'id': 2}) + '\0')
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+        yield self._waitFor(lambda: self._bodies(client))
+        self.assertEqual(['after'], self._bodies(client))
+        self.assertTrue(link in self.nodes[1].backplane.nodes)
+
+    @defer.inlineCallbacks
+    def testResumeAfterInterleavedPeerBroadcast(self):
+        '''A broadcast from another node comes with a lower id after a local one, resuming from the local 
+        one still gets it'''
+        self.patch(juggernaut.Message, 'current_id', 10)
+        self.patch(juggernaut.Message, 'id_step', 3)
+        self.nodes[1].broadcast({'type': 'to_channels', 'channels': [4], 'body': 'local'})
+        self.nodes[1].backplane.nodes[0].dataReceived(json.dumps({'op': 'broadcast', 'id': 2,
+            'request': {'type': 'to_channels', 'channels': [4], 'body': 'peer'}}) + '\0')
+        client = MockFlashClient(5, port=15002)
+        self.clients.append(client)
+        yield client.connectedEvent
+        client.sendMessage({'command': 'subscribe', 'client_id': 5, 'session_id': 5, 'channels': [4], 'last_msg_id': 10})
+        yield self._waitFor(lambda: self._bodies(client))
+        self.assertEqual(['peer'], self._bodies(client))
+        
+    @defer.inlineCallbacks
+    def testClientsOnOtherNodesAreNotMissing(self):
+        errors = []
+        self.patch(juggernaut.logger, 'error', lambda *args: errors.append(args))
+        client = yield self._subscribe(2, 9, 3)
+        self.nodes[0].broadcast({'type': 'to_clients', 'client_ids': [9], 'body': 'hi'})
+        yield self._waitFor(lambda: all(node.metrics.snapshot().get('broadcasts') for node in self.nodes))
+        self.assertEqual(['hi'], self._bodies(client))
+        self.assertEqual([], errors)
+
+class MakeServiceTest(unittest.TestCase):
+    
+    def setUp(self):
+        # message ids are numbered per process, patched values are put back after the test
+        self.patch(juggernaut.Message, 'current_id', 0)
+        self.patch(juggernaut.Message, 'id_step', 1)
+        self.config = dict(TestConfig.config, snapshot_path='snapshot', cluster_port=15101, cluster_node_id=1,
+            cluster_peers=['localhost:15102', 'localhost:15103'])
+        self.service = juggernaut.makeService(self.config)
+        
+    def tearDown(self):
+        return self.service.stopService()
+    
+    def testNodeNumbersMessagesInItsStripe(self):
+        self.assertEqual([1, 4], [juggernaut.Message('a').id, juggernaut.Message('b').id])
+        
+    def testSnapshotIsSkippedWithoutChangingOptions(self):
+        self.assertEqual(None, self.service.config.get('snapshot_path'))
+        self.assertEqual('snapshot', self.config['snapshot_path'])
@@ -0,0 +1,80 @@
+from twisted.test import proto_helpers
+from twisted.internet import task, defer
+import juggernaut
+from juggernaut import websocket
+
+import sys, json
+sys.path.append('test')
+from test_helper import ServiceTest
+
+class CountingTransport(proto_helpers.StringTransport):
+    writes = 0
+    
+    def write(self, data):
+        self.writes += 1
+        proto_helpers.StringTransport.write(self, data)
+        
+    def writeSequence(self, seq):
+        self.writes += 1
+        proto_helpers.StringTransport.write(self, ''.join(seq))
+
+class CoalesceTest(ServiceTest):
+    options = {'write_coalesce_delay': 0}
+    
+    def setUp(self):
+        ServiceTest.setUp(self)
+        self.clock = self.service.flushScheduler.clock = task.Clock()
+        
+    def _connect(self, client_id, protocol=juggernaut.JuggernautProtocol):
+        return ServiceTest._connect(self, client_id, protocol, CountingTransport())
+        
+    def _broadcast(self, bodies, client_ids):
+        for body in bodies:
+            self.service.broadcast({'type': 'to_clients', 'client_ids': client_ids, 'body': body})
+        
+    def _bodies(self, data):
+        return [json.loads(frame)['body'] for frame in filter(None, data.split('\0'))]
+        
+    def testMessagesOfOneIterationAreWrittenAtOnce(self):
+        connectors = [self._connect(1), self._connect(2)]
+        self._broadcast(['first', 'second', 'third'], [1, 2])
+        self.assertEqual([0, 0], [connector.transport.writes for connector in connectors])
+        self.clock.advance(0)
+        for connector in connectors:
+            self.assertEqual(1, connector.transport.writes)
+            self.assertEqual(['first', 'second', 'third'], self._bodies(connector.transport.value()))
+            
+    def testWebSocketClientsGetWebSocketFrames(self):
+        connector = self._connect(1, juggernaut.JuggernautWebSocketProtocol)
+        self._broadcast(['first', 'second'], [1])
+        self.clock.advance(0)
+        decoder = websocket.WebSocketFrameDecoder(masked=False)
+        payloads = [payload for opcode, payload in decoder.feed(connector.transport.value())]
+        self.assertEqual(['first', 'second'], [json.loads(payload)['body'] for payload in payloads])
+        
+    def testPendingMessagesAreStoredWhenConnectionIsLost(self):
+        connector = self._connect(1)
+        self._broadcast(['first', 'second'], [1])
+        connector.connectionLost(None)
+        self.clock.advance(0)
+        self.assertEqual('', connector.transport.value())
+        self.assertEqual(['first', 'second'], self._bodies(''.join(self.service.clients[1].stored_messages.frames)))
+        
+    def testPendingMessagesGoBeforeHeldBackOnesWhenConnectionIsLost(self):
+        self.service.webhooks.post = lambda url, params: defer.Deferred()
+        connector = self._connect(1)
+        self._broadcast(['pending'], [1])
+        self.service.subscribeRequest(connector.client, [1]) # the webhook stays in flight
+        self._broadcast(['held back'], [1])
+        connector.connectionLost(None)
+        self.assertEqual(['pending', 'held back'], self._bodies(''.join(self.service.clients[1].stored_messages.frames)))
+        
+    def testPendingMessagesAreQueuedWhenPaused(self):
+        connector = self._connect(1)
+        self._broadcast(['first'], [1])
+        connector.pauseProducing()
+        self.clock.advance(0)
+        self.assertEqual('', connector.transport.value())
+        connector.resumeProducing()
+        self.clock.advance(0)
+        self.assertEqual(['first'], self._bodies(connector.transport.value()))
@@ -0,0 +1,23 @@
+from twisted.trial import unittest
+from juggernaut import codec
+
+class CodecTest(unittest.TestCase):
+    
+    def tearDown(self):
+        codec.use()
+        
+    def testBackendsAgree(self):
+        frame = {'command': 'broadcast', 'type': 'to_channels', 'channels': [1], 'body': {'text': u'za\u017c\xf3\u0142\u0107 /\0'}}
+        for name in codec.available():
+            codec.use(name)
+            encoded = codec.dumps(frame)
+            self.assertFalse('\0' in encoded, name) # NUL terminates frames, it has to be escaped
+            self.assertEqual(frame, codec.loads(encoded), name)
+            
+    def testStdlibIsAlwaysAvailable(self):
+        self.assertEqual('json', codec.available()[-1])
+        codec.use('json')
+        self.assertEqual('json', codec.backend)
+        
+    def testUnknownBackend(self):
+        self.assertRaises(ValueError, codec.use, 'yaml')
@@ -0,0 +1,75 @@
+from twisted.internet import defer
+import juggernaut
+from juggernaut import websocket
+
+import sys, json, zlib, base64
+sys.path.append('test')
+from test_helper import ServiceTest, connectProtocol
+
+class CompressionTest(ServiceTest):
+    BODY = {'text': 'Lorem ipsum dolor sit amet ' * 100}
+    options = {'compression_threshold': 500}
+    
+    def setUp(self):
+        ServiceTest.setUp(self)
+        self.service.webhooks.post = lambda url, params: defer.Deferred()
+        
+    def _connect(self, client_id, compression=None, protocol=juggernaut.JuggernautProtocol):
+        connector = connectProtocol(self.service, protocol)
+        request = {'command': 'subscribe', 'client_id': client_id, 'session_id': client_id, 'channels': [1]}
+        if compression:
+            request['compression'] = compression
+        connector.processMessage(json.dumps(request))
+        connector.client.buffered = None # as if the subscribe webhook had answered
+        return connector
+        
+    def _messages(self, data):
+        return [self._inflate(json.loads(frame)) for frame in filter(None, data.split('\0'))]
+        
+    def _inflate(self, message):
+        if 'deflate' in message:
+            inflated = json.loads(zlib.decompress(base64.b64decode(message['deflate'])))
+            self.assertEqual(message['id'], inflated['id'])
+            return inflated
+        return message
+        
+    def testLargeMessagesAreDeflatedForClientsAskingForIt(self):
+        compressing, plain = self._connect(1, 'deflate'), self._connect(2)
+        self.service.broadcast({'type': 'to_clients', 'client_ids': [1, 2], 'body': self.BODY})
+        self.assertTrue('"deflate"' in compressing.transport.value())
+        self.assertTrue(len(compressing.transport.value()) < len(plain.transport.value()) / 4)
+        self.assertFalse('"deflate"' in plain.transport.value())
+        self.assertEqual(self._messages(plain.transport.value()), self._messages(compressing.transport.value()))
+        
+    def testSmallMessagesStayPlain(self):
+        connector = self._connect(1, 'deflate')
+        self.service.broadcast({'type': 'to_clients', 'client_ids': [1], 'body': 'short'})
+        self.assertEqual(['short'], [json.loads(frame)['body'] for frame in filter(None, connector.transport.value().split('\0'))])
+        
+    def testUnknownMethodLeavesMessagesPlain(self):
+        connector = self._connect(1, 'brotli')
+        self.assertFalse(connector.compression)
+        
+    def testCompressedOnceForAllRecipients(self):
+        msg = juggernaut.Message(self.BODY)
+        self.assertTrue(msg.compressedFrame() is msg.compressedFrame())
+        self.assertTrue(msg.compressed().endswith('"}') and '\0' not in msg.compressed())
+        
+    def testWebSocketClientsGetDeflatedTextFrames(self):
+        connector = self._connect(1, 'deflate', juggernaut.JuggernautWebSocketProtocol)
+        self.service.broadcast({'type': 'to_clients', 'client_ids': [1], 'body': self.BODY})
+        decoder = websocket.WebSocketFrameDecoder(masked=False)
+        messages = [self._inflate(json.loads(payload)) for opcode, payload in decoder.feed(connector.transport.value())]
+        self.assertEqual([self.BODY], [message['body'] for message in messages])
+        
+    def testBatchedBroadcastsAreDeflated(self):
+        connector = self._connect(1, 'deflate')
+        self.service.broadcast({'type': 'batch', 'broadcasts': [{'client_ids': [1], 'body': self.BODY}, {'client_ids': [1], 'body': 'short'}]})
+        self.assertEqual(1, connector.transport.value().count('"deflate"'))
+        self.assertEqual([self.BODY, 'short'], [message['body'] for message in self._messages(connector.transport.value())])
+        
+    def testBytesSentCountDeflatedFrames(self):
+        compressing, plain = self._connect(1, 'deflate'), self._connect(2)
+        self.service.broadcast({'type': 'to_clients', 'client_ids': [1, 2], 'body': self.BODY})
+        self.assertEqual(len(compressing.transport.value()) + len(plain.transport.value()), 
+            self.service.metrics.snapshot()['message_bytes_sent'])
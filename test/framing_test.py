@@ -0,0 +1,64 @@
+from twisted.trial import unittest
+from twisted.internet import defer, reactor
+from juggernaut.framing import NulFrameDecoder, FrameTooLarge
+
+import sys
+sys.path.append('test')
+from test_helper import *
+
+class NulFrameDecoderTest(unittest.TestCase):
+    
+    def testFramesSplitAcrossChunks(self):
+        decoder = NulFrameDecoder()
+        self.assertEqual([], decoder.feed('{"comm'))
+        self.assertEqual([], decoder.feed('and": 1'))
+        self.assertEqual(['{"command": 1}', 'second'], decoder.feed('}\0second\0thi'))
+        self.assertEqual(3, decoder.pending())
+        self.assertEqual(['third'], decoder.feed('rd\0'))
+        self.assertEqual(0, decoder.pending())
+        
+    def testByteByByte(self):
+        decoder = NulFrameDecoder()
+        frames = []
+        for byte in 'first\0second\0':
+            frames.extend(decoder.feed(byte))
+        self.assertEqual(['first', 'second'], frames)
+        
+    def testOversizedFrameIsDropped(self):
+        decoder = NulFrameDecoder(5, NulFrameDecoder.DROP)
+        self.assertEqual(['ok'], decoder.feed('ok\0too long\0'))
+        self.assertEqual([], decoder.feed('long'))
+        self.assertEqual([], decoder.feed('er and longer'))
+        self.assertEqual(['fine'], decoder.feed('\0fine\0'))
+        self.assertEqual(2, decoder.dropped)
+        self.flushLoggedErrors()
+        
+    def testOversizedFrameStopsDecoding(self):
+        decoder = NulFrameDecoder(5)
+        self.assertEqual([], decoder.feed('1234'))
+        self.assertEqual([], decoder.feed('56'))
+        self.assertTrue(isinstance(decoder.oversized, FrameTooLarge))
+        self.assertEqual([], decoder.feed('\0ok\0'))
+        
+    def testFramesBeforeOversizedOneAreReturned(self):
+        decoder = NulFrameDecoder(5)
+        self.assertEqual(['ok', 'fine'], decoder.feed('ok\0fine\0too long\0next\0'))
+        self.assertTrue(isinstance(decoder.oversized, FrameTooLarge))
+        self.assertEqual([], decoder.feed('more\0'))
+        
+class OversizedFrameTest(JuggernautTest):
+    
+    def testOversizedFrameDisconnects(self):
+        self.config['max_frame_size'] = 10
+        client = MockFlashClient(1)
+        client.connectedEvent.addCallback(lambda _: client.connector.transport.write('x' * 11))
+        
+        return client.disconnectedEvent
+        
+    def testFramesBeforeOversizedOneAreProcessed(self):
+        self.config['max_frame_size'] = 30
+        connector = connectProtocol(self.service)
+        connector.dataReceived('<policy-file-request/>\0' + 'x' * 31 + '\0')
+        self.assertEqual(self.service.policy_file, connector.transport.value())
+        self.assertTrue(connector.transport.disconnecting)
+        self.assertEqual(1, self.service.metrics.snapshot()['frames_received'])
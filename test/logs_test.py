@@ -0,0 +1,45 @@
+from twisted.trial import unittest
+from twisted.python import log
+from juggernaut.logs import Logger, DEBUG, WARNING
+
+class Formatted:
+    def __init__(self):
+        self.count = 0
+        
+    def __str__(self):
+        self.count += 1
+        return 'formatted'
+
+class LoggerTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.messages = []
+        log.addObserver(self._observe)
+        
+    def tearDown(self):
+        log.removeObserver(self._observe)
+        
+    def _observe(self, event):
+        if not event.get('isError'):
+            self.messages.append(log.textFromEventDict(event))
+        
+    def testDisabledLevelsAreNotFormatted(self):
+        logger = Logger('warning')
+        arg = Formatted()
+        logger.debug("debug %s", arg)
+        logger.info("info %s", arg)
+        logger.warning("warning %s", arg)
+        self.assertEqual(['warning formatted'], self.messages)
+        self.assertEqual(1, arg.count)
+        self.assertFalse(logger.enabled(DEBUG))
+        self.assertTrue(logger.enabled(WARNING))
+        
+    def testDebugSampling(self):
+        logger = Logger('debug', 0.25)
+        for i in range(8):
+            logger.debug("message %d", i)
+        self.assertEqual(['message 3', 'message 7'], self.messages)
+        
+    def testInvalidConfiguration(self):
+        self.assertRaises(ValueError, Logger, 'verbose')
+        self.assertRaises(ValueError, Logger, 'info', 0)
@@ -0,0 +1,69 @@
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+from juggernaut.metrics import Registry, StatsResource, mergeSnapshots
+import juggernaut
+
+import sys
+sys.path.append('test')
+from test_helper import *
+
+class RegistryTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.registry = Registry()
+        
+    def testHistogramBuckets(self):
+        histogram = self.registry.histogram('latency', [0.1, 1])
+        for value in [0.05, 0.1, 0.5, 5]:
+            histogram.observe(value)
+        snapshot = self.registry.snapshot()['latency']
+        self.assertEqual([[0.1, 2], [1, 3], ['+Inf', 4]], snapshot['buckets'])
+        self.assertEqual(4, snapshot['count'])
+        self.assertIs(histogram, self.registry.histogram('latency'))
+        
+    def testTextFormat(self):
+        self.registry.counter('frames').inc(3)
+        self.registry.gauge('clients', lambda: 2)
+        self.registry.histogram('size', [10]).observe(5)
+        self.assertEqual('clients 2\nframes 3\nsize_bucket{le="10"} 1\nsize_bucket{le="+Inf"} 1\nsize_sum 5\nsize_count 1\n', 
+            self.registry.text())
+            
+    def testMergeSnapshots(self):
+        other = Registry()
+        for registry, value in [(self.registry, 1), (other, 20)]:
+            registry.counter('frames').inc(value)
+            registry.histogram('size', [10]).observe(value)
+        merged = mergeSnapshots([self.registry.snapshot(), other.snapshot(), None])
+        self.assertEqual(21, merged['frames'])
+        self.assertEqual([[10, 1], ['+Inf', 2]], merged['size']['buckets'])
+        
+    def testStatsResource(self):
+        self.registry.counter('frames').inc()
+        request = DummyRequest([''])
+        request.args = {'format': ['json']}
+        self.assertEqual({'frames': 1}, json.loads(StatsResource(self.registry).render_GET(request)))
+        self.assertEqual('frames 1\n', StatsResource(self.registry).render_GET(DummyRequest([''])))
+
+class ServiceMetricsTest(JuggernautTest):
+    
+    def testBroadcastAndWebhookMetrics(self):
+        self.webServer.expectRequests(3)
+        client = MockFlashClient(1)
+        rails = MockFlashClient()
+        client.connectedEvent.addCallback(lambda _: client.sendSubscribeMessage())
+        reactor.callLater(0.1, rails.sendBroadcastToChannelsMessage, "hello", [1])
+        
+        def assertMetrics(*a):
+            stats = juggernaut.ResponseCollector()
+            self.service.query({'type': 'stats'}, stats)
+            stats = stats.response
+            self.assertEqual(1, stats['broadcasts'])
+            self.assertEqual(1, stats['messages_sent'])
+            self.assertEqual(1, stats['clients_connected'])
+            self.assertEqual(2, stats['frames_received'])
+            self.assertEqual(1, stats['webhook_subscribe_seconds']['count'])
+            client.connector.disconnect()
+            rails.connector.disconnect()
+        d = task.deferLater(reactor, 0.2, assertMetrics)
+        
+        return defer.DeferredList([client.disconnectedEvent, rails.disconnectedEvent, d])
@@ -113,6 +113,25 @@ class QueryTest(JuggernautTest):
         
         return self.client.disconnectedEvent
     
+    def testShowClientsBySession(self):
+        self.webServer.expectRequests(3)
+        reactor.callLater(0.2, self.rails.sendMessage, {'command': 'query', 'type': 'show_clients', 'session_ids': [1, 5]})
+        reactor.callLater(0.25, self._assertResponse, [{ 'client_id': 1, 'session_id': 1, "num_connections": 1 }])
+        reactor.callLater(0.3, self.client.connector.disconnect)
+        return self.client.disconnectedEvent
+        
+    def testShowChannelCounts(self):
+        self.webServer.expectRequests(6)
+        client2 = MockFlashClient(2)
+        reactor.callLater(0.1, client2.sendSubscribeMessage, [1])
+        reactor.callLater(0.2, self.rails.sendMessage, {'command': 'query', 'type': 'show_channel_counts'})
+        reactor.callLater(0.25, self._assertResponse, {'1': 2})
+        reactor.callLater(0.25, self.rails.sendMessage, {'command': 'query', 'type': 'show_channel_counts', 'channels': [1, 2]})
+        reactor.callLater(0.3, self._assertResponse, {'1': 2, '2': 0})
+        reactor.callLater(0.35, self.client.connector.disconnect)
+        reactor.callLater(0.35, client2.connector.disconnect)
+        return defer.DeferredList([self.client.disconnectedEvent, client2.disconnectedEvent])
+    
     def _sendRemoveChannelsMessage(self, client_ids, channels):
         self.rails.sendMessage({
             'command': 'query',
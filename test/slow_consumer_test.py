@@ -0,0 +1,68 @@
+from twisted.internet import defer
+import juggernaut
+
+import sys, json
+sys.path.append('test')
+from test_helper import ServiceTest
+
+class SlowConsumerTest(ServiceTest):
+    options = {'write_buffer_limit': 120}
+    
+    def _broadcast(self, bodies, client_ids):
+        for body in bodies:
+            self.service.broadcast({'type': 'to_clients', 'client_ids': client_ids, 'body': body})
+        
+    def _bodies(self, data):
+        return [json.loads(frame)['body'] for frame in filter(None, data.split('\0'))]
+        
+    def testPausedConnectionQueuesUntilResumed(self):
+        connector = self._connect(1)
+        self.assertEqual(connector, connector.transport.producer)
+        connector.pauseProducing()
+        self._broadcast(['first', 'second'], [1])
+        self.assertEqual('', connector.transport.value())
+        connector.resumeProducing()
+        self.assertEqual(['first', 'second'], self._bodies(connector.transport.value()))
+        
+    def testQueuedFramesGoBeforeHeldBackMessagesOnReconnect(self):
+        self.service.webhooks.post = lambda url, params: defer.Deferred()
+        connector = self._connect(1)
+        connector.pauseProducing()
+        self._broadcast(['queued'], [1])
+        self.service.subscribeRequest(connector.client, [1]) # the webhook stays in flight
+        self._broadcast(['held back'], [1])
+        connector.connectionLost(None)
+        reconnected = self._connect(1)
+        self.assertEqual(['queued', 'held back'], self._bodies(reconnected.transport.value()))
+        
+    def testDropOldestAtHighWaterMark(self):
+        connector = self._connect(1)
+        connector.pauseProducing()
+        self._broadcast(['a' * 30, 'b' * 30, 'c' * 30], [1])
+        connector.resumeProducing()
+        self.assertEqual(['b' * 30, 'c' * 30], self._bodies(connector.transport.value()))
+        self.assertEqual(1, connector.queue.dropped)
+        
+    def testDisconnectFallsBackToStoredMessages(self):
+        self.config['slow_consumer_policy'] = 'disconnect'
+        connector = self._connect(1)
+        connector.pauseProducing()
+        self._broadcast(['a' * 30, 'b' * 30, 'c' * 30], [1])
+        self.assertTrue(connector.transport.disconnecting)
+        connector.connectionLost(None)
+        
+        client = self.service.clients[1]
+        self.assertFalse(client.is_alive)
+        reconnected = self._connect(1)
+        self.assertEqual(['a' * 30, 'b' * 30, 'c' * 30], self._bodies(reconnected.transport.value()))
+        
+    def testShowBuffers(self):
+        slow, fast = self._connect(1), self._connect(2)
+        slow.pauseProducing()
+        self._broadcast(['a' * 30], [1, 2])
+        collector = juggernaut.ResponseCollector()
+        self.service.query_show_buffers({'type': 'show_buffers'}, collector)
+        buffers = dict((buf['client_id'], buf) for buf in collector.response)
+        self.assertTrue(buffers[1]['paused'])
+        self.assertEqual(len(slow.queue.frames[0]), buffers[1]['queued_bytes'])
+        self.assertEqual(0, buffers[2]['queued_bytes'])
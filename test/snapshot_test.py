@@ -0,0 +1,76 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+import juggernaut
+
+import sys, json, os
+sys.path.append('test')
+from test_helper import TestConfig, connectProtocol
+
+class SnapshotTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.config = dict(TestConfig.config, snapshot_path=self.mktemp(), snapshot_grace=5)
+        self.services = []
+        self.posted = []
+        
+    def tearDown(self):
+        return defer.DeferredList([service.stopService() for service in self.services])
+        
+    def _startService(self):
+        service = juggernaut.JuggernautService(dict(self.config))
+        service.webhooks.post = lambda url, params: self.posted.append(url) or defer.Deferred()
+        service.startService()
+        self.services.append(service)
+        return service
+        
+    def _connect(self, service, client_id, session_id=None, channel_id=1):
+        connector = connectProtocol(service)
+        connector.dataReceived(json.dumps({'command': 'subscribe', 'client_id': client_id, 
+            'session_id': session_id or client_id, 'channels': [channel_id]}) + '\0')
+        return connector
+        
+    def _admit(self, service, client_id):
+        connector = connectProtocol(service)
+        connector.client = service.findOrCreateClient(connector, client_id, client_id, 1)
+        service.addToChannel(connector.client, 1)
+        return connector
+        
+    def _bodies(self, connector):
+        return [json.loads(frame)['body'] for frame in filter(None, connector.transport.value().split('\0'))]
+        
+    def _restart(self):
+        self.services[0].stopService()
+        del(self.posted[:])
+        return self._startService()
+        
+    def testClientsAreRestoredWithStoredMessages(self):
+        service = self._startService()
+        self._admit(service, 1)
+        self._admit(service, 2).connectionLost(None)
+        service.broadcast({'type': 'to_channels', 'channels': [1], 'body': 'kept'})
+        last_id = juggernaut.Message.current_id
+        
+        restarted = self._restart()
+        self.assertEqual(set([1, 2]), set(restarted.clients.keys()))
+        self.assertEqual(2, len(restarted.channels[1]))
+        self.assertFalse(any(client.is_alive for client in restarted.clients.values()))
+        self.assertTrue(juggernaut.Message.current_id >= last_id)
+        self.assertFalse(os.path.exists(self.config['snapshot_path']))
+        
+        connector = self._connect(restarted, 2)
+        self.assertEqual(['kept'], self._bodies(connector))
+        self.assertTrue(restarted.clients[2].is_alive)
+        self.assertEqual([], self.posted)
+        
+    def testDifferentSessionGoesThroughWebhook(self):
+        service = self._startService()
+        self._admit(service, 1)
+        restarted = self._restart()
+        self._connect(restarted, 1, session_id=7)
+        self.assertEqual([self.config['subscription_url']], self.posted)
+        self.assertEqual({}, restarted.restored)
+        
+    def testMissingOrCorruptSnapshotStartsEmpty(self):
+        open(self.config['snapshot_path'], 'wb').write('garbage')
+        service = self._startService()
+        self.assertEqual({}, service.clients)
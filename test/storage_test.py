@@ -0,0 +1,83 @@
+from twisted.trial import unittest
+from juggernaut.storage import MessageStore, WriteQueue, ChannelHistory, HistoryCache
+
+class MessageStoreTest(unittest.TestCase):
+    
+    def testDropsOldestAboveMessageLimit(self):
+        store = MessageStore(max_messages=2)
+        for frame in ['1\0', '2\0', '3\0']:
+            store.append(frame)
+        self.assertEqual(2, len(store))
+        self.assertEqual(1, store.dropped)
+        self.assertEqual('2\0003\0', store.flush())
+        self.assertEqual(0, len(store))
+        
+    def testDropsOldestAboveByteLimit(self):
+        store = MessageStore(max_bytes=10)
+        store.append('12345\0')
+        store.append('1234\0')
+        self.assertEqual(1, store.dropped)
+        self.assertEqual(6, store.dropped_bytes)
+        store.append('1234\0')
+        self.assertEqual(1, store.dropped)
+        self.assertEqual(10, store.bytes)
+        store.append('0123456789\0') # does not fit at all
+        self.assertEqual(2, store.dropped)
+        self.assertEqual('1234\0' * 2, store.flush())
+
+        
+class WriteQueueTest(unittest.TestCase):
+    
+    def testDropOldest(self):
+        queue = WriteQueue(10, WriteQueue.DROP_OLDEST)
+        for frame in ['1234\0', '5678\0', 'abcd\0']:
+            self.assertTrue(queue.append(frame))
+        self.assertEqual(1, queue.dropped)
+        self.assertEqual('5678\0abcd\0', queue.flush())
+        
+    def testCoalesceKeepsNewest(self):
+        queue = WriteQueue(10, WriteQueue.COALESCE)
+        for frame in ['1234\0', '5678\0', 'abcd\0']:
+            self.assertTrue(queue.append(frame))
+        self.assertEqual(2, queue.dropped)
+        self.assertEqual('abcd\0', queue.flush())
+        
+    def testDisconnectReportsOverflow(self):
+        queue = WriteQueue(10, WriteQueue.DISCONNECT)
+        self.assertTrue(queue.append('1234\0'))
+        self.assertTrue(queue.append('5678\0'))
+        self.assertFalse(queue.append('abcd\0'))
+        self.assertEqual(3, len(queue)) # nothing is dropped, the frames go to the stored messages
+        self.assertRaises(ValueError, WriteQueue, 10, 'block')
+
+        
+class HistoryTest(unittest.TestCase):
+    
+    def testSince(self):
+        history = ChannelHistory(3, None)
+        for id in range(5):
+            history.append(id, '%d\0' % id)
+        self.assertEqual(3, len(history))
+        self.assertEqual('3\0004\0', history.since(2))
+        self.assertEqual('2\0003\0004\0', history.since(0))
+        self.assertEqual('', history.since(4))
+        
+    def testSinceWithStripedIds(self):
+        history = ChannelHistory(10, None)
+        for id in [0, 2, 4, 1]: # 1 relayed from another worker after the local 4
+            history.append(id, '%d\0' % id)
+        self.assertEqual('4\0001\0', history.since(2))
+        self.assertEqual('1\0', history.since(4))
+        self.assertEqual('4\0', history.since(3))
+        self.assertEqual('0\0002\0004\0001\0', history.since(-1))
+        
+    def testLeastRecentlyUsedChannelIsDropped(self):
+        cache = HistoryCache(10, None, 12, {3: 0})
+        cache.record(1, 1, '12345\0')
+        cache.record(2, 2, '1234\0')
+        cache.record(3, 3, '1234\0') # history disabled for channel 3
+        self.assertEqual(11, cache.bytes)
+        cache.record(1, 4, '1\0') # channel 2 is now the least recently used one
+        self.assertEqual(8, cache.bytes)
+        self.assertEqual('', cache.since(2, 0))
+        self.assertEqual('12345\0001\0', cache.since(1, 0))
@@ -157,4 +157,55 @@ class SubscribeTest(JuggernautTest):
         reactor.callLater(0.06, connectAnotherClient, reconnecting_client)
         
         return reconnecting_client.disconnectedEvent
-        
\ No newline at end of file
+        
+            
+    def testMessagesRenderedBySubscribeAction(self):
+        '''Messages sent while the subscribe webhook is in flight are held back and sent, ordered by id, 
+        together with the messages rendered by the subscribe action'''
+        self.webServer.expectRequests(3)
+        def onRequest((request, counter)):
+            if counter == 0:
+                request.write(json.dumps(['welcome', {'state': 1}]))
+                task.deferLater(reactor, 0.1, request.finish)
+            else:
+                request.finish()
+        self.webServer.requestHandler = onRequest
+        
+        client = MockFlashClient(1)
+        rails = MockFlashClient()
+        client.connectedEvent.addCallback(lambda _: client.sendSubscribeMessage())
+        reactor.callLater(0.05, rails.sendBroadcastToClientsMessage, 'to client', [1])
+        reactor.callLater(0.05, rails.sendBroadcastToChannelsMessage, 'to channel', [1])
+        reactor.callLater(0.2, rails.sendBroadcastToChannelsMessage, 'live', [1])
+        
+        def assertMessagesArrived(*a):
+            messages = map(json.loads, client.connector.transport.protocol.messages)
+            self.assertEqual(['to client', 'to channel', 'welcome', {'state': 1}, 'live'], [msg['body'] for msg in messages])
+            self.assertEqual(sorted(msg['id'] for msg in messages), [msg['id'] for msg in messages])
+            client.connector.disconnect()
+            rails.connector.disconnect()
+        d = task.deferLater(reactor, 0.3, assertMessagesArrived)
+        
+        return defer.DeferredList([client.disconnectedEvent, rails.disconnectedEvent, d])
+
+class HeldBackMessagesTest(ServiceTest):
+    
+    def setUp(self):
+        ServiceTest.setUp(self)
+        # ids striped as in the first of two workers
+        self.patch(juggernaut.Message, 'current_id', 4)
+        self.patch(juggernaut.Message, 'id_step', 2)
+        self.response = defer.Deferred()
+        self.service.webhooks.post = lambda url, params: self.response
+        
+    def testArrivalOrderIsKeptWithStripedIds(self):
+        connector = connectProtocol(self.service)
+        connector.dataReceived(json.dumps({'command': 'subscribe', 'client_id': 1, 'session_id': 1, 'channels': [1]}) + '\0')
+        self.service.broadcast({'type': 'to_channels', 'channels': [1], 'body': 'relayed'}, 1)
+        self.service.broadcast({'type': 'to_clients', 'client_ids': [1], 'body': 'direct'})
+        self.service.broadcast({'type': 'to_channels', 'channels': [1], 'body': 'relayed later'}, 3)
+        self.assertEqual('', connector.transport.value())
+        self.response.callback('["welcome"]')
+        messages = [json.loads(frame) for frame in filter(None, connector.transport.value().split('\0'))]
+        self.assertEqual(['relayed', 'direct', 'relayed later', 'welcome'], [msg['body'] for msg in messages])
+        self.assertEqual([1, 4, 3, 6], [msg['id'] for msg in messages])
@@ -1,12 +1,15 @@
 from twisted.trial import unittest
-from twisted.internet import protocol, defer
+from twisted.internet import protocol, defer, task
 from twisted.internet import reactor
+from twisted.protocols import policies
+from twisted.test import proto_helpers
 from twisted.web import resource, server
 import juggernaut
+from juggernaut import websocket
 from twisted.python import log
 from twisted.trial.unittest import FailTest
 
-import json, re
+import json, re, os
 
 class JuggernautTest(unittest.TestCase):
     timeout = 5
@@ -16,27 +19,73 @@ class JuggernautTest(unittest.TestCase):
         self.service = juggernaut.makeService(self.config)
         factory = juggernaut.IJuggernautFactory(self.service)
         self.listeningPort = reactor.listenTCP(self.config['port'], factory)
+        self.webSocketPort = reactor.listenTCP(self.config['websocket_port'], juggernaut.IJuggernautWebSocketFactory(self.service))
         
         self.webServer = MockWebServer()
         
     def tearDown(self):
         d = self.webServer.getAllRequests(
             ).addCallback(self.listeningPort.stopListening
-            ).addCallback(self.webServer.connector.stopListening)
+            ).addCallback(self.webSocketPort.stopListening
+            ).addCallback(lambda _: self.service.stopService()
+            ).addCallback(self.webServer.stopListening)
         return d
     
+    def _rebuildService(self):
+        '''Build the service again, needed after changing options which are read when the service is created'''
+        self.service = juggernaut.makeService(self.config)
+        self.listeningPort.factory.service = self.service
+        self.webSocketPort.factory.service = self.service
+        
     def _assertClientIsConnected(self, client):
         self.assertEqual('connected', client.connector.state)
 
+class ServiceTest(unittest.TestCase):
+    '''Service built from TestConfig updated with options. Nothing listens, connections are made by hand 
+    over in-memory transports'''
+    options = {}
+    
+    def setUp(self):
+        self.config = dict(TestConfig.config, **self.options)
+        self.service = juggernaut.JuggernautService(self.config)
+        
+    def tearDown(self):
+        return self.service.stopService()
+        
+    def _connect(self, client_id, protocol=juggernaut.JuggernautProtocol, transport=None):
+        '''Connection of an alive client, not in any channel yet'''
+        connector = connectProtocol(self.service, protocol, transport)
+        connector.client = self.service.findOrCreateClient(connector, client_id, client_id, 1)
+        return connector
+
+class StubFactory:
+    '''Factory of a protocol connected by hand, the protocol only needs the service from it'''
+    def __init__(self, service):
+        self.service = service
+
+def connectProtocol(service, protocol=juggernaut.JuggernautProtocol, transport=None):
+    '''Protocol of the service connected to transport, a StringTransport by default. WebSocket connections 
+    start with the handshake done'''
+    connector = protocol()
+    if issubclass(protocol, juggernaut.JuggernautWebSocketProtocol):
+        connector.handshake = None
+    connector.factory = StubFactory(service)
+    if transport is None:
+        transport = proto_helpers.StringTransport()
+    connector.makeConnection(transport)
+    return connector
+
 class TestConfig:
     config = {
         'host': 'localhost',
         'port': 5002,
+        'websocket_port': 5004,
         'allowed_ips': ['127.0.0.1'],
         'subscription_url': 'http://localhost:8080/subscribe',
         'logout_connection_url': 'http://localhost:8080/disconnected',
         'logout_url': 'http://localhost:8080/logged_out',
-        'timeout': 0.02
+        'timeout': 0.02,
+        'timer_resolution': 0.005
     }
 
 class ClientProtocol(protocol.Protocol):
@@ -55,7 +104,10 @@ class ClientProtocol(protocol.Protocol):
             self.buffer = split.pop()
     
         for message in split:
-            self.messages.append(message)
+            self.messageReceived(message)
+            
+    def messageReceived(self, message):
+        self.messages.append(message)
         
     def connectionMade(self):
         self.factory.onConnectionMade.callback(self)
@@ -64,15 +116,53 @@ class ClientProtocol(protocol.Protocol):
         self.factory.onConnectionLost.callback(self)
         
 
+class WebSocketClientProtocol(protocol.Protocol):
+    '''Loopback WebSocket client, collects payloads of received text messages in messages'''
+    
+    def __init__(self):
+        self.handshake = ""
+        self.messages = []
+        self.pongs = []
+        self.decoder = websocket.WebSocketFrameDecoder(masked=False)
+        
+    def connectionMade(self):
+        self.key = websocket.newKey()
+        self.transport.write(websocket.handshakeRequest(TestConfig.config['host'], TestConfig.config['websocket_port'], self.key))
+        
+    def dataReceived(self, data):
+        if self.handshake is not None:
+            self.handshake += data
+            if not '\r\n\r\n' in self.handshake:
+                return
+            response, data = self.handshake.split('\r\n\r\n', 1)
+            self.handshake = None
+            if not 'Sec-WebSocket-Accept: %s' % websocket.acceptKey(self.key) in response:
+                raise FailTest("Invalid handshake response %s" % response)
+            self.factory.onConnectionMade.callback(self)
+            
+        for opcode, payload in self.decoder.feed(data):
+            if opcode == websocket.TEXT:
+                self.messages.append(payload)
+            elif opcode == websocket.PONG:
+                self.pongs.append(payload)
+            
+    def send(self, payload, opcode=websocket.TEXT):
+        self.transport.write(websocket.encodeFrame(payload, opcode, os.urandom(4)))
+        
+    def connectionLost(self, *a):
+        self.factory.onConnectionLost.callback(self)
+
 class MockFlashClient:
-    def __init__(self, client_id=None):
+    protocol = ClientProtocol
+    
+    def __init__(self, client_id=None, host=None, port=None):
         factory = protocol.ClientFactory()
-        factory.protocol = ClientProtocol
+        factory.protocol = self.protocol
         self.connectedEvent = defer.Deferred()
         self.disconnectedEvent = defer.Deferred()
         factory.onConnectionMade = self.connectedEvent 
         factory.onConnectionLost = self.disconnectedEvent 
-        self.connector = reactor.connectTCP(TestConfig.config['host'], TestConfig.config['port'], factory)
+        self.connector = reactor.connectTCP(host or TestConfig.config['host'], port or TestConfig.config['port'], factory)
         
         self.id = client_id
         
@@ -116,11 +206,34 @@ class MockFlashClient:
         self.connector.transport.write(self.broadcastToClientsMessage(body, clients))
     
         
+class MockWebSocketClient(MockFlashClient):
+    '''Talks the same protocol as MockFlashClient, but over WebSocket'''
+    def __init__(self, client_id=None, host=None, port=None):
+        factory = protocol.ClientFactory()
+        factory.protocol = WebSocketClientProtocol
+        self.connectedEvent = defer.Deferred()
+        self.disconnectedEvent = defer.Deferred()
+        factory.onConnectionMade = self.connectedEvent 
+        factory.onConnectionLost = self.disconnectedEvent 
+        self.connector = reactor.connectTCP(host or TestConfig.config['host'], port or TestConfig.config['websocket_port'], factory)
+        
+        self.id = client_id
+        
+    def sendMessage(self, msg):
+        self.connector.transport.protocol.send(json.dumps(msg))
+        
+    def sendSubscribeMessage(self, channels=[1]):
+        self.subscribeMessage(self.id, channels)
+        
 class ChildResource(resource.Resource):
     def __init__(self, webserver):
         self.webserver = webserver
         
     def render_POST(self, request):
+        if self.webserver.autoRespond:
+            path = request.prePathURL().split('/')[-1]
+            self.webserver.received[path] = self.webserver.received.get(path, 0) + 1
+            return self.webserver.autoRespond(request)
         if self.webserver.counter >= len(self.webserver.deferList):
             raise FailTest("Request not expected %s!" % str(request))
         self.webserver.requests.append(request)
@@ -138,14 +251,19 @@ class ChildResource(resource.Resource):
         return server.NOT_DONE_YET
 
 class MockWebServer:
-    def __init__(self):
+    '''Expects the requests announced with expectRequests. With autoRespond, a function returning the 
+    response body, it answers any number of requests and counts them by path in received instead'''
+    def __init__(self, port=8080, autoRespond=None):
         res = resource.Resource()
         self.requestHandler = None
         res.putChild('subscribe', ChildResource(self))
         res.putChild('disconnected', ChildResource(self))
         res.putChild('logged_out', ChildResource(self))
         self.site = server.Site(res)
-        self.connector = reactor.listenTCP(8080, self.site)
+        self.factory = policies.WrappingFactory(self.site)
+        self.connector = reactor.listenTCP(port, self.factory)
+        self.autoRespond = autoRespond
+        self.received = {}
         
         self.return200s = False
         self.counter = 0
@@ -160,6 +278,13 @@ class MockWebServer:
 
     def getNFirstRequests(self, num):
         return defer.DeferredList(self.deferList[0:num])
+        
+    def stopListening(self, *a):
+        '''Stop listening and wait until clients close their keep-alive connections'''
+        def waitForConnections(_):
+            if self.factory.protocols:
+                return task.deferLater(reactor, 0.01, waitForConnections, None)
+        return defer.maybeDeferred(self.connector.stopListening).addCallback(waitForConnections)
     
 def errorHandler(a):
     log.err(str(a))
\ No newline at end of file
@@ -0,0 +1,48 @@
+from twisted.trial import unittest
+from twisted.internet import task, error
+from juggernaut.timers import TimerWheel
+
+class TimerWheelTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = TimerWheel(0.1, self.clock)
+        self.called = []
+        
+    def testDeadlineIsRoundedUp(self):
+        self.clock.advance(0.05)
+        self.wheel.schedule(1, self.called.append, 1)
+        self.wheel.schedule(1.02, self.called.append, 2)
+        self.assertEqual(1, len(self.clock.getDelayedCalls())) # both land in the same bucket
+        self.clock.advance(1) # both deadlines are rounded up to 1.1
+        self.assertEqual([], self.called)
+        self.clock.advance(0.06)
+        self.assertEqual([1, 2], sorted(self.called))
+        self.assertEqual(0, len(self.wheel))
+        self.assertEqual([], self.clock.getDelayedCalls())
+        
+    def testCancel(self):
+        first = self.wheel.schedule(1, self.called.append, 1)
+        self.wheel.schedule(2, self.called.append, 2)
+        first.cancel()
+        self.assertFalse(first.active())
+        self.assertRaises(error.AlreadyCancelled, first.cancel)
+        self.assertEqual(1, len(self.wheel))
+        self.clock.advance(1)
+        self.assertEqual([], self.called)
+        self.clock.advance(1)
+        self.assertEqual([2], self.called)
+        
+    def testEarlierDeadlineReschedules(self):
+        self.wheel.schedule(5, self.called.append, 5)
+        self.wheel.schedule(1, self.called.append, 1)
+        self.clock.advance(1)
+        self.assertEqual([1], self.called)
+        self.clock.advance(4)
+        self.assertEqual([1, 5], self.called)
+        
+    def testStop(self):
+        timer = self.wheel.schedule(1, self.called.append, 1)
+        self.wheel.stop()
+        self.assertFalse(timer.active())
+        self.assertEqual([], self.clock.getDelayedCalls())
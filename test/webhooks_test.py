@@ -0,0 +1,155 @@
+from twisted.python import log
+from twisted.internet import protocol, defer, task, reactor
+import juggernaut
+from juggernaut.webhooks import WebhookClient
+from twisted.web import client as web_client
+
+import sys
+sys.path.append('test')
+from test_helper import *
+
+class WebhooksTest(JuggernautTest):
+    
+    def testConnectionIsReused(self):
+        '''subscribe, disconnected and logged_out requests should all go through a single connection'''
+        self.webServer.expectRequests(3)
+        
+        client = MockFlashClient(1)
+        client.connectedEvent.addCallback(lambda _: client.sendSubscribeMessage())
+        task.deferLater(reactor, 0.05, client.connector.disconnect)
+        
+        def assertConnectionReused(*a):
+            stats = self.service.webhooks.stats()
+            self.assertEqual(1, stats['connections_created'])
+            self.assertEqual(2, stats['connections_reused'])
+            self.assertEqual(1, stats['urls'][self.config['subscription_url']]['requests'])
+            self.assertEqual(1, stats['urls'][self.config['logout_url']]['requests'])
+        d = self.webServer.getAllRequests().addCallback(assertConnectionReused)
+        
+        return defer.DeferredList([client.disconnectedEvent, d])
+        
+    def testConcurrencyLimit(self):
+        '''With the limit of 1, the second subscribe request waits until the first one is answered'''
+        self.config['webhook_concurrency'] = {self.config['subscription_url']: 1}
+        self._rebuildService()
+        self.webServer.expectRequests(6)
+        
+        def onRequest((request, counter)):
+            if counter == 0:
+                stats = self.service.webhooks.stats()['urls'][self.config['subscription_url']]
+                self.assertEqual(1, stats['queued'])
+                task.deferLater(reactor, 0.05, request.finish)
+            else:
+                request.finish()
+        self.webServer.requestHandler = onRequest
+        
+        clients = map(lambda x: MockFlashClient(x), range(2))
+        task.deferLater(reactor, 0.05, lambda: [client.sendSubscribeMessage() for client in clients])
+        task.deferLater(reactor, 0.2, lambda: [client.connector.disconnect() for client in clients])
+        
+        return defer.DeferredList(map(lambda x: x.disconnectedEvent, clients))
+
+        
+    def testBatchedDisconnects(self):
+        '''Three clients disconnect at once, their disconnected and logged_out events are sent in one request each'''
+        self.config['webhook_batch_window'] = 0.05
+        self._rebuildService()
+        self.webServer.expectRequests(5)
+        
+        def onRequest((request, counter)):
+            if counter >= 3:
+                expected = ['disconnected', 'logged_out'][counter - 3]
+                self.assertEqual(request.prePathURL().split('/')[-1], expected)
+                params = request.content.read().split('&')
+                self.assertEqual(9, len(params))
+                self.assertEqual(['client_id[]=1', 'client_id[]=2', 'client_id[]=3'], sorted(params[0::3]))
+                self.assertEqual(['channels[]=1'] * 3, params[2::3])
+            request.finish()
+        self.webServer.requestHandler = onRequest
+        
+        clients = map(lambda x: MockFlashClient(x), range(1, 4))
+        task.deferLater(reactor, 0.05, lambda: [client.sendSubscribeMessage() for client in clients])
+        task.deferLater(reactor, 0.1, lambda: [client.connector.disconnect() for client in clients])
+        
+        return defer.DeferredList(map(lambda x: x.disconnectedEvent, clients) + [self.webServer.getAllRequests()])
+        
+    def testBatchedSubscribes(self):
+        '''Three clients subscribe to the same channel at once, a single subscribe request is sent for all 
+        of them and the messages it renders reach every client'''
+        self.config['subscribe_batch_window'] = 0.05
+        self.config['subscribe_member_count'] = True
+        self._rebuildService()
+        self.webServer.expectRequests(7)
+        
+        def onRequest((request, counter)):
+            if counter == 0:
+                self.assertEqual(request.prePathURL().split('/')[-1], 'subscribe')
+                params = request.content.read().split('&')
+                self.assertEqual(['client_id[]=1', 'client_id[]=2', 'client_id[]=3'], sorted(params[0:9:3]))
+                self.assertEqual('clients_in_channel_count=0', params[-1])
+                request.write('["welcome"]')
+            request.finish()
+        self.webServer.requestHandler = onRequest
+        
+        clients = map(lambda x: MockFlashClient(x), range(1, 4))
+        task.deferLater(reactor, 0.05, lambda: [client.sendSubscribeMessage() for client in clients])
+        
+        def assertSubscribed(*a):
+            self.assertEqual(3, len(self.service.channels[1]))
+            for client in clients:
+                self.assertEqual(['welcome'], [json.loads(msg)['body'] for msg in client.connector.transport.protocol.messages])
+                client.connector.disconnect()
+        task.deferLater(reactor, 0.2, assertSubscribed)
+        
+        return defer.DeferredList(map(lambda x: x.disconnectedEvent, clients) + [self.webServer.getAllRequests()])
+
+    def testSubscribeListsMembersOfTheNewChannel(self):
+        '''A client moving to another channel gets its members listed, just as a batch of subscribes would'''
+        member = juggernaut.JuggernautClient(None, 1, 10, 5, self.service)
+        self.service.addToChannel(member, 5)
+        moving = juggernaut.JuggernautClient(None, 2, 20, 3, self.service)
+        params = juggernaut.RequestParamsHelper(moving, [5], self.service).subscribeParams()
+        self.assertEqual("client_id=2&session_id=20&channels[]=5&clients_in_channel[-1]=10", params)
+
+class FakeAgent:
+    '''Answers every request with the next of the given results, a deferred that never fires after them'''
+    def __init__(self, *results):
+        self.results = list(results)
+        self.requests = 0
+        
+    def request(self, *a):
+        self.requests += 1
+        if self.results:
+            return defer.fail(self.results.pop(0))
+        return defer.Deferred()
+        
+class WebhookClientTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.clock = task.Clock()
+        
+    def _client(self, agent, **options):
+        client = WebhookClient(dict(TestConfig.config, **options), self.clock)
+        client.agent = agent
+        return client
+        
+    def testOnlyRequestsNeverSentAreRetried(self):
+        agent = FakeAgent(web_client.RequestNotSent(), web_client.ResponseNeverReceived([]))
+        d = self._client(agent).post('http://localhost:8080/subscribe', '')
+        self.assertEqual(2, agent.requests)
+        return self.assertFailure(d, web_client.ResponseNeverReceived)
+        
+    def testUnsafeRetriesAreOptIn(self):
+        agent = FakeAgent(web_client.ResponseNeverReceived([]))
+        self._client(agent, webhook_retry_unsafe=True).post('http://localhost:8080/subscribe', '')
+        self.assertEqual(2, agent.requests)
+        
+    def testCloseGivesUpAfterTimeout(self):
+        client = self._client(FakeAgent(), webhook_shutdown_timeout=5)
+        client.post('http://localhost:8080/subscribe', '')
+        closed = []
+        client.close().addCallback(closed.append)
+        self.clock.advance(4)
+        self.assertEqual([], closed)
+        self.clock.advance(1)
+        self.assertEqual(1, len(closed))
@@ -0,0 +1,88 @@
+from twisted.python import log
+from twisted.internet import protocol, defer, task, reactor
+from twisted.trial import unittest
+import juggernaut
+from juggernaut import websocket
+
+import sys
+sys.path.append('test')
+from test_helper import *
+
+class WebSocketTest(JuggernautTest):
+    
+    def testBroadcastToWebSocketAndFlashClients(self):
+        self.webServer.expectRequests(6)
+        ws_client = MockWebSocketClient(1)
+        flash_client = MockFlashClient(2)
+        rails = MockFlashClient()
+        
+        ws_client.connectedEvent.addCallback(lambda _: ws_client.sendSubscribeMessage())
+        flash_client.connectedEvent.addCallback(lambda _: flash_client.sendSubscribeMessage())
+        reactor.callLater(0.1, rails.sendBroadcastToChannelsMessage, {'text': 'Czesc'}, [1])
+        
+        def assertMessagesArrived(*a):
+            ws_messages = ws_client.connector.transport.protocol.messages
+            flash_messages = flash_client.connector.transport.protocol.messages
+            self.assertEqual(1, len(ws_messages))
+            self.assertEqual(json.loads(flash_messages[0]), json.loads(ws_messages[0]))
+            self.assertEqual({'text': 'Czesc'}, json.loads(ws_messages[0])['body'])
+        d = task.deferLater(reactor, 0.2, assertMessagesArrived)
+        
+        def disconnectClients(*a):
+            for client in [ws_client, flash_client, rails]:
+                client.connector.disconnect()
+        d.addCallback(disconnectClients)
+        
+        return defer.DeferredList([ws_client.disconnectedEvent, flash_client.disconnectedEvent, rails.disconnectedEvent, d])
+        
+    def testPingIsAnswered(self):
+        client = MockWebSocketClient(1)
+        client.connectedEvent.addCallback(lambda p: p.send('are you there?', websocket.PING))
+        
+        def assertPong(*a):
+            self.assertEqual(['are you there?'], client.connector.transport.protocol.pongs)
+            client.connector.disconnect()
+        task.deferLater(reactor, 0.05, assertPong)
+        
+        return client.disconnectedEvent
+        
+    def testInvalidHandshakeDisconnects(self):
+        factory = protocol.ClientFactory()
+        factory.protocol = ClientProtocol
+        factory.onConnectionMade = defer.Deferred()
+        factory.onConnectionLost = defer.Deferred()
+        factory.onConnectionMade.addCallback(lambda p: p.transport.write('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n'))
+        reactor.connectTCP(self.config['host'], self.config['websocket_port'], factory)
+        
+        def assertBadRequest(p):
+            self.assertTrue(p.buffer.startswith('HTTP/1.1 400'))
+        return factory.onConnectionLost.addCallback(assertBadRequest)
+        
+class WebSocketFramingTest(unittest.TestCase):
+    
+    def testFragmentedMaskedMessage(self):
+        key = 'abcd'
+        first = websocket.encodeFrame('{"comm', websocket.TEXT, key)
+        first = chr(ord(first[0]) & 0x7F) + first[1:] # clear FIN bit
+        last = websocket.encodeFrame('and": 1}', websocket.CONTINUATION, key)
+        ping = websocket.encodeFrame('', websocket.PING, key)
+        data = first + ping + last
+        
+        decoder = websocket.WebSocketFrameDecoder()
+        messages = []
+        for byte in data:
+            messages.extend(decoder.feed(byte))
+        self.assertEqual([(websocket.PING, ''), (websocket.TEXT, '{"command": 1}')], messages)
+        
+    def testLongFrameLength(self):
+        payload = 'x' * 70000
+        decoder = websocket.WebSocketFrameDecoder(masked=False)
+        self.assertEqual([(websocket.TEXT, payload)], decoder.feed(websocket.encodeFrame(payload)))
+        
+    def testUnmaskedClientFrameIsRejected(self):
+        decoder = websocket.WebSocketFrameDecoder()
+        self.assertRaises(websocket.WebSocketError, decoder.feed, websocket.encodeFrame('hi'))
+        
+    def testAcceptKey(self):
+        # example from RFC 6455
+        self.assertEqual('s3pPLMBiTxaQ9kYGzzhZRbK+xOo=', websocket.acceptKey('dGhlIHNhbXBsZSBub25jZQ=='))
@@ -0,0 +1,137 @@
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+import juggernaut
+from juggernaut.workers import RelayHub, MasterLink, WorkerLink
+from juggernaut.channels import ClientSet
+
+import sys, json
+sys.path.append('test')
+from test_helper import TestConfig, connectProtocol
+
+class Pipe(proto_helpers.StringTransport):
+    '''Transport delivering written data straight to the other end'''
+    def __init__(self, peer):
+        proto_helpers.StringTransport.__init__(self)
+        self.peer = peer
+        
+    def write(self, data):
+        self.peer.dataReceived(data)
+
+class WorkerPipe(Pipe):
+    '''Pipe into a worker, the worker handles the data with its own message id counter'''
+    def __init__(self, peer, counters, index):
+        Pipe.__init__(self, peer)
+        self.counters = counters
+        self.index = index
+        
+    def write(self, data):
+        self.counters.run(self.index, self.peer.dataReceived, data)
+
+class IdCounters:
+    '''Message id counter of every worker, swapped in while the worker runs. Workers share the counter 
+    of this process otherwise, in worker processes each of them has its own'''
+    def __init__(self, count):
+        self.current_ids = range(count) # every worker starts at its index, as in runWorker
+        self.running = None
+        
+    def run(self, index, f, *args):
+        previous = self.running
+        if previous is not None:
+            self.current_ids[previous] = juggernaut.Message.current_id
+        juggernaut.Message.current_id, self.running = self.current_ids[index], index
+        try:
+            return f(*args)
+        finally:
+            self.current_ids[index] = juggernaut.Message.current_id
+            self.running = previous
+            if previous is not None:
+                juggernaut.Message.current_id = self.current_ids[previous]
+
+class WorkersTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.patch(juggernaut.Message, 'current_id', 0)
+        self.patch(juggernaut.Message, 'id_step', 2)
+        self.hub = RelayHub()
+        self.counters = IdCounters(2)
+        self.workers = [self._startWorker(index) for index in range(2)]
+        
+    def tearDown(self):
+        for worker in self.workers:
+            worker.stopService()
+        
+    def _startWorker(self, index):
+        worker = juggernaut.JuggernautService(dict(TestConfig.config))
+        worker.relay = WorkerLink(worker)
+        master = MasterLink(self.hub, index)
+        worker.relay.makeConnection(Pipe(master))
+        master.makeConnection(WorkerPipe(worker.relay, self.counters, index))
+        self.hub.addLink(master)
+        return worker
+        
+    def _addClient(self, worker, client_id, channel_id=1):
+        connector = connectProtocol(worker)
+        client = worker.findOrCreateClient(connector, client_id, client_id, channel_id)
+        client.channel_id = channel_id
+        worker.channels.setdefault(channel_id, ClientSet()).add(client)
+        return connector.transport
+    
+    def _messages(self, transport):
+        return map(json.loads, filter(None, transport.value().split('\0')))
+        
+    def testBroadcastReachesClientsOfOtherWorkers(self):
+        transports = [self._addClient(worker, index) for index, worker in enumerate(self.workers)]
+        self.workers[0].broadcast({'type': 'to_channels', 'channels': [1], 'body': 'hello'})
+        messages = map(self._messages, transports)
+        self.assertEqual([['hello'], ['hello']], [[msg['body'] for msg in received] for received in messages])
+        self.assertEqual(messages[0][0]['id'], messages[1][0]['id'])
+        
+    def testMessageIdsStayUnique(self):
+        '''Every worker numbers messages in its own stripe with its own counter, and moves the counter past 
+        the ids of messages relayed from the other worker'''
+        transport = self._addClient(self.workers[1], 1)
+        for index, body in [(0, 'first'), (1, 'second'), (1, 'third'), (0, 'fourth')]:
+            self.counters.run(index, self.workers[index].broadcast, {'type': 'to_clients', 'client_ids': [1], 'body': body})
+        messages = self._messages(transport)
+        self.assertEqual(['first', 'second', 'third', 'fourth'], [msg['body'] for msg in messages])
+        self.assertEqual([0, 1, 3, 4], [msg['id'] for msg in messages])
+        
+    def testClientsOfOtherWorkersAreNotMissing(self):
+        errors = []
+        self.patch(juggernaut.logger, 'error', lambda *args: errors.append(args))
+        transport = self._addClient(self.workers[1], 1)
+        self.workers[0].broadcast({'type': 'to_clients', 'client_ids': [1, 2], 'body': 'hello'})
+        self.assertEqual(['hello'], [msg['body'] for msg in self._messages(transport)])
+        self.assertEqual([], errors)
+        
+    def testQueryMergesResponsesOfAllWorkers(self):
+        for index, worker in enumerate(self.workers):
+            self._addClient(worker, index)
+        collector = juggernaut.ResponseCollector()
+        self.workers[1].query({'type': 'show_clients_for_channels', 'channels': [1]}, collector)
+        self.assertEqual([1, 0], [client['client_id'] for client in collector.response])
+        
+        collector = juggernaut.ResponseCollector()
+        self.workers[0].query({'type': 'show_client', 'client_id': 1}, collector)
+        self.assertEqual(1, collector.response['client_id'])
+        
+    def testQueryAnsweredWhenWorkerIsGone(self):
+        self._addClient(self.workers[0], 0)
+        self.hub.removeLink(1)
+        collector = juggernaut.ResponseCollector()
+        self.workers[0].query({'type': 'show_clients'}, collector)
+        self.assertEqual([0], [client['client_id'] for client in collector.response])
+        
+    def testBrokenBroadcastIsNotRelayed(self):
+        transport = self._addClient(self.workers[1], 1)
+        for request in [{'type': u'bogus', 'body': 'x'}, {'type': u'to_clients', 'body': 'x'}, 
+                {'type': 'batch', 'broadcasts': [{'client_ids': [1], 'body': 'x'}, {'client_ids': 1, 'body': 'y'}]}]:
+            self.assertRaises(ValueError, self.workers[0].broadcast, request)
+        self.assertEqual([], self._messages(transport))
+        
+    def testWorkerSurvivesFailingRelayedBroadcast(self):
+        transport = self._addClient(self.workers[1], 1)
+        self.workers[1].relay.dataReceived(json.dumps({'op': 'broadcast', 'request': {'type': 'bogus', 'body': 'x'}, 'id': 1}) + '\0' + 
+            json.dumps({'op': 'broadcast', 'request': {'type': 'to_clients', 'client_ids': [1], 'body': 'after'}, 'id': 2}) + '\0')
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+        self.assertEqual(['after'], [msg['body'] for msg in self._messages(transport)])